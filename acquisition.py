@@ -0,0 +1,160 @@
+import logging
+import queue
+import threading
+import time
+
+import metrics
+from adaptive_scheduler import AdaptiveScheduler
+from co2_ampel import get_all_information, record_sample_lag, required_locations, sweep_locations, update_forecast, write_to_file
+from rgb_controller import set_ampel
+from util import map_value_clamp
+
+logger = logging.getLogger("co2_ampel")
+
+class AcquisitionResult:
+    """Result of one run of the acquisition pipeline.
+    kind is 'sample' (data holds the dict of get_all_information), 'unchanged' or 'error' (error holds the exception)"""
+    __slots__ = ('kind', 'generation', 'data', 'error', 'latency', 'next_delay')
+
+    def __init__(self, kind, generation, data=None, error=None, latency=0, next_delay=None):
+        self.kind = kind
+        self.generation = generation
+        self.data = data
+        self.error = error
+        self.latency = latency
+        self.next_delay = next_delay
+
+class AcquisitionWorker:
+    """Runs the fetch, estimate, write and led pipeline in a background thread.
+
+    submit starts a run, the result is put into the thread-safe queue results.
+    cancel invalidates the running and all submitted runs, their results are dropped. A run that has
+    new observations still stores its sample and sets the leds, the sample is the result of the next run
+    then, so it is not lost. Only one run of the current generation is running or waiting at a time,
+    a cancelled run can be replaced right away.
+    With forecast_hours every run also updates the forecast curve, see co2_ampel.update_forecast.
+    With a server.AmpelClient as client, the runs read the current sample of its server instead of fetching,
+    with forecast_hours every new sample also reads the forecast curve of the server."""
+
+    def __init__(self, scheduler=None, ampel_range=(270, 650), forecast_hours=None, client=None):
+        self.scheduler = AdaptiveScheduler() if scheduler is None else scheduler
+        self.ampel_range = ampel_range
+        self.forecast_hours = forecast_hours
+        self.client = client
+        # time of the last sample read from the client
+        self._last_time = None
+        self.results = queue.Queue()
+
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._generation = 0
+        # number of runs that are running or waiting and the generation of the last one
+        self._pending = 0
+        self._pending_generation = None
+        # dict of get_all_information of a cancelled run, reported by the next run
+        self._unreported = None
+
+        self._thread = threading.Thread(target=self._run, name="acquisition", daemon=True)
+        self._thread.start()
+
+    @property
+    def busy(self) -> bool:
+        """True while a run is running or waiting"""
+        return self._pending > 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def submit(self, use_precise=False) -> bool:
+        """starts a run. Returns False if a run of the current generation is already running or waiting"""
+        with self._lock:
+            if self._pending and self._pending_generation == self._generation:
+                return False
+            self._pending += 1
+            self._pending_generation = self._generation
+            self._jobs.put((self._generation, use_precise))
+            return True
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._generation += 1
+
+    def stop(self) -> None:
+        """cancels all runs and ends the thread"""
+        self.cancel()
+        self._jobs.put(None)
+
+    def _is_cancelled(self, generation) -> bool:
+        return generation != self._generation
+
+    def _acquire_remote(self, generation):
+        all_info = self.client.all_information()
+        if all_info['time'] == self._last_time:
+            return AcquisitionResult('unchanged', generation)
+        if self._is_cancelled(generation):
+            return None
+
+        self._last_time = all_info['time']
+        if self.forecast_hours:
+            # /current has no curve. The curve is revalidated with its ETag, so an unchanged one is not sent again
+            try:
+                all_info['forecast'] = self.client.forecast()
+            except Exception as error:
+                logger.warning("could not read the forecast: %r", error)
+        set_ampel(map_value_clamp(all_info['gpkwh'], *self.ampel_range, 0, 1), bool(all_info.get('clean_window_ahead')))
+        return AcquisitionResult('sample', generation, data=all_info)
+
+    def _acquire(self, generation, use_precise):
+        if self.client is not None:
+            return self._acquire_remote(generation)
+
+        locations = required_locations(use_precise)
+        with metrics.timed('fetch'):
+            changed = self.scheduler.refresh(locations, sweep=sweep_locations(use_precise))
+        if not changed:
+            unreported, self._unreported = self._unreported, None
+            if unreported is not None:
+                return AcquisitionResult('sample', generation, data=unreported)
+            return AcquisitionResult('unchanged', generation)
+
+        # the scheduler has recorded the observations now, so the run is finished even if it is cancelled
+        all_info = get_all_information(use_precise=use_precise, fetch=self.scheduler.get, cached=True)
+        sample = all_info['sample']
+        with metrics.timed('store'):
+            write_to_file(sample)
+        record_sample_lag(all_info)
+
+        all_info['clean_window_ahead'] = False
+        if self.forecast_hours:
+            all_info['forecast'], all_info['clean_window_ahead'] = update_forecast(sample, use_precise, self.forecast_hours)
+        set_ampel(map_value_clamp(sample.gpkwh, *self.ampel_range, 0, 1), all_info['clean_window_ahead'])
+        if self._is_cancelled(generation):
+            self._unreported = all_info
+            return None
+        self._unreported = None
+        return AcquisitionResult('sample', generation, data=all_info)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            generation, use_precise = job
+
+            start = time.perf_counter()
+            try:
+                result = None if self._is_cancelled(generation) else self._acquire(generation, use_precise)
+            except Exception as e:
+                metrics.inc('cycle_errors_total')
+                result = AcquisitionResult('error', generation, error=e)
+
+            if result is not None:
+                result.latency = time.perf_counter() - start
+                metrics.observe('stage_seconds', result.latency, stage='cycle')
+                # the server of a client has its own schedule
+                result.next_delay = None if self.client is not None else self.scheduler.next_delay(required_locations(use_precise))
+                self.results.put(result)
+
+            with self._lock:
+                self._pending -= 1
@@ -0,0 +1,132 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+import sweep
+from util import request_park_weather_data, request_weather_data
+
+class _LocationState:
+    __slots__ = ('weather', 'dt', 'interval', 'next_refresh', 'misses')
+
+    def __init__(self, interval):
+        self.weather = None
+        self.dt = None
+        self.interval = interval
+        self.next_refresh = 0
+        self.misses = 0
+
+class AdaptiveScheduler:
+    """Polls weather locations only when a new observation is expected.
+
+    For every location the time of the last observation ('dt' of the response) is tracked.
+    The update interval of each location is learned from consecutive observations and used
+    to predict when the next observation will be available. Until then the location is fresh and
+    the last response is reused. If a location is requested after the predicted time and the
+    observation has not changed, the scheduler backs off exponentially up to max_delay.
+
+    Sweep locations (the windparks of the precise mode) are requested with sweep_fetch, longest
+    waiting first, within sweep_deadline seconds (see sweep.fetch_all). If some of them are refused
+    by the rate limit, fail or are too slow, they stay stale and are requested in a later cycle."""
+
+    def __init__(self, fetch=None, default_interval: float = 600, min_delay: float = 60,
+                 max_delay: float = 1800, grace: float = 30, max_workers: int = 8, sweep_fetch=None,
+                 sweep_deadline: Optional[float] = None, hedge_after: Optional[float] = None):
+        self.fetch = request_weather_data if fetch is None else fetch
+        self.sweep_fetch = (request_park_weather_data if fetch is None else fetch) if sweep_fetch is None else sweep_fetch
+        self.default_interval = default_interval
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.grace = grace
+        self.max_workers = max_workers
+        self.sweep_deadline = sweep_deadline
+        self.hedge_after = hedge_after
+
+        self._locations: Dict[Tuple[float, float], _LocationState] = {}
+        self._sweep = set()
+
+    def _state(self, location) -> _LocationState:
+        state = self._locations.get(location)
+        if state is None:
+            state = self._locations[location] = _LocationState(self.default_interval)
+        return state
+
+    def is_stale(self, lat: float, lon: float, now: Optional[float] = None) -> bool:
+        """returns True if a new observation is expected at lat, lon"""
+        now = time.time() if now is None else now
+        state = self._locations.get((lat, lon))
+        return state is None or state.weather is None or state.next_refresh <= now
+
+    def observe(self, lat: float, lon: float, weather: dict, now: Optional[float] = None) -> bool:
+        """records a weather response at lat, lon and predicts the next refresh.
+        Returns True if the response holds a new observation."""
+        now = time.time() if now is None else now
+        state = self._state((lat, lon))
+        dt = weather.get('dt')
+
+        if dt is not None and dt != state.dt:
+            if state.dt is not None and dt > state.dt:
+                # exponential moving average of the time between observations
+                observed_interval = min(max(dt - state.dt, self.min_delay), self.max_delay)
+                state.interval = 0.7 * state.interval + 0.3 * observed_interval
+            state.weather = weather
+            state.dt = dt
+            state.misses = 0
+            state.next_refresh = max(dt + state.interval + self.grace, now + self.min_delay)
+            return True
+
+        if state.weather is None:
+            state.weather = weather
+        state.misses += 1
+        state.next_refresh = now + min(self.min_delay * 2 ** (state.misses - 1), self.max_delay)
+        return False
+
+    def refresh(self, locations: Iterable[Tuple[float, float]], now: Optional[float] = None, sweep: Iterable[Tuple[float, float]] = ()) -> bool:
+        """requests all stale locations. Returns True if any of them has a new observation.
+        The locations of sweep are requested after the others and are skipped if they don't answer in time"""
+        now = time.time() if now is None else now
+        self._sweep = set(sweep)
+        # locations that are listed several times, e.g. by several regions, are requested once
+        stale = [location for location in dict.fromkeys(locations) if self.is_stale(*location, now=now)]
+        if not stale:
+            return False
+        headline = [location for location in stale if location not in self._sweep]
+        # the sweep locations that are waiting the longest are requested first
+        parks = sorted((location for location in stale if location in self._sweep), key=lambda location: self._state(location).next_refresh)
+
+        if self.max_workers <= 1 or len(headline) <= 1:
+            weathers = [self.fetch(lat, lon) for lat, lon in headline]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(headline))) as executor:
+                weathers = list(executor.map(lambda location: self.fetch(*location), headline))
+        weathers += self._fetch_sweep(parks)
+
+        changed = False
+        for location, weather in zip(headline + parks, weathers):
+            if weather is not None:
+                changed = self.observe(*location, weather, now=now) or changed
+        return changed
+
+    def _fetch_sweep(self, locations):
+        return sweep.fetch_all(locations, self.sweep_fetch, self.max_workers, self.sweep_deadline, hedge_after=self.hedge_after)
+
+    def get(self, lat: float, lon: float) -> Optional[dict]:
+        """returns the last response at lat, lon. Unknown locations are requested.
+        For sweep locations nothing is requested, None is returned if they did not answer in the last refresh.
+        Can be passed as fetch to co2_ampel.get_all_information"""
+        state = self._locations.get((lat, lon))
+        if (lat, lon) in self._sweep:
+            return None if state is None or self.is_stale(lat, lon) else state.weather
+        if state is None or state.weather is None:
+            self.observe(lat, lon, self.fetch(lat, lon))
+            state = self._locations[(lat, lon)]
+        return state.weather
+
+    def next_delay(self, locations: Optional[Iterable[Tuple[float, float]]] = None, now: Optional[float] = None) -> float:
+        """returns the seconds until the next location is expected to have a new observation,
+        clamped to min_delay and max_delay"""
+        now = time.time() if now is None else now
+        locations = self._locations if locations is None else locations
+        refresh_times = [self._locations[location].next_refresh for location in locations if location in self._locations]
+        if not refresh_times:
+            return self.min_delay
+        return min(max(min(refresh_times) - now, self.min_delay), self.max_delay)
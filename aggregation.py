@@ -0,0 +1,161 @@
+import datetime
+import os
+import time as _time
+
+import numpy as np
+
+import data_reader
+
+# bucket sizes in seconds of the aggregation levels
+LEVELS = (600, 3600, 86400)
+
+# time between two raw samples that is assumed when choosing a level
+SAMPLE_INTERVAL = 60
+
+FIELDS = ('onshore', 'offshore', 'solar', 'conv', 'total', 'gpkwh')
+
+def level_path(level: int, path=data_reader.DATA_FILE):
+    """returns the path of the file of an aggregation level, e.g. data/data_agg_600.csv"""
+    root, extension = os.path.splitext(path)
+    return f"{root}_agg_{level}{extension}"
+
+class _Bucket:
+    __slots__ = ('start', 'count', 'minimum', 'maximum', 'sum')
+
+    def __init__(self, start, values):
+        self.start = start
+        self.count = len(values)
+        self.minimum = values.min(axis=0)
+        self.maximum = values.max(axis=0)
+        self.sum = values.sum(axis=0)
+
+    def add(self, values):
+        self.count += len(values)
+        self.minimum = np.minimum(self.minimum, values.min(axis=0))
+        self.maximum = np.maximum(self.maximum, values.max(axis=0))
+        self.sum = self.sum + values.sum(axis=0)
+
+    def to_line(self):
+        # time,count,then min,max,mean of every field
+        columns = [datetime.datetime.fromtimestamp(self.start).strftime(data_reader.TIME_FORMAT), str(self.count)]
+        for minimum, maximum, total in zip(self.minimum, self.maximum, self.sum):
+            columns += [str(minimum), str(maximum), str(total / self.count)]
+        return ','.join(columns) + '\n'
+
+# bucket that is not finished yet, by (path, level)
+_open_buckets = {}
+
+def _bucket_start(timestamp, level):
+    # buckets are aligned to local time, so daily buckets start at midnight
+    offset = datetime.datetime.fromtimestamp(timestamp).astimezone().utcoffset().total_seconds()
+    return (timestamp + offset) // level * level - offset
+
+def _add(level, path, times, values):
+    """adds samples that are newer than everything aggregated so far and writes all finished buckets"""
+    key = (path, level)
+    starts = np.array([_bucket_start(timestamp, level) for timestamp in times])
+    lines = []
+    for start in np.unique(starts):
+        bucket_values = values[starts == start]
+        bucket = _open_buckets.get(key)
+        if bucket is not None and bucket.start == start:
+            bucket.add(bucket_values)
+            continue
+        if bucket is not None:
+            lines.append(bucket.to_line())
+        _open_buckets[key] = _Bucket(start, bucket_values)
+
+    if lines:
+        with open(level_path(level, path), 'a') as f:
+            f.writelines(lines)
+
+def _catch_up(level, path, until):
+    """aggregates all raw samples up to until that are not part of the level file yet"""
+    lines = data_reader._read_last_lines(level_path(level, path), 1) if os.path.exists(level_path(level, path)) else []
+    start = data_reader._line_time(lines[0]) + level if lines else 0
+    data = data_reader.read_range(start, until, path)
+    _open_buckets.pop((path, level), None)
+    if data['time']:
+        _add(level, path, data['time'], np.column_stack([data[field] for field in FIELDS]))
+
+def add_sample(time: datetime.datetime, values, path=data_reader.DATA_FILE) -> None:
+    """updates all aggregation levels with a sample that has just been appended to the data file.
+    values are onshore, offshore, solar, conv, total, gpkwh"""
+    for level in LEVELS:
+        if (path, level) not in _open_buckets:
+            # the first sample after a restart also aggregates everything that was missed
+            _catch_up(level, path, time)
+        else:
+            _add(level, path, [time.timestamp()], np.array([values], dtype=np.float64))
+
+def reset(path=data_reader.DATA_FILE) -> None:
+    """forgets the unfinished buckets, e.g. after the data file was archived"""
+    for level in LEVELS:
+        _open_buckets.pop((path, level), None)
+
+def _parse_aggregated_lines(lines):
+    data = {'time': [], 'count': []}
+    for field in FIELDS:
+        data[field] = []
+        data[field + '_min'] = []
+        data[field + '_max'] = []
+
+    for line in lines:
+        line_elements = line.split(',')
+        data['time'].append(datetime.datetime.strptime(line_elements[0], data_reader.TIME_FORMAT).timestamp())
+        data['count'].append(int(line_elements[1]))
+        for i, field in enumerate(FIELDS):
+            data[field + '_min'].append(float(line_elements[2 + 3 * i]))
+            data[field + '_max'].append(float(line_elements[3 + 3 * i]))
+            data[field].append(float(line_elements[4 + 3 * i]))
+    return data
+
+def read_aggregated(level: int, start, end, path=data_reader.DATA_FILE):
+    """reads the buckets of an aggregation level that start from start to end.
+    Returns a dict like data_reader.read_range with the mean of each bucket and
+    additionally '<field>_min', '<field>_max' and 'count'. The unfinished bucket is included."""
+    start = start.timestamp() if isinstance(start, datetime.datetime) else start
+    end = end.timestamp() if isinstance(end, datetime.datetime) else end
+
+    lines = []
+    file_path = level_path(level, path)
+    if os.path.exists(file_path):
+        with open(file_path, 'rb') as f:
+            f.seek(data_reader._find_offset(f, os.path.getsize(file_path), start))
+            for line in f:
+                if not line.strip():
+                    continue
+                if data_reader._line_time(line) > end:
+                    break
+                lines.append(line.decode().rstrip('\n'))
+
+    bucket = _open_buckets.get((path, level))
+    if bucket is not None and start <= bucket.start <= end:
+        lines.append(bucket.to_line().rstrip('\n'))
+
+    return _parse_aggregated_lines(lines)
+
+def choose_level(span: float, width: int, sample_interval: float = SAMPLE_INTERVAL) -> int:
+    """returns the finest resolution that shows span seconds with at most one point per pixel.
+    0 means raw samples, otherwise a level of LEVELS"""
+    if span / sample_interval <= width:
+        return 0
+    for level in LEVELS:
+        if span / level <= width:
+            return level
+    return LEVELS[-1]
+
+def read_for_plot(start, end, width: int, path=data_reader.DATA_FILE):
+    """reads the data from start to end in a resolution that fits width pixels.
+    Returns (level, data), see choose_level and read_aggregated"""
+    start = start.timestamp() if isinstance(start, datetime.datetime) else start
+    end = end.timestamp() if isinstance(end, datetime.datetime) else end
+    level = choose_level(end - start, width)
+    if level == 0:
+        return level, data_reader.read_range(start, end, path)
+    return level, read_aggregated(level, start, end, path)
+
+def read_latest_span(span: float, width: int, path=data_reader.DATA_FILE):
+    """reads the last span seconds in a resolution that fits width pixels, see read_for_plot"""
+    now = _time.time()
+    return read_for_plot(now - span, now, width, path)
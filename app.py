@@ -1,17 +1,34 @@
 import tkinter as tk
+import argparse
 import datetime
-import matplotlib
 import json
+import logging
 
-from co2_ampel import get_all_information, map_value_clamp, write_to_file
-from rgb_controller import set_ampel, quit
+import data_reader
+import forecast
+import metrics
+from acquisition import AcquisitionWorker
+from rgb_controller import quit
+from util import enable_cache, enable_rate_limit, remaining_budget
 
-matplotlib.use('TkAgg')
+# matplotlib is only imported when the Plot module is shown for the first time
 
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+logger = logging.getLogger("co2_ampel")
 
-import data_reader
+# events published by the modules, see CO2AmpelGUI.publish
+NEW_SAMPLE = 'new_sample'          # payload: dict of co2_ampel.get_all_information
+FETCH_ERROR = 'fetch_error'        # payload: exception
+CONFIG_CHANGE = 'config_change'    # payload: (name, value) of the changed setting
+
+
+class Subscription:
+    __slots__ = ('module', 'callback', 'coalesce', 'pending')
+
+    def __init__(self, module, callback, coalesce):
+        self.module = module
+        self.callback = callback
+        self.coalesce = coalesce
+        self.pending = []
 
 
 class CO2AmpelGUI(tk.Tk):
@@ -36,13 +53,16 @@ class CO2AmpelGUI(tk.Tk):
 
         self.modules = {}
         self.module_selector_buttons = {}
+        self.active_module = None
 
         self.attrs = {}
+        self.subscriptions = {}
+        self.published_events = 0
 
     def register_module(self, module):
         if module in self.modules:
             print("Module already registered!")
-            return
+            return module
 
         self.modules[module] = module(self, self.module_frame)
         self.modules[module].grid(row=0, column=0, sticky='nswe')
@@ -51,21 +71,45 @@ class CO2AmpelGUI(tk.Tk):
                                                             command=lambda m=module: self.enable_module(m))
         self.module_selector_frame.rowconfigure(len(self.module_selector_buttons) - 1, weight=1)
         self.module_selector_buttons[module].grid(row=len(self.module_selector_buttons) - 1, column=0, sticky='nswe')
+        return module
 
     def enable_module(self, module):
         self.active_module = module
         self.modules[module].tkraise()
+        self.modules[module].on_enable()
+
+        # the module catches up on the events it missed while it was hidden, in the order they were published
+        missed = []
+        for subscriptions in self.subscriptions.values():
+            for subscription in subscriptions:
+                if subscription.module is self.modules[module]:
+                    missed += [(number, subscription.callback, payload) for number, payload in subscription.pending]
+                    subscription.pending = []
+        for _, callback, payload in sorted(missed, key=lambda event: event[0]):
+            callback(payload)
 
     def mainloop(self, *args, **kwargs):
         if len(self.modules):
             self.enable_module(list(self.modules.keys())[0])
-        self.update_modules()
         super().mainloop(*args, **kwargs)
 
-    def update_modules(self):
-        self.modules[self.active_module].on_update()
-
-        self.after(1000, self.update_modules)
+    def subscribe(self, module, event, callback, coalesce=True):
+        """calls callback(payload) whenever event is published while module is visible.
+        Events published while the module is hidden are delivered when it is enabled,
+        with coalesce=True only the latest of them."""
+        self.subscriptions.setdefault(event, []).append(Subscription(module, callback, coalesce))
+
+    def publish(self, event, payload=None):
+        """has to be called from the Tk thread"""
+        self.published_events += 1
+        active = self.modules.get(self.active_module)
+        for subscription in self.subscriptions.get(event, []):
+            if subscription.module is active:
+                subscription.callback(payload)
+            elif subscription.coalesce:
+                subscription.pending = [(self.published_events, payload)]
+            else:
+                subscription.pending.append((self.published_events, payload))
 
     def set_attr(self, attr, value):
         self.attrs[attr] = value
@@ -78,7 +122,11 @@ class AbstractModule(tk.Frame):
         self.app: CO2AmpelGUI = app
         super().__init__(*args, **kwargs)
 
-    def on_update(self):
+    def subscribe(self, event, callback, coalesce=True):
+        self.app.subscribe(self, event, callback, coalesce)
+
+    def on_enable(self):
+        """called when the module is shown, before it receives the events it missed"""
         pass
 
 
@@ -117,6 +165,7 @@ class Home(AbstractModule):
         self.config_frame.rowconfigure(1, weight=1)
         self.config_frame.rowconfigure(2, weight=1)
         self.config_frame.rowconfigure(3, weight=1)
+        self.config_frame.rowconfigure(4, weight=1)
 
         self.run_button = tk.Button(self.config_frame, command=self.on_run_click, **self.NOT_RUNNING_BUTTON_CONFIG)
         self.run_button.grid(row=0, column=0, sticky='nswe', padx=50, pady=10)
@@ -141,91 +190,181 @@ class Home(AbstractModule):
 
         tk.Button(self.delta_frame, command=self.on_delta_time_button, text='set delta time').grid(row=0, column=1, sticky='nswe')
 
+        self.status_label = tk.Label(self.config_frame, text='idle')
+        self.status_label.grid(row=4, column=0, sticky='nswe', padx=50, pady=10)
+
         self.loop_started = False
+        self.loop_id = None
+        self.polling = False
+        self.next_delay = None
+        self.worker = AcquisitionWorker(forecast_hours=forecast.FORECAST_HOURS)
 
     def on_run_click(self):
-        if not self.loop_started:
-            self.process_data_loop()
         new_state = not self.app.get_attr('running')
         self.app.set_attr('running', new_state)
         self.run_button.configure(self.RUNNING_BUTTON_CONFIG if new_state else self.NOT_RUNNING_BUTTON_CONFIG)
-        self.process_data()
+        if new_state:
+            self.process_data_loop()
+        else:
+            # no timer is left running while the Ampel is stopped
+            self.worker.cancel()
+            self.after_cancel(self.loop_id)
+            self.loop_started = False
+            self.status_label.configure(text='stopped')
+        self.app.publish(CONFIG_CHANGE, ('running', new_state))
 
     def on_precision_click(self):
         new_state = not self.app.get_attr('use_precise')
         self.app.set_attr('use_precise', new_state)
         self.precision_button.configure(text='deactivate precise mode' if new_state else 'activate precise mode')
+        self.app.publish(CONFIG_CHANGE, ('use_precise', new_state))
 
     def on_delte_data_click(self):
-        with open('data/data.csv', 'r+') as data_file, open('data/data.csv.old', 'w') as old_file:
-            data_content = data_file.read()
-            print(data_content)
-            old_file.write(data_content)
+        import aggregation
 
-        with open('data/data.csv', 'w'):
-            pass
+        logger.info("archived plot data to %s", data_reader.archive_data())
+        aggregation.reset()
+        self.app.publish(CONFIG_CHANGE, ('data', 'archived'))
 
     def on_delta_time_button(self):
         self.delta_time = float(self.delta_time_entry.get())
+        if self.loop_started:
+            # the loop restarts with the new delta time, a running fetch hands its sample to the new one
+            self.worker.cancel()
+            self.after_cancel(self.loop_id)
+            self.process_data_loop()
+        self.app.publish(CONFIG_CHANGE, ('delta_time', self.delta_time))
 
     def process_data_loop(self):
         self.loop_started = True
         self.process_data()
-        self.after(int(1000 * 60 * self.delta_time), self.process_data_loop)
+        # delta_time is the longest time between two polls, the scheduler polls earlier if new observations are expected
+        delay = 60 * self.delta_time if self.next_delay is None else min(60 * self.delta_time, self.next_delay)
+        self.loop_id = self.after(int(1000 * delay), self.process_data_loop)
 
     def process_data(self):
-        if self.app.get_attr('running'):
-            try:
-                all_info = get_all_information(use_precise=self.app.get_attr('use_precise'))
-                self.app.set_attr('current_data', all_info)
-                write_to_file(all_info['power'])
-                self.app.set_attr('new_data_plot', True)
-                self.app.set_attr('new_data_weather', True)
+        if self.app.get_attr('running') and self.worker.submit(self.app.get_attr('use_precise')):
+            self.status_label.configure(text='fetch in progress...')
+            if not self.polling:
+                self.polling = True
+                self.poll_results()
+
+    def poll_results(self):
+        """hands the results of the acquisition worker to the gui. Only polls while a fetch is in progress"""
+        while not self.worker.results.empty():
+            self.on_result(self.worker.results.get())
+
+        if self.worker.busy or not self.worker.results.empty():
+            self.after(100, self.poll_results)
+        else:
+            self.polling = False
+
+    def on_result(self, result):
+        if result.generation != self.worker.generation:
+            return
+        self.next_delay = result.next_delay
+
+        finished = datetime.datetime.now().strftime("%H:%M:%S")
+        budget = remaining_budget()
+        budget_text = '' if budget is None else f"\n{budget['minute']} requests left this minute, {budget['day']} today"
+        if result.kind == 'sample':
+            self.app.set_attr('current_data', result.data)
+            coverage = result.data['coverage']
+            coverage_text = f', {100 * coverage:.0f} % of the windparks answered' if coverage < 1 else ''
+            self.status_label.configure(text=f'last fetch at {finished} took {result.latency:.1f} s{coverage_text}' + budget_text)
+            self.app.publish(NEW_SAMPLE, result.data)
+        elif result.kind == 'unchanged':
+            self.status_label.configure(text=f'no new observations at {finished}, fetch took {result.latency:.1f} s' + budget_text)
+        else:
+            logger.error("fetch failed: %r", result.error)
+            self.status_label.configure(text=f'fetch failed at {finished}: {result.error}' + budget_text)
+            self.app.publish(FETCH_ERROR, result.error)
 
-                set_ampel(map_value_clamp(all_info['gpkwh'], 270, 650, 0, 1))
-            except Exception as e:
-                print(f"Exception {e}")
-        
 
 
 @app.register_module
 class Plot(AbstractModule):
+    # shown time span in seconds, None shows the latest samples
+    SPANS = {
+        'latest samples': None,
+        '1 day': 60 * 60 * 24,
+        '1 week': 60 * 60 * 24 * 7,
+        '1 month': 60 * 60 * 24 * 30,
+        '1 year': 60 * 60 * 24 * 365
+    }
+
+    # number of samples shown for 'latest samples'
+    LATEST_SAMPLES = 50
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs, bg='blue')
 
+        self.span = tk.StringVar(self, 'latest samples')
+        tk.OptionMenu(self, self.span, *self.SPANS, command=lambda _: self.plot_data()).pack(fill=tk.X)
+
+        self.figure_canvas = None
+        self.plotted = False
+
+        self.subscribe(NEW_SAMPLE, self.on_new_sample)
+        self.subscribe(CONFIG_CHANGE, self.on_config_change, coalesce=False)
+
+    def on_enable(self):
+        if self.figure_canvas is None:
+            self.build_figure()
+            self.plot_data()
+
+    def build_figure(self):
+        import matplotlib
+        matplotlib.use('TkAgg')
+
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+
+        from plot_view import PowerPlot
+
         self.figure = Figure()
         self.figure_canvas = FigureCanvasTkAgg(self.figure, self)
         NavigationToolbar2Tk(self.figure_canvas, self)
-        self.ax = self.figure.add_subplot()
-        self.ax2 = self.ax.twinx()
+        self.power_plot = PowerPlot(self.figure, self.figure_canvas, incremental=True)
         self.figure_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=1)
 
-    def on_update(self):
-        if self.app.get_attr('new_data_plot'):
+    def on_new_sample(self, all_info):
+        if self.plotted and self.SPANS[self.span.get()] is None:
+            # the new sample is drawn without reading the data file
+            self.power_plot.append(all_info['sample'].to_data())
+        else:
             self.plot_data()
-            self.app.set_attr('new_data_plot', False)
 
-    def plot_data(self):
-        data = data_reader.read_latest_n_points(50)
-        time, distribution, total, gpkwh = data_reader.convert_to_plot_data(data)
-
-        self.ax.clear()
+    def on_config_change(self, change):
+        if change == ('data', 'archived'):
+            self.plot_data()
 
-        self.ax.stackplot(time, distribution, labels=["offshore", "onshore", "solar", "conv"])
-        self.ax.plot(time, total, label='total')
-        self.ax.set_xlabel('time')
-        self.ax.set_ylabel('power in GW')
+    def read_data(self):
+        """reads the data of the selected span in a resolution that matches the width of the plot.
+        Returns (level, data), see aggregation.read_for_plot"""
+        import aggregation
 
-        self.ax2.clear()
-        self.ax2.set_ylim(200, 900)
-        self.ax2.plot(time, gpkwh, 'black', label='emission')
-        self.ax2.set_ylabel('g CO2 per kWh')
+        span = self.SPANS[self.span.get()]
+        width = self.figure_canvas.get_tk_widget().winfo_width()
+        client = self.app.get_attr('client')
+        if client is not None:
+            if span is None:
+                return 0, client.latest(self.LATEST_SAMPLES)
+            now = datetime.datetime.now().timestamp()
+            return client.range(now - span, now, width)
 
-        self.ax.legend(loc='upper left')
-        self.ax2.legend(loc='upper right')
-        self.ax.xaxis.set_major_formatter(lambda x, pos: datetime.datetime.fromtimestamp(x).strftime("%H:%M"))
+        if span is None:
+            return 0, data_reader.read_latest_n_points(self.LATEST_SAMPLES)
+        return aggregation.read_latest_span(span, width)
 
-        self.figure_canvas.draw()
+    def plot_data(self):
+        if self.figure_canvas is None:
+            return
+        level, data = self.read_data()
+        span = self.SPANS[self.span.get()]
+        time_format = "%H:%M" if span is None or span <= 60 * 60 * 24 else "%d.%m."
+        self.power_plot.plot(data, level, time_format, max_points=self.LATEST_SAMPLES if span is None else None)
+        self.plotted = True
 
 
 @app.register_module
@@ -239,9 +378,14 @@ class WeatherInfo(AbstractModule):
             self.label = tk.Label(self, text=property, font=("Georgia", 7), justify='left')
             self.label.grid(row=0, column=0, sticky="nswe")
             self.property = property
-
-        def on_update(self):
-            raw_json = app.get_attr('current_data')[self.property]
+            self.shown_weather = None
+
+        def show(self, all_info):
+            raw_json = all_info[self.property]
+            # the json is only formatted again if the observation changed
+            if raw_json is self.shown_weather or (raw_json and self.shown_weather and raw_json.get('dt') == self.shown_weather.get('dt')):
+                return
+            self.shown_weather = raw_json
             self.label.configure(text=json.dumps(raw_json, indent=2))
 
     def __init__(self, *args, **kwargs):
@@ -258,12 +402,130 @@ class WeatherInfo(AbstractModule):
             self.weather_infos[property] = self.WeatherInfoPanel(self, self.app, property)
             self.weather_infos[property].grid(row=0, column=counter, sticky='nswe')
 
-    def on_update(self):
-        if self.app.get_attr('new_data_weather'):
-            for property in self.weather_infos:
-                self.weather_infos[property].on_update()
-            self.app.set_attr('new_data_weather', False)
+        self.error_label = tk.Label(self, fg='red')
+        self.error_label.grid(row=1, column=0, columnspan=3, sticky='nswe')
+
+        self.subscribe(NEW_SAMPLE, self.on_new_sample)
+        self.subscribe(FETCH_ERROR, self.on_fetch_error)
+
+    def on_new_sample(self, all_info):
+        self.error_label.configure(text='')
+        for property in self.weather_infos:
+            self.weather_infos[property].show(all_info)
+
+    def on_fetch_error(self, error):
+        self.error_label.configure(text=f'last fetch failed: {error}')
+
+@app.register_module
+class Forecast(AbstractModule):
+    # hours of the window that is searched for the lowest emission
+    WINDOW_HOURS = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.window_label = tk.Label(self, justify='left', anchor='w')
+        self.window_label.pack(fill=tk.X)
+
+        self.figure_canvas = None
+        self.curve = None
+
+        self.subscribe(NEW_SAMPLE, self.on_new_sample)
+
+    def on_enable(self):
+        if self.figure_canvas is None:
+            self.build_figure()
+            # the stored curve is shown until the first fetch
+            if self.curve is None:
+                client = self.app.get_attr('client')
+                self.show(data_reader.read_forecast() if client is None else client.forecast())
+
+    def build_figure(self):
+        import matplotlib
+        matplotlib.use('TkAgg')
+
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+        self.figure = Figure()
+        self.axes = self.figure.add_subplot()
+        self.figure_canvas = FigureCanvasTkAgg(self.figure, self)
+        self.figure_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=1)
+
+    def on_new_sample(self, all_info):
+        if all_info.get('forecast') is not None:
+            self.show(all_info['forecast'])
+
+    def show(self, curve):
+        self.curve = curve
+        if not len(curve['time']):
+            self.window_label.configure(text='no forecast yet')
+            return
+
+        window = forecast.cleanest_window(curve, self.WINDOW_HOURS)
+        if window is not None:
+            start, end, gpkwh = (datetime.datetime.fromtimestamp(window[0]), datetime.datetime.fromtimestamp(window[1]), window[2])
+            self.window_label.configure(text=f"cleanest {self.WINDOW_HOURS} hours: {start:%a %H:%M} - {end:%H:%M}, {gpkwh:.0f} g CO2 / kWh")
+
+        if self.figure_canvas is None:
+            return
+        self.axes.clear()
+        self.axes.plot([datetime.datetime.fromtimestamp(t) for t in curve['time']], curve['gpkwh'], drawstyle='steps-post')
+        self.axes.set_ylabel('g CO2 / kWh')
+        self.figure.autofmt_xdate()
+        self.figure_canvas.draw_idle()
+
+@app.register_module
+class Metrics(AbstractModule):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+
+        self.label = tk.Label(self, font=("Courier", 9), justify='left', anchor='nw')
+        self.label.grid(row=0, column=0, sticky='nswe')
+
+        self.subscribe(NEW_SAMPLE, self.show)
+        self.subscribe(FETCH_ERROR, self.show)
+
+    def on_enable(self):
+        self.show()
+
+    def show(self, payload=None):
+        snapshot = metrics.snapshot()
+        lines = []
+        for name, histograms in sorted(snapshot['histograms'].items()):
+            if name == 'request_seconds':
+                continue
+            for labels, histogram in sorted(histograms.items()):
+                label = ','.join(value for _, value in labels)
+                lines.append(f"{name}{'[' + label + ']' if label else ''}: {histogram['count']} x, "
+                             f"mean {histogram['sum'] / histogram['count'] * 1000:.1f} ms")
+        requests = snapshot['histograms'].get('request_seconds', {})
+        if requests:
+            slowest = max(requests.items(), key=lambda item: item[1]['sum'] / item[1]['count'])
+            lines.append(f"slowest location: {slowest[0][0][1]}, mean {slowest[1]['sum'] / slowest[1]['count'] * 1000:.1f} ms")
+        for name, counter in sorted(snapshot['counters'].items()):
+            lines.append(f"{name}: {sum(counter.values())}")
+        self.label.configure(text='\n'.join(lines) or 'no metrics recorded yet')
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shows the CO2 emission per kWh.")
+    parser.add_argument('--source', help="url of an Ampel started with --serve-port. Its samples are shown instead of fetching any")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    if args.source is not None:
+        from server import AmpelClient
+
+        client = AmpelClient(args.source)
+        app.set_attr('client', client)
+        app.modules[Home].worker.client = client
+    else:
+        enable_cache()
+        enable_rate_limit()
+    metrics.enable()
     app.mainloop()
+    app.modules[Home].worker.stop()
     quit()
@@ -0,0 +1,332 @@
+"""Benchmarks of the CO2Ampel.
+
+    python benchmarks.py [--output bench_output.txt] [--rows 2000000] [--latency 0.05] [startup end_to_end ...]
+
+Every benchmark returns a dict of measurements. The results are printed as json,
+so they can be compared between versions and hardware.
+No benchmark needs the internet or an api key, the weather is requested from fake_openweather."""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# modules that must not be loaded by importing an entry point, by entry point
+STARTUP_MODULES = {
+    'estimator': ('requests', 'numpy', 'matplotlib', 'tkinter'),
+    'co2_ampel': ('requests', 'numpy', 'matplotlib', 'tkinter'),
+    'data_reader': ('requests', 'numpy', 'matplotlib', 'tkinter'),
+    'util': ('requests',),
+}
+
+def measure_import(module: str):
+    """imports module in a fresh interpreter. Returns (seconds, names of the loaded top level modules)"""
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            f"import {module}\n"
+            "duration = time.perf_counter() - start\n"
+            "print(duration)\n"
+            "print(' '.join(sorted({name.split('.')[0] for name in sys.modules})))")
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.splitlines()
+    return float(output[-2]), set(output[-1].split())
+
+def bench_startup(repeat=3):
+    """measures the import time of every entry point and which heavy modules it loads"""
+    results = {}
+    for module, forbidden in STARTUP_MODULES.items():
+        times = []
+        for _ in range(repeat):
+            seconds, loaded = measure_import(module)
+            times.append(seconds)
+        results[module] = {
+            'import_seconds': min(times),
+            'heavy_modules': sorted(set(forbidden) & loaded)
+        }
+    return results
+
+def _timings(durations):
+    durations = sorted(durations)
+    return {
+        'min': durations[0],
+        'median': statistics.median(durations),
+        'p95': durations[min(int(len(durations) * 0.95), len(durations) - 1)],
+        'max': durations[-1]
+    }
+
+def bench_end_to_end(repeat=5, latency=0.05, jitter=0.02, error_rate=0.0):
+    """measures get_all_information in normal and precise mode against a local fake api
+    with latency +- jitter seconds per request"""
+    import co2_ampel
+    import util
+    from fake_openweather import FakeOpenWeather
+
+    results = {'latency': latency, 'jitter': jitter, 'error_rate': error_rate}
+    old = util.API_URL, util.KEY, util.CACHE
+    with FakeOpenWeather(latency, jitter, error_rate, seed=0) as server:
+        util.API_URL, util.KEY, util.CACHE = server.url, 'benchmark', None
+        util.close_session()
+        try:
+            for mode, use_precise in (('normal', False), ('precise', True)):
+                durations = []
+                failures = 0
+                requests_before = server.request_count
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    try:
+                        co2_ampel.get_all_information(use_precise=use_precise)
+                    except Exception:
+                        failures += 1
+                        continue
+                    durations.append(time.perf_counter() - start)
+                results[mode] = {
+                    'seconds': _timings(durations) if durations else None,
+                    'requests_per_run': (server.request_count - requests_before) / repeat,
+                    'failures': failures
+                }
+        finally:
+            util.close_session()
+            util.API_URL, util.KEY, util.CACHE = old
+    return results
+
+def bench_estimator(samples=100000):
+    """measures how many samples per second the scalar estimator functions and estimate_batch estimate"""
+    import numpy as np
+    import estimator
+
+    start_time = datetime.datetime(2022, 1, 1)
+    times = [start_time + datetime.timedelta(minutes=i) for i in range(samples)]
+    onshore_wind = np.linspace(0, 15, samples)
+    offshore_wind = np.linspace(15, 0, samples)
+    cloudiness = np.arange(samples) % 101
+
+    start = time.perf_counter()
+    for time_, h_wind, b_wind, clouds in zip(times, onshore_wind.tolist(), offshore_wind.tolist(), cloudiness.tolist()):
+        needed_power = estimator.estimate_needed_power(time_)
+        onshore = estimator.estimate_onshore_wind_power(h_wind)
+        offshore = estimator.estimate_offshore_wind_power(b_wind)
+        solar = estimator.estimate_solar_power(time_, clouds)
+        conv = max(needed_power - onshore - offshore - solar, 0)
+        estimator.Sample(time_, onshore, offshore, solar, conv, needed_power)
+    scalar = time.perf_counter() - start
+
+    times = np.array(times, dtype='datetime64[m]')
+    start = time.perf_counter()
+    estimator.estimate_batch(times, onshore_wind, offshore_wind, cloudiness)
+    batch = time.perf_counter() - start
+
+    return {
+        'samples': samples,
+        'scalar_samples_per_second': samples / scalar,
+        'batch_samples_per_second': samples / batch
+    }
+
+def write_history(path, rows, interval=60, end=None):
+    """writes rows synthetic samples every interval seconds up to end into the data file at path
+    and its daily partitions"""
+    import data_reader
+
+    end = datetime.datetime.now() if end is None else end
+    timestamp = end - datetime.timedelta(seconds=interval * (rows - 1))
+    step = datetime.timedelta(seconds=interval)
+    day = None
+    f = None
+    for i in range(rows):
+        if timestamp.date() != day:
+            if f is not None:
+                f.close()
+            day = timestamp.date()
+            f = open(path if day == end.date() else data_reader.partition_path(day, path), 'w')
+        power = 20 + i % 40
+        f.write(f"{timestamp.strftime(data_reader.TIME_FORMAT)},{power / 4},{power / 8},{power / 8},{power / 2},{power},{400.0}\n")
+        timestamp += step
+    if f is not None:
+        f.close()
+
+def bench_data_reader(rows=2000000, repeat=5):
+    """measures reading the csv and the binary log with a synthetic history of rows samples, one per minute"""
+    import binary_log
+    import data_reader
+
+    results = {'rows': rows}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "data.csv")
+        start = time.perf_counter()
+        write_history(path, rows)
+        results['write_seconds'] = time.perf_counter() - start
+        end = time.time()
+
+        def measure(function, *args):
+            durations = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                data = function(*args)
+                durations.append(time.perf_counter() - start)
+            return {'seconds': _timings(durations), 'points': len(data['time'])}
+
+        results['csv_latest_50'] = measure(data_reader.read_latest_n_points, 50, path)
+        results['csv_range_day'] = measure(data_reader.read_range, end - 86400, end, path)
+        results['csv_range_week'] = measure(data_reader.read_range, end - 7 * 86400, end, path)
+
+        with open(data_reader.list_partitions(path)[0]) as f:
+            lines = [line.rstrip('\n') for line in f]
+        start = time.perf_counter()
+        data_reader._parse_lines(lines)
+        results['csv_parse_rows_per_second'] = len(lines) / (time.perf_counter() - start)
+
+        binary_path = os.path.join(directory, "data.bin")
+        start = time.perf_counter()
+        for partition in data_reader.list_partitions(path):
+            binary_log.convert_csv_to_binary(partition, binary_path)
+        results['binary_convert_seconds'] = time.perf_counter() - start
+        results['binary_latest_50'] = measure(binary_log.read_latest_n_points, 50, binary_path)
+        results['binary_range_week'] = measure(binary_log.read_range, end - 7 * 86400, end, binary_path)
+    return results
+
+def bench_plot(points=(50, 1000, 10000), repeat=5):
+    """measures a full plot of PowerPlot and appending a single sample with and without blitting.
+    The figure is rendered offscreen with the agg backend"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from plot_view import PowerPlot
+
+    def synthetic_data(n, start):
+        data = {'time': [start + 60 * i for i in range(n)]}
+        for field, value in (('onshore', 10), ('offshore', 5), ('solar', 5), ('conv', 30), ('total', 50), ('gpkwh', 480)):
+            data[field] = [value + i % 7 for i in range(n)]
+        return data
+
+    results = {}
+    for n in points:
+        data = synthetic_data(n, time.time() - 60 * n)
+        for incremental in (True, False):
+            figure = Figure(figsize=(8, 4), dpi=100)
+            plot = PowerPlot(figure, FigureCanvasAgg(figure), incremental=incremental)
+
+            plot_durations = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                plot.plot(data, max_points=n)
+                plot_durations.append(time.perf_counter() - start)
+
+            append_durations = []
+            for i in range(repeat):
+                sample = synthetic_data(1, data['time'][-1] + 60 * (i + 1))
+                start = time.perf_counter()
+                plot.append(sample)
+                append_durations.append(time.perf_counter() - start)
+
+            results[f"{n}_{'blit' if incremental else 'redraw'}"] = {
+                'plot_seconds': _timings(plot_durations),
+                'append_seconds': _timings(append_durations)
+            }
+    return results
+
+def bench_grid(configs=((0.1, None), (0.25, None), (0.5, None), (0.1, 30), (0.1, 15))):
+    """compares precise sweeps over the weather grid with (resolution, max_calls) of configs to the full sweep.
+    The wind speeds come from fake_openweather, so the errors only show how the interpolation behaves"""
+    import precise_wind
+    from fake_openweather import weather_at
+
+    def fetch(lat, lon):
+        return weather_at(lat, lon, 0)
+
+    return {f"{resolution}_{max_calls}": precise_wind.grid_error(resolution, max_calls, fetch=fetch)
+            for resolution, max_calls in configs}
+
+def bench_regions(repeat=5):
+    """compares the example regions in one RegionEngine with one engine per region.
+    Returns the requests of both and the durations of their estimation in seconds"""
+    import region
+    from adaptive_scheduler import AdaptiveScheduler
+    from fake_openweather import weather_at
+
+    regions = region.load_regions(os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.example.json"))
+    now = datetime.datetime.now()
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append((lat, lon))
+        return weather_at(lat, lon, int(now.timestamp()))
+
+    shared = region.RegionEngine(regions, scheduler=AdaptiveScheduler(fetch, max_workers=1))
+    shared.refresh()
+    shared_calls = len(calls)
+    separate = [region.RegionEngine([r], scheduler=AdaptiveScheduler(fetch, max_workers=1)) for r in regions]
+    for engine in separate:
+        engine.refresh()
+
+    # the first estimation imports numpy
+    shared.estimate(now)
+    shared_durations, separate_durations = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        shared.estimate(now)
+        shared_durations.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for engine in separate:
+            engine.estimate(now)
+        separate_durations.append(time.perf_counter() - start)
+
+    return {
+        'regions': len(regions),
+        'shared_calls': shared_calls,
+        'separate_calls': len(calls) - shared_calls,
+        'shared_estimate': _timings(shared_durations),
+        'separate_estimate': _timings(separate_durations)
+    }
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'end_to_end': bench_end_to_end,
+    'estimator': bench_estimator,
+    'data_reader': bench_data_reader,
+    'plot': bench_plot,
+    'grid': bench_grid,
+    'regions': bench_regions,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help="file the json results are written to")
+    parser.add_argument('--rows', type=int, default=2000000, help="samples in the synthetic history of data_reader")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds the fake api waits per request")
+    parser.add_argument('--jitter', type=float, default=0.02, help="seconds the latency varies by")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="part of the fake api requests that fail")
+    parser.add_argument('--repeat', type=int, default=5, help="repetitions of every measurement")
+    parser.add_argument('benchmarks', nargs='*', help=f"benchmarks to run, default all of {', '.join(BENCHMARKS)}")
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    options = {
+        'startup': {'repeat': args.repeat},
+        'end_to_end': {'repeat': args.repeat, 'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate},
+        'estimator': {},
+        'data_reader': {'rows': args.rows, 'repeat': args.repeat},
+        'plot': {'repeat': args.repeat},
+        'regions': {'repeat': args.repeat},
+    }
+
+    results = {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'results': {name: BENCHMARKS[name](**options.get(name, {})) for name in (args.benchmarks or BENCHMARKS)}
+    }
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Binary storage backend for the sample log.
+
+Every sample is stored as a fixed-width record of float64 values
+(time as unix timestamp, onshore, offshore, solar, conv, total, gpkwh).
+The file is read through numpy.memmap, so slicing arbitrary ranges does not parse or copy anything.
+
+It is the storage of co2_ampel --storage binary, but no replacement of data_reader: read_latest_n_points
+and read_range take the same arguments and return arrays instead of lists, the other functions of data_reader
+are missing. The gui, the server and aggregation only read the csv log, export_to_csv writes one for them."""
+import datetime
+import os
+import sys
+from itertools import islice
+
+import numpy as np
+
+import data_reader
+from estimator import Sample
+
+DATA_FILE = "data/data.bin"
+
+FIELDS = ('time', 'onshore', 'offshore', 'solar', 'conv', 'total', 'gpkwh')
+RECORD_DTYPE = np.dtype([(field, '<f8') for field in FIELDS])
+
+def append(time: float, power, gpkwh: float, path=DATA_FILE) -> None:
+    """appends one record. power is a dict with the keys 'onshore', 'offshore', 'solar', 'conv', 'total'"""
+    record = np.array([(time, power['onshore'], power['offshore'], power['solar'], power['conv'], power['total'], gpkwh)], dtype=RECORD_DTYPE)
+    with open(path, 'ab') as f:
+        f.write(record.tobytes())
+
+def write_to_file(power, path=DATA_FILE) -> None:
+    """appends a Sample or power data with the current time, like co2_ampel.write_to_file"""
+    sample = power if isinstance(power, Sample) else Sample.from_power(datetime.datetime.now(), power)
+    append(sample.time.timestamp(), sample.power, sample.gpkwh, path)
+
+def open_log(path=DATA_FILE) -> np.ndarray:
+    """returns all records as read only structured array that is mapped into memory"""
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    # an incompletely written record at the end is ignored
+    count = size // RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+
+def to_data_dict(records: np.ndarray):
+    """converts records to the dict format of data_reader, holding arrays instead of lists"""
+    return {field: records[field] for field in FIELDS}
+
+def read_latest_n_points(n, path=DATA_FILE):
+    """returns the latest n data points in the format of data_reader.read_latest_n_points"""
+    records = open_log(path)
+    return to_data_dict(records[max(len(records) - n, 0):] if n > 0 else records[:0])
+
+def read_range(start, end, path=DATA_FILE):
+    """returns all data points from start to end (both inclusive) in the format of data_reader.read_range.
+    start and end are datetimes or timestamps. The range is found by binary search over the times"""
+    start = start.timestamp() if isinstance(start, datetime.datetime) else start
+    end = end.timestamp() if isinstance(end, datetime.datetime) else end
+    records = open_log(path)
+    times = records['time']
+    return to_data_dict(records[np.searchsorted(times, start, 'left'):np.searchsorted(times, end, 'right')])
+
+convert_to_plot_data = data_reader.convert_to_plot_data
+
+def convert_csv_to_binary(csv_path=data_reader.DATA_FILE, binary_path=DATA_FILE, chunk_size=10000) -> int:
+    """appends all samples of a csv log to a binary log. Returns the number of converted samples"""
+    count = 0
+    with open(csv_path) as csv_file, open(binary_path, 'ab') as binary_file:
+        while True:
+            chunk = list(islice(csv_file, chunk_size))
+            if not chunk:
+                break
+            lines = [line.rstrip('\n') for line in chunk if line.strip()]
+            data = data_reader._parse_lines(lines)
+            records = np.empty(len(lines), dtype=RECORD_DTYPE)
+            for field in FIELDS:
+                records[field] = data[field]
+            binary_file.write(records.tobytes())
+            count += len(lines)
+    return count
+
+def export_to_csv(binary_path=DATA_FILE, csv_path=data_reader.DATA_FILE) -> int:
+    """writes all samples of a binary log to a csv log. Returns the number of exported samples"""
+    records = open_log(binary_path)
+    with open(csv_path, 'w') as f:
+        for record in records.tolist():
+            time = datetime.datetime.fromtimestamp(record[0]).strftime("%Y-%m-%d %H:%M:%S.%f")
+            f.write(','.join((time, *[str(value) for value in record[1:]])) + '\n')
+    return len(records)
+
+
+if __name__ == "__main__":
+    # python binary_log.py [csv_path] [binary_path] converts a csv log to a binary log
+    count = convert_csv_to_binary(*sys.argv[1:3])
+    print(f"[INFO] converted {count} samples")
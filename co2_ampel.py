@@ -1,13 +1,22 @@
+import argparse
 import datetime
-from math import e, pi, sin
-from time import sleep
+import logging
+import signal
+import threading
+import time
 from typing import Dict
 
-import requests as req
+import data_reader
+import metrics
+from estimator import (CONV_EMISSION, SOLAR_CONSTANT, SOLAR_FACTOR, Sample, estimate_batch, estimate_current_solar_power, estimate_currently_needed_power,
+                       estimate_needed_power, estimate_offshore_wind_power, estimate_onshore_wind_power, estimate_solar_power)
+from util import (BOR_WIN_LAT, BOR_WIN_LON, HOLTRIEM_LAT, HOLTRIEM_LON, OLDENBURG_LAT, OLDENBURG_LON, enable_cache, enable_rate_limit, force_non_negative,
+                  map_value, map_value_clamp, remaining_budget, request_park_weather_data, request_weather_data)
 
-import rgb_controller
-from precise_wind import estimate_offshore_wind_power_precise, estimate_onshore_wind_power_precise
-from util import *
+# precise_wind (numpy), aggregation (numpy) and rgb_controller (pigpio) are imported when they are needed,
+# so importing this module for the estimation stays fast
+
+logger = logging.getLogger("co2_ampel")
 
 
 def get_wind_speed(weather_data=None, lat=None, lon=None):
@@ -22,68 +31,11 @@ def get_cloudiness(weather_data=None, lat=None, lon=None):
     weather_data = request_weather_data(lat, lon) if weather_data == None else weather_data
     return weather_data['clouds']['all']
 
-def estimate_needed_power(time: datetime.time, average: float = 60, deviation: float = 20):
-    """Estimates the needed power at a given time
-    
-    args:
-        time: datetime.time     time
-        average: float          average power needed
-        deviation: float        difference between highest and lowest power consumption
-
-    returns: float              estimated power consumption in GW
-    """
-    return deviation / 2 * sin(2 * pi / 24 * ((time.hour + time.minute / 60) - 6)) + average
-
-def estimate_currently_needed_power():
-    return estimate_needed_power(datetime.datetime.now())
-
-def estimate_onshore_wind_power(wind_speed: float) -> float:
-    """Uses wind_speed to estimate the onshore wind power production.
-    See https://docs.google.com/spreadsheets/d/1a9QbTW_9zzluov_hqcWPwHgRYNH03s1lz4pOXHQ5cew/edit?usp=sharing
-    and https://www.desmos.com/calculator/9z13kqfsx0"""
-    return force_non_negative(-e**(-0.53*(wind_speed-10))+32)
-
-def estimate_offshore_wind_power(wind_speed):
-    """Uses wind_speed to estimate the offshore wind power production.
-    See https://docs.google.com/spreadsheets/d/1a9QbTW_9zzluov_hqcWPwHgRYNH03s1lz4pOXHQ5cew/edit?usp=sharing"""
-    if wind_speed < 10:
-        return force_non_negative(map_value(wind_speed, 4.65, 9.5, 0.732, 5.465))
-    else:
-        return force_non_negative(map_value(wind_speed, 9.89, 15.16, 5.465, 4.8))
-
-SOLAR_FACTOR = {
-    "jan": 1.086,
-    "feb": 1.459,
-    "mar": 2.032,
-    "apr": 2.582,
-    "may": 2.677,
-    "jun": 2.818,
-    "jul": 3.532,
-    "aug": 3.145,
-    "sep": 2.463,
-    "oct": 2.463,
-    "nov": 2.463,
-    "dec": 1.0
-}
-
-SOLAR_CONSTANT = 7
-
-def estimate_solar_power(date: datetime.datetime, cloudiness):
-    """estimates the solar power using the daytime and the date"""
-    factor = list(SOLAR_FACTOR.values())[date.month - 1]
-    cloud_factor = 1 - cloudiness / 100 + 0.6
-    cloud_factor = map_value_clamp(cloud_factor, 0, 1, 0, 1)
-    return factor * cloud_factor * SOLAR_CONSTANT * force_non_negative(sin(2 * pi / 24 * ((date.hour + date.minute / 60) - 6)))
-
-def estimate_current_solar_power(cloudiness):
-    return estimate_solar_power(datetime.datetime.now(), cloudiness)
-
-def estimate_power(holtriem_wind=None, bor_win_wind=None, cloudiness=None, use_precise=False, log=True):
-    """estimates the current power. if no parameters are provided, it will request 
-    everything it needs automatically. However, you can specify the wind speeds and the cloundiness.
-    If the parameter log is set to False, it will not print information to stdout. \n
-    Be carefull with the 'use_precise' parameter. Calling this function with use_precise=True will result in more than 100 API calls."""
-    needed_power = estimate_currently_needed_power()
+def estimate_sample(holtriem_wind=None, bor_win_wind=None, cloudiness=None, use_precise=False, log=True, fetch=None, wind_speeds=None) -> Sample:
+    """estimates the current power and returns it as Sample. See estimate_power for the parameters.
+    wind_speeds is the precise_wind.SweepResult of sweep_all_wind_speeds, it is requested if it is None"""
+    now = datetime.datetime.now()
+    needed_power = estimate_needed_power(now)
 
     if not use_precise:
         h_wind = get_wind_speed(lat=HOLTRIEM_LAT, lon=HOLTRIEM_LON) if holtriem_wind == None else holtriem_wind
@@ -93,31 +45,48 @@ def estimate_power(holtriem_wind=None, bor_win_wind=None, cloudiness=None, use_p
         offshore = estimate_offshore_wind_power(b_wind)
     else:
         h_wind = None
-        onshore = estimate_onshore_wind_power_precise()
         b_wind = None
-        offshore = estimate_offshore_wind_power_precise()
+        from precise_wind import (ONSHORE_PARKS, average_solar_cloudiness, estimate_offshore_wind_power_precise,
+                                  estimate_onshore_wind_power_precise, estimate_solar_power_precise, sweep_all_wind_speeds)
+        wind_speeds = sweep_all_wind_speeds(fetch=fetch) if wind_speeds is None else wind_speeds
+        onshore_wind_speeds, offshore_wind_speeds = wind_speeds.split(len(ONSHORE_PARKS))
+        onshore = estimate_onshore_wind_power_precise(onshore_wind_speeds)
+        offshore = estimate_offshore_wind_power_precise(offshore_wind_speeds)
 
     cloudiness = get_cloudiness(lat=OLDENBURG_LAT, lon=OLDENBURG_LON) if cloudiness == None else cloudiness
-    solar = estimate_current_solar_power(cloudiness)
+    # the precise mode uses the cloudiness of the windpark responses, Oldenburg only if they have none
+    solar = estimate_solar_power_precise(now, wind_speeds) if use_precise else None
+    if solar is None:
+        solar = estimate_solar_power(now, cloudiness)
+        cloudiness_source = "Oldenburg"
+    else:
+        cloudiness = average_solar_cloudiness(wind_speeds.cloudiness[:len(ONSHORE_PARKS)])
+        cloudiness_source = "pv sites"
 
     renewable_power_supply = onshore + offshore + solar
 
     conv_power = force_non_negative(needed_power - renewable_power_supply)
 
-    if log:
-        print(f"[INFO] estimated power consumption: {needed_power} GW")
-        print(f"[INFO] wind speed Holtriem: {h_wind} m/s.\tEstimated onshore wind power: {onshore} GW")
-        print(f"[INFO] wind speed BorWinAlpha: {b_wind} m/s.\tEstimated offshore wind power: {offshore} GW")
-        print(f"[INFO] cloudiness Oldenburg: {cloudiness}%.\tEstimated solar power: {solar} GW")
-        print(f"[INFO] estimated conv power: {conv_power} GW")
+    sample = Sample(now, onshore, offshore, solar, conv_power, needed_power, holtriem_wind=h_wind, bor_win_wind=b_wind,
+                    cloudiness=cloudiness, use_precise=use_precise, coverage=wind_speeds.coverage if use_precise else 1.0)
 
-    return {
-        "onshore": onshore,
-        "offshore": offshore,
-        "solar": solar,
-        "conv": conv_power,
-        "total": needed_power
-    }
+    if log and logger.isEnabledFor(logging.INFO):
+        logger.info("estimated power consumption: %s GW", needed_power)
+        logger.info("wind speed Holtriem: %s m/s.\tEstimated onshore wind power: %s GW", h_wind, onshore)
+        logger.info("wind speed BorWinAlpha: %s m/s.\tEstimated offshore wind power: %s GW", b_wind, offshore)
+        logger.info("cloudiness %s: %s%%.\tEstimated solar power: %s GW", cloudiness_source, cloudiness, solar)
+        logger.info("estimated conv power: %s GW", conv_power)
+
+    return sample
+
+def estimate_power(holtriem_wind=None, bor_win_wind=None, cloudiness=None, use_precise=False, log=True, fetch=None):
+    """estimates the current power. if no parameters are provided, it will request 
+    everything it needs automatically. However, you can specify the wind speeds and the cloundiness.
+    If the parameter log is set to False, it will not log the estimated values.
+    fetch(lat, lon) is used to get weather data in precise mode, it defaults to request_weather_data.
+    In precise mode the solar power is estimated from the cloudiness in the windpark responses, see precise_wind.use_solar_sites. \n
+    Be carefull with the 'use_precise' parameter. Calling this function with use_precise=True will result in more than 100 API calls."""
+    return estimate_sample(holtriem_wind, bor_win_wind, cloudiness, use_precise, log, fetch).power
 
 def estimate_power_distribution(power=None, use_precise=False) -> Dict[str, float]:
     """estimates the current percentage of the onshore, offshore, solar and conventional power in the local grid.
@@ -139,12 +108,27 @@ def calculate_gCO2_per_kWh(power_distribution = None, use_precise=False, log=Tru
     Be carefull with the 'use_precise' parameter. Calling this function with use_precise=True will result in more than 100 API calls."""
     if power_distribution == None:
         power_distribution = estimate_power_distribution(use_precise=use_precise)
-    gCO2_per_kWh = power_distribution['conv'] * 800
+    gCO2_per_kWh = power_distribution['conv'] * CONV_EMISSION
     if log:
-        print(f"[INFO] estimated emission: {gCO2_per_kWh} g CO2 / kWh")
+        logger.info("estimated emission: %s g CO2 / kWh", gCO2_per_kWh)
     return gCO2_per_kWh
 
-def get_all_information(use_precise=False):
+def sweep_locations(use_precise=False):
+    """returns the (lat, lon) of the windparks of the precise mode. They are requested with low priority,
+    so they can be spread over several cycles if the request budget is tight"""
+    if not use_precise:
+        return []
+    import precise_wind
+    return precise_wind.sweep_locations()
+
+def required_locations(use_precise=False):
+    """returns the (lat, lon) of all locations get_all_information requests weather data for"""
+    locations = [(OLDENBURG_LAT, OLDENBURG_LON)]
+    if not use_precise:
+        locations += [(HOLTRIEM_LAT, HOLTRIEM_LON), (BOR_WIN_LAT, BOR_WIN_LON)]
+    return locations + sweep_locations(use_precise)
+
+def get_all_information(use_precise=False, fetch=None, cached=False):
     """performs all calculations and returns all information in a dict. Returns: \n
     {
         'holtriem_weather': full weather_data dict in Holtriem, DE. None if use_precise is True
@@ -152,27 +136,44 @@ def get_all_information(use_precise=False):
         'oldenburg_weather': full weather_data dict in Oldenburg, DE
         'holtriem_wind': wind speed in Holtriem, DE. None if use_precise is True
         'bor_win_wind': wind speed at the BorWinAlpha offshore windpark. None if use_precise is True
-        'cloudiness': cloudiness in percent in Oldenburg, DE
+        'cloudiness': cloudiness in percent the solar power is estimated from. In Oldenburg, DE or, if use_precise
+                      is True, the average of the pv sites from the windpark responses (see precise_wind.average_solar_cloudiness)
         'power': dict of the absolut current power. Devided into 'onshore', 'offshore', 'solar', 'conv', 'total'
         'power_dist': percentage of the total power. Devided into 'onshore', 'offshore', 'solar', 'conv'
         'gpkwh': gramm CO2 emission per kWh energy
+        'coverage': capacity share of the windparks that answered in precise mode, 1 otherwise
+        'sample': Sample holding all estimated values
     }\n
+    fetch(lat, lon) is used to get the weather data, it defaults to request_weather_data and to
+    request_park_weather_data for the windparks. cached=True tells that fetch reads weather data that was
+    requested before, like AdaptiveScheduler.get, so the reads are timed as 'read' instead of 'fetch' and
+    windparks that are missing are not retried.
     Be carefull with the 'use_precise' parameter. Calling this function with use_precise=True will result in more than 100 API calls."""
-    if not use_precise:
-        h_weather = request_weather_data(HOLTRIEM_LAT, HOLTRIEM_LON)
-        h_wind = get_wind_speed(h_weather)
-        b_weather = request_weather_data(BOR_WIN_LAT, BOR_WIN_LON)
-        b_wind = get_wind_speed(b_weather)
-    else:
-        h_weather = None
-        h_wind = None
-        b_weather = None
-        b_wind = None
-    o_weather = request_weather_data(OLDENBURG_LAT, OLDENBURG_LON)
-    cloudiness = get_cloudiness(o_weather)
-    power = estimate_power(holtriem_wind=h_wind, bor_win_wind= b_wind, cloudiness=cloudiness, use_precise=use_precise)
-    power_dist = estimate_power_distribution(power)
-    gpkwh = calculate_gCO2_per_kWh(power_distribution=power_dist)
+    park_fetch = request_park_weather_data if fetch is None else fetch
+    fetch = request_weather_data if fetch is None else fetch
+
+    with metrics.timed('read' if cached else 'fetch'):
+        if not use_precise:
+            h_weather = fetch(HOLTRIEM_LAT, HOLTRIEM_LON)
+            h_wind = get_wind_speed(h_weather)
+            b_weather = fetch(BOR_WIN_LAT, BOR_WIN_LON)
+            b_wind = get_wind_speed(b_weather)
+            wind_speeds = None
+        else:
+            from precise_wind import sweep_all_wind_speeds
+            h_weather = None
+            h_wind = None
+            b_weather = None
+            b_wind = None
+            wind_speeds = sweep_all_wind_speeds(fetch=park_fetch, retries=0 if cached else None)
+        o_weather = fetch(OLDENBURG_LAT, OLDENBURG_LON)
+        cloudiness = get_cloudiness(o_weather)
+    with metrics.timed('estimate'):
+        sample = estimate_sample(holtriem_wind=h_wind, bor_win_wind= b_wind, cloudiness=cloudiness, use_precise=use_precise,
+                                 fetch=fetch, wind_speeds=wind_speeds)
+    logger.info("estimated emission: %s g CO2 / kWh", sample.gpkwh)
+    if sample.coverage < 1:
+        logger.warning("only %.0f%% of the windpark capacity answered, using the last known wind speeds for the rest", 100 * sample.coverage)
 
     return {
         'holtriem_weather': h_weather,
@@ -180,36 +181,208 @@ def get_all_information(use_precise=False):
         'oldenburg_weather': o_weather,
         'holtriem_wind': h_wind,
         'bor_win_wind': b_wind,
-        'cloudiness': cloudiness,
-        'power': power,
-        'power_dist': power_dist,
-        'gpkwh': gpkwh
+        'cloudiness': sample.cloudiness,
+        'power': sample.power,
+        'power_dist': sample.power_distribution,
+        'gpkwh': sample.gpkwh,
+        'coverage': sample.coverage,
+        'sample': sample
     }
 
 
 def write_to_file(power):
-    """appends power data to /data/data.csv.
+    """appends a Sample or power data with the current time to /data/data.csv, see data_reader.append_sample.
     data is stored in the following format time,onshore,offshore,solar,conv,total,gpkwh"""
-    gCO2_per_kWh = calculate_gCO2_per_kWh(estimate_power_distribution(power), log=False)
-
-    with open("data/data.csv", "a") as f:
-                f.write(','.join((str(datetime.datetime.now()), *[str(a) for a in power.values()], str(gCO2_per_kWh))) + '\n')
-
-
-if __name__ == "__main__":
-    while True:
+    import aggregation
+
+    sample = power if isinstance(power, Sample) else Sample.from_power(datetime.datetime.now(), power)
+    values = sample.values()
+    data_reader.append_sample(sample.time, values)
+    aggregation.add_sample(sample.time, values)
+
+def record_sample_lag(all_info) -> None:
+    """records the time between the observation in Oldenburg and the sample in the metrics"""
+    observation_time = (all_info['oldenburg_weather'] or {}).get('dt')
+    if observation_time is not None:
+        metrics.observe('sample_lag_seconds', all_info['sample'].time.timestamp() - observation_time)
+
+
+def update_forecast(sample, use_precise=False, hours=None, fetch=None):
+    """estimates the forecast curve for the next hours (see forecast.estimate_forecast), stores it in
+    data_reader.FORECAST_FILE and returns (curve, clean_window_ahead) compared to sample.
+    A failed forecast is logged and (None, False) is returned, so it never stops the sample"""
+    import forecast
+
+    try:
+        with metrics.timed('forecast'):
+            curve = forecast.estimate_forecast(forecast.FORECAST_HOURS if hours is None else hours, use_precise, fetch)
+    except Exception as error:
+        logger.warning("forecast failed: %r", error)
+        return None, False
+    data_reader.write_forecast(curve)
+    return curve, forecast.clean_window_ahead(curve, sample.gpkwh)
+
+def run_cycle(scheduler, use_precise=True, ampel_range=(200, 700), store=write_to_file, forecast_hours=None, forecast_fetch=None):
+    """requests the stale locations of the scheduler and, if any observation changed, estimates the
+    emission, stores the Sample with store(sample) and sets the leds.
+    With forecast_hours the forecast curve is updated too (see update_forecast), it is added as 'forecast'
+    and the leds show if a clean window is ahead ('clean_window_ahead'). forecast_fetch(lat, lon) requests a forecast.
+    Returns the dict of get_all_information or None if nothing changed"""
+    import rgb_controller
+
+    with metrics.timed('cycle'):
+        with metrics.timed('fetch'):
+            changed = scheduler.refresh(required_locations(use_precise), sweep=sweep_locations(use_precise))
+        if not changed:
+            logger.info("no new observations, skipping cycle")
+            return None
+
+        all = get_all_information(use_precise=use_precise, fetch=scheduler.get, cached=True)
+        sample = all['sample']
+        with metrics.timed('store'):
+            store(sample)
+        record_sample_lag(all)
+
+        all['clean_window_ahead'] = False
+        if forecast_hours:
+            all['forecast'], all['clean_window_ahead'] = update_forecast(sample, use_precise, forecast_hours, forecast_fetch)
+        clean_window_ahead = all['clean_window_ahead']
+
+        ampel_value = map_value_clamp(sample.gpkwh, *ampel_range, 0, 1)
+        logger.info("ampel value: %s, clean window ahead: %s", ampel_value, clean_window_ahead)
+        rgb_controller.set_ampel(ampel_value, clean_window_ahead)
+    return all
+
+def seconds_until_boundary(interval: float, now: float = None) -> float:
+    """returns the seconds until the next multiple of interval in wall-clock time, e.g. the next full 10 minutes"""
+    now = time.time() if now is None else now
+    return (now // interval + 1) * interval - now
+
+def run_daemon(interval=600, use_precise=True, ampel_range=(200, 700), adaptive=False, store=write_to_file, stop_event=None, forecast_hours=None,
+               on_sample=None, sweep_deadline=None, hedge_after=None):
+    """runs a cycle at every multiple of interval seconds in wall-clock time until stop_event is set.
+    forecast_hours is passed to run_cycle, on_sample(all_info) is called after every cycle with a new sample.
+    sweep_deadline and hedge_after are passed to the AdaptiveScheduler of the windpark requests.
+    The waiting time is measured with the monotonic clock, so slow cycles and clock changes don't shift the schedule.
+    With adaptive=True the next cycle runs when the scheduler expects new observations instead.
+    Exceptions of a cycle are logged and the next cycle runs as usual."""
+    from adaptive_scheduler import AdaptiveScheduler
+
+    stop_event = threading.Event() if stop_event is None else stop_event
+    scheduler = AdaptiveScheduler(sweep_deadline=sweep_deadline, hedge_after=hedge_after)
+
+    while not stop_event.is_set():
         try:
-            all = get_all_information(use_precise=True)
-            power = all['power']
-            gCO2_per_kWh = all['gpkwh']
-            write_to_file(power)
-
-            ampel_value = map_value_clamp(gCO2_per_kWh, 200, 700, 0, 1)
-            print(ampel_value)
+            all_info = run_cycle(scheduler, use_precise, ampel_range, store, forecast_hours)
+            if all_info is not None and on_sample is not None:
+                on_sample(all_info)
+        except Exception as error:
+            metrics.inc('cycle_errors_total')
+            logger.exception("cycle failed: %r", error)
+
+        budget = remaining_budget()
+        if budget is not None:
+            logger.info("remaining request budget: %s this minute, %s today", budget['minute'], budget['day'])
+
+        if adaptive:
+            delay = scheduler.next_delay(required_locations(use_precise))
+        else:
+            delay = seconds_until_boundary(interval)
+        deadline = time.monotonic() + delay
+        while not stop_event.is_set() and time.monotonic() < deadline:
+            stop_event.wait(deadline - time.monotonic())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estimates the CO2 emission per kWh periodically and shows it on the leds.")
+    parser.add_argument('--interval', type=float, default=600, help="seconds between two cycles, aligned to the wall-clock")
+    parser.add_argument('--mode', choices=('normal', 'precise'), default='precise', help="precise mode results in more than 100 API calls per cycle")
+    parser.add_argument('--adaptive', action='store_true', help="run cycles when new observations are expected instead of every interval")
+    parser.add_argument('--low', type=float, default=200, help="emission in g CO2 / kWh that is shown green")
+    parser.add_argument('--high', type=float, default=700, help="emission in g CO2 / kWh that is shown red")
+    parser.add_argument('--storage', choices=('csv', 'binary'), default='csv', help="storage backend of the sample log, the gui and --serve-port only read csv")
+    parser.add_argument('--no-cache', action='store_true', help="don't use the persistent weather cache")
+    parser.add_argument('--metrics-port', type=int, help="serve the metrics in the prometheus text format on this port")
+    parser.add_argument('--per-minute', type=float, default=60, help="api requests allowed per minute")
+    parser.add_argument('--per-day', type=float, default=30000, help="api requests allowed per day")
+    parser.add_argument('--no-rate-limit', action='store_true', help="don't limit the api requests")
+    parser.add_argument('--sweep-deadline', type=float, default=20, help="seconds the windpark requests of the precise mode may take")
+    parser.add_argument('--hedge-after', type=float, help="send windpark requests that take longer than this many seconds a second time")
+    parser.add_argument('--grid-resolution', type=float, help="request each cell of this size in degrees once instead of every windpark")
+    parser.add_argument('--max-calls', type=int, help="request at most this many grid cells per sweep and interpolate the other windparks")
+    parser.add_argument('--forecast-hours', type=float, default=0,
+                        help="also estimate the emission for this many hours ahead and show a clean window ahead on the leds")
+    parser.add_argument('--serve-port', type=int, help="serve the samples as json on this port, see server.py. With --regions the region on the leds is served")
+    parser.add_argument('--serve-host', default="127.0.0.1", help="address the samples are served on, 0.0.0.0 for all interfaces")
+    parser.add_argument('--source', help="url of another Ampel started with --serve-port. Its samples are shown instead of fetching any")
+    parser.add_argument('--regions', help="json file of regions that are estimated together, see region.py and regions.example.json")
+    parser.add_argument('--led-region', help="name of the region shown on the leds, the first region by default")
+    args = parser.parse_args(argv)
+    if args.storage == 'binary' and args.serve_port is not None:
+        parser.error("--serve-port serves the csv log, it can't be used with --storage binary")
+    if args.regions is not None:
+        # the regions are estimated every interval into their csv logs, without a forecast
+        for option, given in (('--storage binary', args.storage == 'binary'), ('--forecast-hours', args.forecast_hours),
+                              ('--adaptive', args.adaptive)):
+            if given:
+                parser.error(f"{option} can't be used with --regions")
+
+    import rgb_controller
+
+    if args.grid_resolution is not None or args.max_calls is not None:
+        import grid_index
+        import precise_wind
+        precise_wind.enable_grid(grid_index.RESOLUTION if args.grid_resolution is None else args.grid_resolution, args.max_calls)
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    if not args.no_cache:
+        enable_cache()
+    if not args.no_rate_limit:
+        enable_rate_limit(args.per_minute, args.per_day)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+
+    if args.storage == 'binary':
+        import binary_log
+        store = binary_log.write_to_file
+    else:
+        store = write_to_file
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    engine = None
+    if args.regions is not None and args.source is None:
+        import region
+        from adaptive_scheduler import AdaptiveScheduler
+        scheduler = AdaptiveScheduler(sweep_deadline=args.sweep_deadline, hedge_after=args.hedge_after)
+        engine = region.RegionEngine(region.load_regions(args.regions), args.mode == 'precise', scheduler)
+        led_region = engine.regions[0].name if args.led_region is None else args.led_region
+        if led_region not in [r.name for r in engine.regions]:
+            parser.error(f"--led-region {led_region} is not in {args.regions}")
+
+    on_sample = None
+    if args.serve_port is not None:
+        import server
+        if engine is None:
+            on_sample = server.serve(args.serve_port, args.serve_host).publish
+        else:
+            # the region on the leds is served, its log is written by the regions
+            on_sample = server.serve(args.serve_port, args.serve_host, engine.region(led_region).data_path, None).publish
+
+    try:
+        if args.source is not None:
+            import server
+            server.run_led_client(args.source, min(args.interval, 60), (args.low, args.high), stop_event)
+        elif engine is not None:
+            region.run_daemon(engine, args.interval, led_region, stop_event, on_sample)
+        else:
+            run_daemon(args.interval, args.mode == 'precise', (args.low, args.high), args.adaptive, store, stop_event,
+                       args.forecast_hours, on_sample, args.sweep_deadline, args.hedge_after)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rgb_controller.quit()
 
-            rgb_controller.set_ampel(ampel_value)
 
-            sleep(60*10)
-        except KeyboardInterrupt:
-            rgb_controller.quit()
-            break
+if __name__ == "__main__":
+    main()
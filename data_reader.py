@@ -1,13 +1,50 @@
 import datetime
-import matplotlib.pyplot as plt
+import glob
+import os
+import shutil
+import sys
 
-def read_latest_n_points(n):
-    with open("data/data.csv", 'r') as f:
-        file_content = f.read()
+# the data file holds the samples of the current day. Samples of past days are moved
+# to daily partitions next to it, e.g. data/data-2022-01-26.csv
+DATA_FILE = "data/data.csv"
+ARCHIVE_DIRECTORY = "data/archive"
+# the latest forecast curve in the format of the data file, replaced by every new curve
+FORECAST_FILE = "data/forecast.csv"
 
-    lines = file_content.split('\n')
-    relevant_lines = lines[-n::]
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+# fields after the time in every line
+FIELDS = ('onshore', 'offshore', 'solar', 'conv', 'total', 'gpkwh')
+
+# number of bytes read at once while seeking backwards through the data file
+BLOCK_SIZE = 4096
+
+def _read_last_lines(path, n):
+    """returns the last n non empty lines of the file at path as bytes.
+    The file is read backwards from its end in blocks, so only the end of the file is read."""
+    if n <= 0:
+        return []
+
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        blocks = []
+        newlines = 0
+        # n + 1 newlines guarantee n complete lines, even if the file ends with a newline
+        while position > 0 and newlines <= n:
+            read_size = min(BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size)
+            newlines += block.count(b'\n')
+            blocks.append(block)
+
+    lines = b''.join(reversed(blocks)).split(b'\n')
+    if position > 0:
+        # the first line is only partially read
+        lines = lines[1:]
+    return [line for line in lines if line][-n:]
+
+def _parse_lines(lines):
     # data is stored in the following format time,onshore,offshore,solar,conv,total,gpkwh
     data = {
         'time': [],
@@ -19,13 +56,10 @@ def read_latest_n_points(n):
         'gpkwh': []
     }
 
-    for line in relevant_lines:
-        if not line:
-            break
-
+    for line in lines:
         line_elements = line.split(',')
 
-        data['time'].append(datetime.datetime.strptime(line_elements[0], "%Y-%m-%d %H:%M:%S.%f").timestamp())
+        data['time'].append(datetime.datetime.strptime(line_elements[0], TIME_FORMAT).timestamp())
         data['onshore'].append(float(line_elements[1]))
         data['offshore'].append(float(line_elements[2]))
         data['solar'].append(float(line_elements[3]))
@@ -35,6 +69,144 @@ def read_latest_n_points(n):
 
     return data
 
+def partition_path(date: datetime.date, path=DATA_FILE):
+    """returns the path of the daily partition of the data file at path"""
+    root, extension = os.path.splitext(path)
+    return f"{root}-{date.isoformat()}{extension}"
+
+def list_partitions(path=DATA_FILE):
+    """returns the paths of all daily partitions and the data file, from old to new.
+    A partition holds no samples after its day, the data file holds the newest samples."""
+    root, extension = os.path.splitext(path)
+    partitions = sorted(glob.glob(f"{glob.escape(root)}-????-??-??{extension}"))
+    return partitions + ([path] if os.path.exists(path) else [])
+
+def _partition_date(partition, path=DATA_FILE):
+    """returns the date of a daily partition or None for the data file itself"""
+    if partition == path:
+        return None
+    root, extension = os.path.splitext(path)
+    return datetime.date.fromisoformat(partition[len(root) + 1:-len(extension) or None])
+
+def _line_time(line: bytes) -> float:
+    return datetime.datetime.strptime(line[:line.index(b',')].decode(), TIME_FORMAT).timestamp()
+
+# date of the latest sample in the data file, by path
+_latest_dates = {}
+
+def rotate_if_needed(now: datetime.datetime, path=DATA_FILE) -> None:
+    """moves the data file to the partition of its latest day if now is on a later day"""
+    if path not in _latest_dates:
+        lines = _read_last_lines(path, 1) if os.path.exists(path) else []
+        _latest_dates[path] = datetime.datetime.fromtimestamp(_line_time(lines[0])).date() if lines else None
+
+    latest_date = _latest_dates[path]
+    if latest_date is not None and latest_date < now.date():
+        target = partition_path(latest_date, path)
+        if os.path.exists(target):
+            with open(path, 'rb') as source, open(target, 'ab') as destination:
+                shutil.copyfileobj(source, destination)
+            os.remove(path)
+        else:
+            os.replace(path, target)
+    _latest_dates[path] = now.date()
+
+def append_sample(time: datetime.datetime, values, path=DATA_FILE) -> None:
+    """appends a sample to the data file, rotating it to a daily partition at the first sample of a new day.
+    values are onshore, offshore, solar, conv, total, gpkwh"""
+    rotate_if_needed(time, path)
+    with open(path, "a") as f:
+        f.write(','.join((time.strftime(TIME_FORMAT), *[str(a) for a in values])) + '\n')
+
+def read_latest_n_points(n, path=DATA_FILE):
+    """reads the latest n data points. Only the end of the newest partitions is read, so the time
+    does not depend on the length of the history"""
+    lines = []
+    for partition in reversed(list_partitions(path)):
+        if len(lines) >= n:
+            break
+        lines = _read_last_lines(partition, n - len(lines)) + lines
+    return _parse_lines([line.decode() for line in lines])
+
+def _find_offset(f, size: int, timestamp: float) -> int:
+    """returns the offset of the first line in the sorted file f with a time at or after timestamp
+    using binary search over the byte offsets"""
+    def line_start(offset):
+        # start of the first line beginning at or after offset
+        if offset == 0:
+            return 0
+        f.seek(offset - 1)
+        f.readline()
+        return f.tell()
+
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        f.seek(line_start(middle))
+        line = f.readline()
+        if not line.strip() or _line_time(line) >= timestamp:
+            high = middle
+        else:
+            low = middle + 1
+    return line_start(low)
+
+def read_range(start, end, path=DATA_FILE):
+    """reads all data points from start to end (both inclusive). start and end are datetimes or timestamps.
+    Only the partitions of the requested days are opened and the first sample is found by binary search,
+    so only the bytes of the requested range are parsed."""
+    start = datetime.datetime.fromtimestamp(start) if not isinstance(start, datetime.datetime) else start
+    end = datetime.datetime.fromtimestamp(end) if not isinstance(end, datetime.datetime) else end
+    start_timestamp, end_timestamp = start.timestamp(), end.timestamp()
+
+    lines = []
+    for partition in list_partitions(path):
+        date = _partition_date(partition, path)
+        if date is not None and date < start.date():
+            continue
+
+        with open(partition, 'rb') as f:
+            f.seek(_find_offset(f, os.path.getsize(partition), start_timestamp))
+            for line in f:
+                if not line.strip():
+                    continue
+                if _line_time(line) > end_timestamp:
+                    break
+                lines.append(line.decode().rstrip('\n'))
+
+        if date is not None and date >= end.date():
+            break
+
+    return _parse_lines(lines)
+
+def archive_data(path=DATA_FILE, archive_directory=ARCHIVE_DIRECTORY) -> str:
+    """moves the data file, its partitions and the files derived from it (e.g. data/data_agg_600.csv)
+    to a new directory in archive_directory. Only the files are renamed, nothing is copied. Returns the new directory"""
+    directory = os.path.join(archive_directory, datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+    os.makedirs(directory, exist_ok=True)
+    root, extension = os.path.splitext(path)
+    for partition in list_partitions(path) + glob.glob(f"{glob.escape(root)}_*{extension}"):
+        os.replace(partition, os.path.join(directory, os.path.basename(partition)))
+    _latest_dates.pop(path, None)
+    return directory
+
+def write_forecast(curve, path=FORECAST_FILE) -> None:
+    """replaces the forecast file with curve, a dict of forecast.estimate_forecast.
+    The file is written next to it first, so readers never see a partial curve"""
+    lines = []
+    for i, timestamp in enumerate(curve['time']):
+        time = datetime.datetime.fromtimestamp(timestamp)
+        lines.append(','.join((time.strftime(TIME_FORMAT), *[str(float(curve[field][i])) for field in FIELDS])) + '\n')
+    with open(path + ".tmp", "w") as f:
+        f.writelines(lines)
+    os.replace(path + ".tmp", path)
+
+def read_forecast(path=FORECAST_FILE):
+    """reads the latest forecast curve in the format of read_latest_n_points, empty if there is none"""
+    if not os.path.exists(path):
+        return _parse_lines([])
+    with open(path) as f:
+        return _parse_lines([line for line in f.read().split('\n') if line])
+
 def convert_to_plot_data(data):
     """use like this:
     time, distribution, total, gpkwh = convert_to_stackplot_data(data)
@@ -45,8 +217,17 @@ def convert_to_plot_data(data):
 
 
 if __name__ == "__main__":
+    # python data_reader.py [hours] plots the last hours in a resolution that fits the figure
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
-    time, distribution, total, gpkwh = convert_to_plot_data(read_latest_n_points(10))
+    if len(sys.argv) > 1:
+        import aggregation
+        width = int(fig.get_figwidth() * fig.dpi)
+        level, data = aggregation.read_latest_span(float(sys.argv[1]) * 3600, width)
+    else:
+        data = read_latest_n_points(10)
+    time, distribution, total, gpkwh = convert_to_plot_data(data)
     ax.stackplot(time, distribution, labels=["onshore", "offshore", "solar", "conv"])
     ax.plot(time, total, label='total')
     ax.set_xlabel('time')
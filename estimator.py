@@ -0,0 +1,210 @@
+"""Estimation of the power and the emission from weather values.
+Only depends on the standard library, numpy is imported when estimate_batch is used."""
+import datetime
+from math import e, pi, sin
+from typing import TYPE_CHECKING, Dict
+
+from util import force_non_negative, map_value, map_value_clamp
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# emission of the conventional power in g CO2 / kWh
+CONV_EMISSION = 800
+
+
+class Sample:
+    """All values of one estimation. The shares and the emission are computed once on creation,
+    so storage, leds, gui and logging can use the sample without computing anything again."""
+    __slots__ = ('time', 'onshore', 'offshore', 'solar', 'conv', 'total',
+                 'onshore_share', 'offshore_share', 'solar_share', 'conv_share', 'gpkwh',
+                 'holtriem_wind', 'bor_win_wind', 'cloudiness', 'use_precise', 'coverage')
+
+    # order of the values in the sample log
+    FIELDS = ('onshore', 'offshore', 'solar', 'conv', 'total', 'gpkwh')
+
+    def __init__(self, time: datetime.datetime, onshore: float, offshore: float, solar: float, conv: float, total: float,
+                 holtriem_wind=None, bor_win_wind=None, cloudiness=None, use_precise=False, coverage=1.0):
+        self.time = time
+        self.onshore = onshore
+        self.offshore = offshore
+        self.solar = solar
+        self.conv = conv
+        self.total = total
+
+        self.onshore_share = onshore / total
+        self.offshore_share = offshore / total
+        self.solar_share = solar / total
+        self.conv_share = conv / total
+        self.gpkwh = self.conv_share * CONV_EMISSION
+
+        self.holtriem_wind = holtriem_wind
+        self.bor_win_wind = bor_win_wind
+        self.cloudiness = cloudiness
+        self.use_precise = use_precise
+        # capacity share of the windparks that answered in the precise mode
+        self.coverage = coverage
+
+    @classmethod
+    def from_power(cls, time: datetime.datetime, power: Dict[str, float], **inputs) -> "Sample":
+        """creates a sample from a power dict with the keys 'onshore', 'offshore', 'solar', 'conv', 'total'"""
+        return cls(time, power['onshore'], power['offshore'], power['solar'], power['conv'], power['total'], **inputs)
+
+    @property
+    def power(self) -> Dict[str, float]:
+        return {"onshore": self.onshore, "offshore": self.offshore, "solar": self.solar, "conv": self.conv, "total": self.total}
+
+    @property
+    def power_distribution(self) -> Dict[str, float]:
+        return {"onshore": self.onshore_share, "offshore": self.offshore_share, "solar": self.solar_share, "conv": self.conv_share}
+
+    def values(self):
+        """returns onshore, offshore, solar, conv, total, gpkwh"""
+        return self.onshore, self.offshore, self.solar, self.conv, self.total, self.gpkwh
+
+    def to_data(self):
+        """returns the sample in the format of data_reader.read_latest_n_points"""
+        data = {'time': [self.time.timestamp()]}
+        for field, value in zip(self.FIELDS, self.values()):
+            data[field] = [value]
+        return data
+
+    def __repr__(self):
+        return f"Sample({self.time}, gpkwh={self.gpkwh})"
+
+
+def estimate_needed_power(time: datetime.time, average: float = 60, deviation: float = 20):
+    """Estimates the needed power at a given time
+    
+    args:
+        time: datetime.time     time
+        average: float          average power needed
+        deviation: float        difference between highest and lowest power consumption
+
+    returns: float              estimated power consumption in GW
+    """
+    return deviation / 2 * sin(2 * pi / 24 * ((time.hour + time.minute / 60) - 6)) + average
+
+def estimate_currently_needed_power():
+    return estimate_needed_power(datetime.datetime.now())
+
+def estimate_onshore_wind_power(wind_speed: float) -> float:
+    """Uses wind_speed to estimate the onshore wind power production.
+    See https://docs.google.com/spreadsheets/d/1a9QbTW_9zzluov_hqcWPwHgRYNH03s1lz4pOXHQ5cew/edit?usp=sharing
+    and https://www.desmos.com/calculator/9z13kqfsx0"""
+    return force_non_negative(-e**(-0.53*(wind_speed-10))+32)
+
+def estimate_offshore_wind_power(wind_speed):
+    """Uses wind_speed to estimate the offshore wind power production.
+    See https://docs.google.com/spreadsheets/d/1a9QbTW_9zzluov_hqcWPwHgRYNH03s1lz4pOXHQ5cew/edit?usp=sharing"""
+    if wind_speed < 10:
+        return force_non_negative(map_value(wind_speed, 4.65, 9.5, 0.732, 5.465))
+    else:
+        return force_non_negative(map_value(wind_speed, 9.89, 15.16, 5.465, 4.8))
+
+SOLAR_FACTOR = {
+    "jan": 1.086,
+    "feb": 1.459,
+    "mar": 2.032,
+    "apr": 2.582,
+    "may": 2.677,
+    "jun": 2.818,
+    "jul": 3.532,
+    "aug": 3.145,
+    "sep": 2.463,
+    "oct": 2.463,
+    "nov": 2.463,
+    "dec": 1.0
+}
+
+SOLAR_CONSTANT = 7
+
+# SOLAR_FACTOR indexed by month - 1
+_SOLAR_FACTORS = tuple(SOLAR_FACTOR.values())
+
+def solar_cloud_factor(cloudiness):
+    """returns the part of the solar power that is left at cloudiness percent.
+    cloudiness can be a numpy array too, nan stays nan"""
+    factor = 1 - cloudiness / 100 + 0.6
+    if hasattr(factor, 'clip'):
+        return factor.clip(0, 1)
+    return map_value_clamp(factor, 0, 1, 0, 1)
+
+def estimate_solar_power(date: datetime.datetime, cloudiness):
+    """estimates the solar power using the daytime and the date"""
+    return estimate_solar_power_from_cloud_factor(date, solar_cloud_factor(cloudiness))
+
+def estimate_solar_power_from_cloud_factor(date: datetime.datetime, cloud_factor: float):
+    """estimates the solar power using the daytime, the date and a solar_cloud_factor,
+    e.g. the average of the cloud factors of several sites"""
+    factor = _SOLAR_FACTORS[date.month - 1]
+    return factor * cloud_factor * SOLAR_CONSTANT * force_non_negative(sin(2 * pi / 24 * ((date.hour + date.minute / 60) - 6)))
+
+def estimate_current_solar_power(cloudiness):
+    return estimate_solar_power(datetime.datetime.now(), cloudiness)
+
+def estimate_batch(times, onshore_wind, offshore_wind, cloudiness, use_precise=False, average: float = 60, deviation: float = 20,
+                   solar_factors=None, onshore_scale: float = 1, offshore_scale: float = 1, solar_scale: float = 1,
+                   cloud_factors=None) -> Dict[str, "np.ndarray"]:
+    """estimates the power and the emission for whole time series at once.
+    Gives the same results as the scalar estimate functions, but in one numpy pass.
+
+    args:
+        times                   local times as numpy datetime64 array or sequence of datetime.datetime
+        onshore_wind            wind speeds in Holtriem or, if use_precise is True, the average weighted onshore wind speeds
+        offshore_wind           wind speeds at BorWinAlpha or, if use_precise is True, the average weighted offshore wind speeds
+        cloudiness              cloudiness in percent in Oldenburg
+        average, deviation      see estimate_needed_power
+        solar_factors           12 factors by month like SOLAR_FACTOR or one row of 12 factors per value, defaults to SOLAR_FACTOR
+        *_scale                 factors of the estimated powers, e.g. the share of a region, see region.Region
+        cloud_factors           solar_cloud_factor of every value that is used instead of the one of cloudiness where it is
+                                not nan, e.g. the average of the pv sites in precise mode, see precise_wind.average_solar_cloud_factor
+
+    average, deviation and the scales can also be arrays with one value per value, so the values
+    of several regions are estimated in the same pass.
+
+    returns: dict of arrays 'onshore', 'offshore', 'solar', 'conv', 'total' in GW and 'gpkwh'
+    """
+    import numpy as np
+
+    times = np.asarray(times, dtype='datetime64[m]')
+    onshore_wind = np.asarray(onshore_wind, dtype=np.float64)
+    offshore_wind = np.asarray(offshore_wind, dtype=np.float64)
+    cloudiness = np.asarray(cloudiness, dtype=np.float64)
+
+    hours = (times - times.astype('datetime64[D]')).astype(np.int64) / 60
+    months = times.astype('datetime64[M]').astype(np.int64) % 12
+    daytime = np.sin(2 * pi / 24 * (hours - 6))
+
+    total = deviation / 2 * daytime + average
+
+    if not use_precise:
+        onshore = -np.exp(-0.53 * (onshore_wind - 10)) + 32
+        offshore = np.where(offshore_wind < 10,
+                            map_value(offshore_wind, 4.65, 9.5, 0.732, 5.465),
+                            map_value(offshore_wind, 9.89, 15.16, 5.465, 4.8))
+    else:
+        from precise_wind import OFFSHORE_POWER_MAPPING, ONSHORE_POWER_MAPPING
+        onshore = map_value(onshore_wind, *ONSHORE_POWER_MAPPING)
+        offshore = map_value(offshore_wind, *OFFSHORE_POWER_MAPPING)
+    onshore = np.maximum(onshore, 0) * onshore_scale
+    offshore = np.maximum(offshore, 0) * offshore_scale
+
+    factors = np.asarray(_SOLAR_FACTORS if solar_factors is None else solar_factors, dtype=np.float64)
+    month_factors = factors[months] if factors.ndim == 1 else factors[np.arange(len(factors)), months]
+    cloud_factor = solar_cloud_factor(cloudiness)
+    if cloud_factors is not None:
+        cloud_factors = np.asarray(cloud_factors, dtype=np.float64)
+        cloud_factor = np.where(np.isnan(cloud_factors), cloud_factor, cloud_factors)
+    solar = month_factors * cloud_factor * SOLAR_CONSTANT * np.maximum(daytime, 0) * solar_scale
+
+    conv = np.maximum(total - (onshore + offshore + solar), 0)
+
+    return {
+        "onshore": onshore,
+        "offshore": offshore,
+        "solar": solar,
+        "conv": conv,
+        "total": total,
+        "gpkwh": conv / total * CONV_EMISSION
+    }
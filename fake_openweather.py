@@ -0,0 +1,109 @@
+"""Local stand-in for the openweathermap api, used by the tests and the benchmarks.
+
+    with FakeOpenWeather(latency=0.05, jitter=0.02, error_rate=0.01) as server:
+        util.API_URL = server.url
+        ...
+
+The weather at a location is derived from its coordinates, so the answers are reproducible.
+Observations are refreshed every update_interval seconds, like the real api does."""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+def weather_at(lat: float, lon: float, dt: int) -> dict:
+    """returns a reproducible weather response for lat, lon observed at dt"""
+    phase = (lat * 7 + lon * 3 + dt / 3600) % 13
+    return {
+        'coord': {'lon': lon, 'lat': lat},
+        'wind': {'speed': round(phase, 2), 'deg': int(lat * lon) % 360},
+        'clouds': {'all': int(lat * 11 + lon * 5 + dt / 600) % 101},
+        'dt': dt,
+        'cod': 200
+    }
+
+def forecast_at(lat: float, lon: float, dt: int, steps: int = 40) -> dict:
+    """returns a reproducible forecast response for lat, lon issued at dt with steps 3 hour steps"""
+    start = (dt // 10800 + 1) * 10800
+    entries = []
+    for step in range(steps):
+        weather = weather_at(lat, lon, start + step * 10800)
+        entries.append({key: weather[key] for key in ('dt', 'wind', 'clouds')})
+    return {'cod': '200', 'cnt': steps, 'list': entries, 'city': {'coord': {'lat': lat, 'lon': lon}}}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server: FakeOpenWeather = self.server.fake
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        with server.lock:
+            server.request_count += 1
+            delay = max(server.latency + server.random.uniform(-server.jitter, server.jitter), 0)
+            failed = server.random.random() < server.error_rate
+        time.sleep(delay)
+
+        if failed:
+            self._send(500, {'cod': 500, 'message': 'internal error'})
+        elif url.path.endswith('/weather') and 'lat' in query and 'lon' in query:
+            self._send(200, weather_at(float(query['lat'][0]), float(query['lon'][0]), server.observation_time()))
+        elif url.path.endswith('/forecast') and 'lat' in query and 'lon' in query:
+            self._send(200, forecast_at(float(query['lat'][0]), float(query['lon'][0]), server.observation_time()))
+        else:
+            self._send(404, {'cod': 404, 'message': 'not found'})
+
+    def _send(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeOpenWeather:
+    """Serves /weather and /forecast requests on localhost in a background thread.
+    Every request waits latency +- jitter seconds, error_rate of the requests fail with status 500."""
+
+    def __init__(self, latency: float = 0, jitter: float = 0, error_rate: float = 0, update_interval: float = 600, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.update_interval = update_interval
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """base url that can be used as util.API_URL"""
+        return f"http://127.0.0.1:{self._server.server_port}/data/2.5"
+
+    def observation_time(self) -> int:
+        return int(time.time() // self.update_interval * self.update_interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
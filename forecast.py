@@ -0,0 +1,172 @@
+"""Forecast of the emission for the next hours.
+
+    curve = forecast.estimate_forecast(48)
+    forecast.cleanest_window(curve, hours=3)    # (start, end, gpkwh)
+
+The forecast of a location is requested once and reused until the provider publishes the next one,
+so a curve costs about one request per location every UPDATE_INTERVAL seconds instead of one poll per hour."""
+import datetime
+import threading
+import time
+from functools import partial
+
+import sweep
+from estimator import estimate_batch
+from rate_limiter import PRIORITY_LOW
+from util import BOR_WIN_LAT, BOR_WIN_LON, HOLTRIEM_LAT, HOLTRIEM_LON, OLDENBURG_LAT, OLDENBURG_LON, request_forecast_data
+
+# numpy and precise_wind are imported when a curve is estimated, so importing this module stays fast
+
+# hours of the estimated curve
+FORECAST_HOURS = 48
+
+# seconds between two steps of the forecast
+STEP = 3 * 3600
+
+# openweathermap computes a new forecast every 3 hours
+UPDATE_INTERVAL = 3 * 3600
+# seconds after an update until the new forecast is served
+PUBLISH_DELAY = 600
+
+# a clean window is ahead if the emission drops by CLEAN_MARGIN g CO2 / kWh within CLEAN_WITHIN hours
+CLEAN_MARGIN = 100
+CLEAN_WITHIN = 12
+
+class ForecastError(Exception):
+    """raised if there is no forecast to estimate a curve from"""
+
+def is_valid_forecast(forecast) -> bool:
+    """returns True if forecast is a successful response of the forecast api"""
+    return isinstance(forecast, dict) and 'list' in forecast and str(forecast.get('cod', 200)) == '200'
+
+class ForecastCache:
+    """Forecast responses by (lat, lon), each is kept until the provider publishes the next forecast"""
+
+    def __init__(self, update_interval: float = UPDATE_INTERVAL, publish_delay: float = PUBLISH_DELAY, clock=time.time):
+        self.update_interval = update_interval
+        self.publish_delay = publish_delay
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def next_update(self, now: float) -> float:
+        """returns the time the forecast after now is served"""
+        return ((now - self.publish_delay) // self.update_interval + 1) * self.update_interval + self.publish_delay
+
+    def get(self, lat, lon):
+        """returns the forecast at lat, lon or None if there is none or a newer one is served"""
+        with self._lock:
+            entry = self._entries.get((lat, lon))
+            if entry is None or self.clock() >= entry[0]:
+                return None
+            return entry[1]
+
+    def put(self, lat, lon, forecast) -> None:
+        with self._lock:
+            self._entries[(lat, lon)] = (self.next_update(self.clock()), forecast)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+CACHE = ForecastCache()
+
+def request_forecast(lat, lon, fetch=None, use_cache=True):
+    """returns the forecast at lat, lon from CACHE or requests it with fetch(lat, lon), which defaults to util.request_forecast_data"""
+    if use_cache:
+        forecast = CACHE.get(lat, lon)
+        if forecast is not None:
+            return forecast
+
+    forecast = (request_forecast_data if fetch is None else fetch)(lat, lon)
+    if use_cache and is_valid_forecast(forecast):
+        CACHE.put(lat, lon, forecast)
+    return forecast
+
+def _series(forecast, times):
+    """returns arrays of the wind speeds and the cloudiness of forecast at the timestamps times, nan where forecast has no step"""
+    import numpy as np
+
+    steps = {entry['dt']: entry for entry in forecast['list']} if forecast is not None else {}
+    wind = np.array([steps[t]['wind']['speed'] if t in steps else np.nan for t in times], dtype=np.float64)
+    clouds = np.array([steps[t].get('clouds', {}).get('all', np.nan) if t in steps else np.nan for t in times], dtype=np.float64)
+    return wind, clouds
+
+def _precise_wind_speeds(times, fetch, max_workers, deadline):
+    """requests the forecasts of the windpark sweep and returns the average weighted onshore and offshore wind speeds at times"""
+    import numpy as np
+    import precise_wind
+
+    max_workers = precise_wind.MAX_CONCURRENT_REQUESTS if max_workers is None else max_workers
+    forecasts = sweep.fetch_all(precise_wind.sweep_locations(), partial(request_forecast, fetch=fetch), max_workers, deadline,
+                                valid=is_valid_forecast)
+    # one row per location, one column per step
+    wind = np.array([_series(forecast, times)[0] for forecast in forecasts]).reshape(-1, len(times))
+    if precise_wind.GRID is not None:
+        wind = np.column_stack([precise_wind.GRID.interpolate(column) for column in wind.T])
+
+    split = len(precise_wind.ONSHORE_PARKS)
+    onshore = np.array([precise_wind.ONSHORE_PARKS.weighted_average(column[:split]) for column in wind.T])
+    offshore = np.array([precise_wind.OFFSHORE_PARKS.weighted_average(column[split:]) for column in wind.T])
+    if np.isnan(onshore).all() or np.isnan(offshore).all():
+        raise ForecastError("no onshore or no offshore windpark forecast")
+    return onshore, offshore
+
+def estimate_forecast(hours=FORECAST_HOURS, use_precise=False, fetch=None, park_fetch=None, max_workers=None, deadline=None, now=None):
+    """estimates the emission at every step of the forecast in the next hours in one estimator.estimate_batch.
+    Uses the forecasts of Holtriem and BorWinAlpha or, if use_precise is True, of the windpark sweep
+    (see precise_wind.sweep_locations). The solar power always uses the cloudiness in Oldenburg.
+    fetch(lat, lon) requests a forecast, it defaults to util.request_forecast_data, park_fetch is used for
+    the windparks and defaults to fetch or a low priority request. Forecasts are reused from CACHE.
+
+    returns: dict of arrays 'time' (timestamps), 'onshore', 'offshore', 'solar', 'conv', 'total' and 'gpkwh', see estimate_batch
+    Raises ForecastError if there is no forecast in Oldenburg"""
+    import numpy as np
+
+    if park_fetch is None:
+        park_fetch = partial(request_forecast_data, priority=PRIORITY_LOW) if fetch is None else fetch
+    now = time.time() if now is None else now
+
+    oldenburg = request_forecast(OLDENBURG_LAT, OLDENBURG_LON, fetch)
+    if not is_valid_forecast(oldenburg):
+        raise ForecastError(f"no forecast in Oldenburg: {oldenburg}")
+    # the steps of Oldenburg are the time line, the step that is running now is the first one
+    times = [entry['dt'] for entry in oldenburg['list'] if now < entry['dt'] + STEP and entry['dt'] <= now + hours * 3600]
+    if not times:
+        raise ForecastError("the forecast in Oldenburg has no steps in the next hours")
+    cloudiness = _series(oldenburg, times)[1]
+
+    if not use_precise:
+        onshore_wind = _series(request_forecast(HOLTRIEM_LAT, HOLTRIEM_LON, fetch), times)[0]
+        offshore_wind = _series(request_forecast(BOR_WIN_LAT, BOR_WIN_LON, fetch), times)[0]
+    else:
+        onshore_wind, offshore_wind = _precise_wind_speeds(times, park_fetch, max_workers, deadline)
+
+    local_times = np.array([datetime.datetime.fromtimestamp(t) for t in times], dtype='datetime64[m]')
+    curve = estimate_batch(local_times, onshore_wind, offshore_wind, cloudiness, use_precise)
+    curve['time'] = np.array(times, dtype=np.float64)
+    return curve
+
+def cleanest_window(curve, hours: float = 3):
+    """returns (start, end, gpkwh) of the window of hours with the lowest mean emission in curve.
+    start and end are timestamps, None if the curve is shorter than the window"""
+    import numpy as np
+
+    steps = max(1, round(hours * 3600 / STEP))
+    gpkwh = np.asarray(curve['gpkwh'], dtype=np.float64)
+    if len(gpkwh) < steps:
+        return None
+    means = np.convolve(gpkwh, np.ones(steps) / steps, mode='valid')
+    if np.isnan(means).all():
+        return None
+    start = int(np.nanargmin(means))
+    return float(curve['time'][start]), float(curve['time'][start + steps - 1]) + STEP, float(means[start])
+
+def clean_window_ahead(curve, gpkwh: float, within: float = CLEAN_WITHIN, margin: float = CLEAN_MARGIN, now=None) -> bool:
+    """returns True if the emission in curve drops to gpkwh - margin or below within the next within hours"""
+    import numpy as np
+
+    now = time.time() if now is None else now
+    times = np.asarray(curve['time'], dtype=np.float64)
+    ahead = (times > now) & (times <= now + within * 3600)
+    return bool(np.any(np.asarray(curve['gpkwh'])[ahead] <= gpkwh - margin))
@@ -0,0 +1,96 @@
+import numpy as np
+
+# grid resolution of the weather model in degrees. Locations in the same cell get the same weather
+RESOLUTION = 0.1
+
+# number of nearest sampled cells used to interpolate a cell that is not sampled
+NEIGHBOURS = 4
+
+# kilometres per degree of latitude
+KM_PER_DEGREE = 111.2
+
+class GridIndex:
+    """Snaps locations to the grid of the weather model, so every cell is requested only once.
+
+    If there are more cells than max_cells, only the max_cells cells with the highest weight are
+    sampled and the value of every other location is interpolated from the nearest sampled cells
+    with inverse distance weighting. The interpolation is precomputed as matrix, so the values of
+    all locations are a single matrix product of the sampled cell values."""
+
+    def __init__(self, coordinates, weights=None, resolution: float = RESOLUTION, max_cells: int = None,
+                 neighbours: int = NEIGHBOURS, power: float = 2):
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        weights = np.ones(len(coordinates)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.resolution = resolution
+        self.max_cells = max_cells
+
+        cells, self.cell_of_location = np.unique(np.round(coordinates / resolution).astype(np.int64), axis=0, return_inverse=True)
+        self.cell_of_location = self.cell_of_location.reshape(-1)
+        cell_weights = np.bincount(self.cell_of_location, weights=weights, minlength=len(cells))
+
+        # the heaviest cells are sampled, ties are broken by position so the selection is reproducible
+        order = np.argsort(-cell_weights, kind='stable')
+        sampled = np.sort(order[:len(cells) if max_cells is None else max(1, min(max_cells, len(cells)))])
+
+        self.cells = cells
+        self.sampled_cells = sampled
+        self.locations = [tuple(cell) for cell in np.round(cells[sampled] * resolution, 6).tolist()]
+        self.matrix = self._interpolation_matrix(coordinates, sampled, neighbours, power)
+
+    def _interpolation_matrix(self, coordinates, sampled, neighbours, power):
+        position_of_cell = np.full(len(self.cells), -1)
+        position_of_cell[sampled] = np.arange(len(sampled))
+        matrix = np.zeros((len(coordinates), len(sampled)))
+
+        own = position_of_cell[self.cell_of_location]
+        inside = own >= 0
+        matrix[np.flatnonzero(inside), own[inside]] = 1
+
+        outside = np.flatnonzero(~inside)
+        if len(outside):
+            matrix[outside] = idw_matrix(coordinates[outside], self.cells[sampled] * self.resolution, neighbours, power)
+        return matrix
+
+    def __len__(self):
+        """number of cells that are requested"""
+        return len(self.locations)
+
+    def interpolate(self, cell_values: np.ndarray) -> np.ndarray:
+        """returns the value of every location from the values of the sampled cells, in the order of locations.
+        See interpolate for cells without a value"""
+        return interpolate(self.matrix, cell_values)
+
+    def support(self, available: np.ndarray) -> np.ndarray:
+        """returns the part of the interpolation weight of every location that comes from available cells"""
+        return self.matrix @ np.asarray(available, dtype=np.float64)
+
+def idw_matrix(points, sources, neighbours: int = NEIGHBOURS, power: float = 2) -> np.ndarray:
+    """returns the matrix that interpolates the values at the (lat, lon) points from the nearest
+    neighbours of the (lat, lon) sources with inverse distance weighting"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    sources = np.asarray(sources, dtype=np.float64).reshape(-1, 2)
+    distances = _distances(points, sources)
+    nearest = np.argsort(distances, axis=1)[:, :neighbours]
+    idw = 1 / np.maximum(np.take_along_axis(distances, nearest, axis=1), 1e-6) ** power
+    matrix = np.zeros((len(points), len(sources)))
+    np.put_along_axis(matrix, nearest, idw / idw.sum(axis=1, keepdims=True), axis=1)
+    return matrix
+
+def interpolate(matrix: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """returns matrix @ values. Values that are missing (nan) are left out and the weights of the other
+    values are renormalized, rows that only depend on missing values are nan"""
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    if not missing.any():
+        return matrix @ values
+    matrix = matrix[:, ~missing]
+    total = matrix.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, matrix @ values[~missing] / total, np.nan)
+
+def _distances(points, centers):
+    """approximate distances in km between every point and every center"""
+    latitude = np.radians((points[:, None, 0] + centers[None, :, 0]) / 2)
+    dlat = points[:, None, 0] - centers[None, :, 0]
+    dlon = (points[:, None, 1] - centers[None, :, 1]) * np.cos(latitude)
+    return KM_PER_DEGREE * np.hypot(dlat, dlon)
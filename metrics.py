@@ -0,0 +1,196 @@
+"""Timing and counting of the acquisition pipeline.
+
+    metrics.enable()
+    with metrics.timed('store'):
+        ...
+    metrics.snapshot()    # for the gui
+    metrics.serve(9100)   # prometheus text format on http://127.0.0.1:9100/metrics
+
+Nothing is recorded while the metrics are disabled, timed then returns a shared do nothing context
+and inc and observe return right away."""
+import bisect
+import threading
+import time
+
+# http.server is imported by serve, so recording does not slow down the start
+
+PREFIX = "co2ampel_"
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    'stage_seconds': "duration of a stage of the acquisition cycle",
+    'request_seconds': "duration of an api request, by location",
+    'api_calls_total': "number of api requests",
+    'api_errors_total': "number of failed api requests",
+    'cache_hits_total': "number of weather requests answered by the cache",
+    'rate_limited_total': "number of api requests refused by the rate limit",
+    'cycle_errors_total': "number of failed acquisition cycles",
+    'sample_lag_seconds': "time between the weather observation and the stored sample",
+}
+
+ENABLED = False
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': dict(zip((*self.buckets, float('inf')), self.counts))}
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, amount=1, **labels) -> None:
+    """increases the counter name with the given labels"""
+    if not ENABLED:
+        return
+    key = _key(labels)
+    with _lock:
+        counter = _counters.setdefault(name, {})
+        counter[key] = counter.get(key, 0) + amount
+
+def observe(name, value, **labels) -> None:
+    """adds value to the histogram name with the given labels"""
+    if not ENABLED:
+        return
+    key = _key(labels)
+    with _lock:
+        histogram = _histograms.setdefault(name, {}).get(key)
+        if histogram is None:
+            histogram = _histograms[name][key] = Histogram()
+        histogram.observe(value)
+
+class _Timer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe('stage_seconds', time.perf_counter() - self.start, stage=self.stage)
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+def timed(stage):
+    """context manager that records its duration as stage in stage_seconds"""
+    return _Timer(stage) if ENABLED else _NULL_TIMER
+
+def _on_request(lat, lon, seconds):
+    inc('api_calls_total')
+    observe('request_seconds', seconds, location=f"{lat},{lon}")
+
+def enable() -> None:
+    """starts recording. The api requests of util are recorded through util.latency_listeners"""
+    global ENABLED
+    import util
+    if _on_request not in util.latency_listeners:
+        util.latency_listeners.append(_on_request)
+    ENABLED = True
+
+def disable() -> None:
+    global ENABLED
+    import util
+    if _on_request in util.latency_listeners:
+        util.latency_listeners.remove(_on_request)
+    ENABLED = False
+
+def reset() -> None:
+    """forgets everything recorded so far"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def snapshot():
+    """returns all recorded values as {'counters': {name: {labels: value}}, 'histograms': {name: {labels: dict}}}.
+    labels are tuples of (label, value) pairs, a histogram dict has the keys 'count', 'sum' and 'buckets'"""
+    with _lock:
+        return {
+            'counters': {name: dict(values) for name, values in _counters.items()},
+            'histograms': {name: {key: histogram.to_dict() for key, histogram in values.items()}
+                           for name, values in _histograms.items()}
+        }
+
+def _format_labels(key, extra=()):
+    labels = [*key, *extra]
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+def _format_bound(bound):
+    return "+Inf" if bound == float('inf') else repr(float(bound))
+
+def render() -> str:
+    """returns the snapshot in the prometheus text format"""
+    values = snapshot()
+    lines = []
+    for name, counter in sorted(values['counters'].items()):
+        lines += [f"# HELP {PREFIX}{name} {HELP.get(name, name)}", f"# TYPE {PREFIX}{name} counter"]
+        lines += [f"{PREFIX}{name}{_format_labels(key)} {value}" for key, value in sorted(counter.items())]
+    for name, histograms in sorted(values['histograms'].items()):
+        lines += [f"# HELP {PREFIX}{name} {HELP.get(name, name)}", f"# TYPE {PREFIX}{name} histogram"]
+        for key, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f"{PREFIX}{name}_bucket{_format_labels(key, (('le', _format_bound(bound)),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(key)} {histogram['sum']}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(key)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def _handle_get(handler):
+    if handler.path.split('?')[0] not in ('/', '/metrics'):
+        handler.send_error(404)
+        return
+    body = render().encode()
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+def serve(port=9100, host="127.0.0.1"):
+    """enables the metrics and serves them at http://host:port/metrics in a background thread.
+    Returns the server, server.shutdown() stops it"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        do_GET = _handle_get
+
+        def log_message(self, *args):
+            pass
+
+    enable()
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
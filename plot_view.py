@@ -0,0 +1,146 @@
+import datetime
+
+import numpy as np
+
+# part of the shown time span that is kept free on the right, so new samples fit without a relayout
+X_HEADROOM = 0.2
+# part of the highest total power that is kept free at the top
+Y_HEADROOM = 0.2
+
+class PowerPlot:
+    """Draws the power distribution, the total power and the emission into a figure.
+
+    plot rebuilds everything. append only adds the new samples to the existing artists and,
+    if the canvas supports it, redraws them with blitting on top of a cached background.
+    The axes are only laid out again if the new samples don't fit into the current limits."""
+
+    LABELS = ["offshore", "onshore", "solar", "conv"]
+
+    def __init__(self, figure, canvas, incremental=True):
+        self.figure = figure
+        self.canvas = canvas
+        self.incremental = incremental
+
+        self.ax = self.figure.add_subplot()
+        self.ax2 = self.ax.twinx()
+
+        self.background = None
+        self.animated_artists = []
+        self.max_points = None
+        self.level = 0
+        self._clear_data()
+
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _clear_data(self):
+        self.time = []
+        self.distribution = [[] for _ in self.LABELS]
+        self.total = []
+        self.gpkwh = []
+
+    def _on_draw(self, event):
+        # the animated artists are not part of a normal draw, they are drawn on top of the cached background
+        if self.incremental:
+            self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+            self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self.animated_artists:
+            self.figure.draw_artist(artist)
+
+    def _stack_verts(self):
+        time = np.asarray(self.time)
+        lower = np.zeros(len(time))
+        verts = []
+        for layer in self.distribution:
+            upper = lower + np.asarray(layer)
+            verts.append(np.concatenate((np.column_stack((time, lower)), np.column_stack((time, upper))[::-1])))
+            lower = upper
+        return verts
+
+    def _update_artists(self):
+        for collection, verts in zip(self.stack, self._stack_verts()):
+            collection.set_verts([verts])
+        self.total_line.set_data(self.time, self.total)
+        self.gpkwh_line.set_data(self.time, self.gpkwh)
+
+    def _fits_limits(self):
+        if not self.time:
+            return True
+        x_min, x_max = self.ax.get_xlim()
+        return x_min <= self.time[0] and self.time[-1] <= x_max and max(self.total) <= self.ax.get_ylim()[1]
+
+    def _set_limits(self):
+        if not self.time:
+            return
+        start, end = self.time[0], self.time[-1]
+        span = max(end - start, 60)
+        self.ax.set_xlim(start, end + (X_HEADROOM * span if self.incremental else 0))
+        self.ax.set_ylim(0, max(self.total) * (1 + Y_HEADROOM))
+
+    def plot(self, data, level=0, time_format="%H:%M", max_points=None):
+        """draws data in the format of data_reader.read_latest_n_points from scratch.
+        If level is not 0, data is aggregated (see aggregation.read_aggregated) and the emission range is shown.
+        With max_points only the latest max_points samples are kept when appending"""
+        self.level = level
+        self.max_points = max_points
+        self._clear_data()
+        self.time = list(data['time'])
+        self.distribution = [list(data[label]) for label in self.LABELS]
+        self.total = list(data['total'])
+        self.gpkwh = list(data['gpkwh'])
+
+        self.ax.clear()
+        self.ax2.clear()
+
+        animated = self.incremental
+        self.stack = self.ax.stackplot(self.time, self.distribution, labels=self.LABELS, animated=animated)
+        self.total_line, = self.ax.plot(self.time, self.total, label='total', animated=animated)
+        self.ax.set_xlabel('time')
+        self.ax.set_ylabel('power in GW')
+
+        self.ax2.set_ylim(200, 900)
+        if level:
+            self.ax2.fill_between(self.time, data['gpkwh_min'], data['gpkwh_max'], color='black', alpha=0.2)
+        self.gpkwh_line, = self.ax2.plot(self.time, self.gpkwh, 'black', label='emission', animated=animated)
+        self.ax2.set_ylabel('g CO2 per kWh')
+
+        self.animated_artists = [*self.stack, self.total_line, self.gpkwh_line] if animated else []
+
+        self.ax.legend(loc='upper left')
+        self.ax2.legend(loc='upper right')
+        self.ax.xaxis.set_major_formatter(lambda x, pos: datetime.datetime.fromtimestamp(x).strftime(time_format))
+        self._set_limits()
+
+        self.canvas.draw()
+
+    def append(self, data):
+        """adds the samples of data that are newer than the plotted ones.
+        Returns the number of added samples"""
+        last_time = self.time[-1] if self.time else float('-inf')
+        new = [i for i, time in enumerate(data['time']) if time > last_time]
+        if not new:
+            return 0
+
+        self.time += [data['time'][i] for i in new]
+        for layer, label in zip(self.distribution, self.LABELS):
+            layer += [data[label][i] for i in new]
+        self.total += [data['total'][i] for i in new]
+        self.gpkwh += [data['gpkwh'][i] for i in new]
+
+        if self.max_points is not None and len(self.time) > self.max_points:
+            drop = len(self.time) - self.max_points
+            del self.time[:drop], self.total[:drop], self.gpkwh[:drop]
+            for layer in self.distribution:
+                del layer[:drop]
+
+        self._update_artists()
+
+        if not self.incremental or self.background is None or not self._fits_limits():
+            self._set_limits()
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_animated()
+            self.canvas.blit(self.figure.bbox)
+        return len(new)
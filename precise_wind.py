@@ -1,7 +1,12 @@
 from pprint import pprint
 from typing import Dict, Tuple
 
-from util import force_non_negative, map_value, request_weather_data
+import numpy as np
+
+import sweep
+from estimator import estimate_solar_power_from_cloud_factor, solar_cloud_factor
+from grid_index import RESOLUTION, GridIndex, idw_matrix, interpolate
+from util import force_non_negative, map_value, request_park_weather_data
 
 # from wikipedia: 'Liste der größten deutschen Onshore-Windparks'
 # key: (lat, lon), value: power in MW
@@ -113,55 +118,324 @@ OFFSHORE_WINDPARK_DICT = {
     (55.9, 7.103): 302.4
 }
 
-def request_wind_speeds(location_dict):
+class ParkTable:
+    """Stores windpark locations and capacities in contiguous arrays.
+    The capacities are normalized to weights once, so averaging the wind speeds
+    of all parks is a single dot product, no matter how many parks there are."""
+    __slots__ = ('locations', 'coordinates', 'capacities', 'weights')
+
+    def __init__(self, park_dict: Dict[Tuple[float, float], float]):
+        self._set(list(park_dict), np.fromiter(park_dict.values(), dtype=np.float64, count=len(park_dict)))
+
+    def _set(self, locations, capacities: np.ndarray) -> None:
+        self.locations = locations
+        self.coordinates = np.array(self.locations, dtype=np.float64).reshape(-1, 2)
+        self.capacities = capacities
+        self.weights = self.capacities / self.capacities.sum()
+
+    @classmethod
+    def concatenate(cls, *tables: "ParkTable") -> "ParkTable":
+        """returns one ParkTable of the parks of all tables in their order. Unlike merging the park dicts,
+        parks of different tables at the same location are kept apart"""
+        table = cls.__new__(cls)
+        table._set([location for t in tables for location in t.locations], np.concatenate([t.capacities for t in tables]))
+        return table
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __iter__(self):
+        return iter(self.locations)
+
+    def to_array(self, values: Dict[Tuple[float, float], float]) -> np.ndarray:
+        """converts a dict with key (lat, lon) to an array in the order of the parks, missing parks are nan"""
+        return np.fromiter((values.get(location, np.nan) for location in self.locations), dtype=np.float64, count=len(self.locations))
+
+    def weighted_average(self, values: np.ndarray) -> float:
+        """returns the capacity weighted average of values, given in the order of the parks.
+        Missing values (nan) are left out and the weights of the other parks are scaled up"""
+        missing = np.isnan(values)
+        if not missing.any():
+            return float(self.weights @ values)
+        if missing.all():
+            return np.nan
+        weights = np.where(missing, 0, self.weights)
+        return float(weights @ np.where(missing, 0, values) / weights.sum())
+
+ONSHORE_PARKS = ParkTable(ONSHORE_WINDPARK_DICT)
+OFFSHORE_PARKS = ParkTable(OFFSHORE_WINDPARK_DICT)
+ALL_PARKS = ParkTable.concatenate(ONSHORE_PARKS, OFFSHORE_PARKS)
+
+def get_park_table(location_weight_dict) -> ParkTable:
+    """returns the precomputed ParkTable of a windpark dict or builds a new one"""
+    if isinstance(location_weight_dict, ParkTable):
+        return location_weight_dict
+    if location_weight_dict is ONSHORE_WINDPARK_DICT:
+        return ONSHORE_PARKS
+    if location_weight_dict is OFFSHORE_WINDPARK_DICT:
+        return OFFSHORE_PARKS
+    return ParkTable(location_weight_dict)
+
+def load_park_registry(path) -> Dict[str, ParkTable]:
+    """reads a csv file with the columns lat,lon,capacity,kind and a header line, kind is onshore, offshore or solar.
+    Returns a dict with the ParkTables of the keys 'onshore', 'offshore' and 'solar'"""
+    parks = {'onshore': {}, 'offshore': {}, 'solar': {}}
+    with open(path) as f:
+        next(f)
+        for line in f:
+            if not line.strip():
+                continue
+            lat, lon, capacity, kind = line.strip().split(',')
+            location = (float(lat), float(lon))
+            parks[kind][location] = parks[kind].get(location, 0) + float(capacity)
+    return {kind: ParkTable(park_dict) for kind, park_dict in parks.items()}
+
+def combine_parks(onshore: ParkTable, offshore: ParkTable) -> ParkTable:
+    """returns one ParkTable of the onshore parks followed by the offshore parks, like ALL_PARKS"""
+    return ParkTable.concatenate(onshore, offshore)
+
+def use_parks(onshore: ParkTable, offshore: ParkTable, solar: ParkTable = None) -> None:
+    """replaces the windparks and the pv sites of the precise mode, e.g. with the tables of load_park_registry"""
+    global ONSHORE_PARKS, OFFSHORE_PARKS, ALL_PARKS
+    ONSHORE_PARKS = onshore
+    OFFSHORE_PARKS = offshore
+    ALL_PARKS = combine_parks(onshore, offshore)
+    if GRID is not None:
+        enable_grid(GRID.resolution, GRID.max_cells)
+    use_solar_sites(solar if solar is not None and len(solar) else None)
+
+# pv sites of the precise solar estimation, None uses all onshore parks with the same weight
+SOLAR_SITES = None
+# interpolates the cloudiness at SOLAR_SITES from the cloudiness at ONSHORE_PARKS
+_solar_matrix = None
+
+def use_solar_sites(sites: ParkTable = None) -> None:
+    """sets the pv sites with their capacity that the precise solar estimation is weighted by.
+    Their cloudiness is interpolated from the windpark responses, so they don't need any requests"""
+    global SOLAR_SITES, _solar_matrix
+    SOLAR_SITES = sites
+    _solar_matrix = None if sites is None else idw_matrix(sites.coordinates, ONSHORE_PARKS.coordinates)
+
+def _solar_sites_average(onshore_values: np.ndarray, onshore: ParkTable = None) -> float:
+    """returns the capacity weighted average of values at the onshore parks at the pv sites, nan if there are no values.
+    The pv sites are interpolated from ONSHORE_PARKS, values of other parks are averaged with the same weight"""
+    if np.isnan(onshore_values).all():
+        return np.nan
+    if SOLAR_SITES is None or (onshore is not None and onshore is not ONSHORE_PARKS):
+        return float(np.nanmean(onshore_values))
+    return SOLAR_SITES.weighted_average(interpolate(_solar_matrix, onshore_values))
+
+def average_solar_cloud_factor(onshore_cloudiness: np.ndarray, onshore: ParkTable = None) -> float:
+    """returns the capacity weighted solar_cloud_factor of the pv sites from the cloudiness at the onshore parks,
+    ONSHORE_PARKS by default. nan if there is no cloudiness"""
+    return _solar_sites_average(solar_cloud_factor(onshore_cloudiness), onshore)
+
+def average_solar_cloudiness(onshore_cloudiness: np.ndarray, onshore: ParkTable = None) -> float:
+    """returns the capacity weighted cloudiness in percent of the pv sites, the cloudiness the precise
+    solar estimation uses, nan if there is no cloudiness. See average_solar_cloud_factor"""
+    return _solar_sites_average(onshore_cloudiness, onshore)
+
+def estimate_solar_power_precise(date, wind_speeds: "SweepResult"):
+    """estimates the solar power from the cloudiness in the responses of the windpark sweep, see use_solar_sites.
+    Returns None if the sweep holds no cloudiness"""
+    cloud_factor = average_solar_cloud_factor(wind_speeds.cloudiness[:len(ONSHORE_PARKS)])
+    if np.isnan(cloud_factor):
+        return None
+    return estimate_solar_power_from_cloud_factor(date, cloud_factor)
+
+# GridIndex over ALL_PARKS that is used by sweep_all_wind_speeds, see enable_grid
+GRID = None
+
+def enable_grid(resolution: float = RESOLUTION, max_calls: int = None) -> GridIndex:
+    """requests every cell of the weather grid only once in the precise mode instead of every windpark.
+    With max_calls, at most max_calls cells with the most capacity are requested and the other parks are interpolated"""
+    global GRID
+    GRID = GridIndex(ALL_PARKS.coordinates, ALL_PARKS.capacities, resolution, max_calls)
+    return GRID
+
+def disable_grid() -> None:
+    global GRID
+    GRID = None
+
+def grid_for(parks: ParkTable):
+    """returns a GridIndex over parks with the resolution and max_calls of GRID, None if the grid is not enabled"""
+    if GRID is None or parks is ALL_PARKS:
+        return GRID
+    return GridIndex(parks.coordinates, parks.capacities, GRID.resolution, GRID.max_cells)
+
+def sweep_locations():
+    """returns the (lat, lon) that sweep_all_wind_speeds requests"""
+    return list(ALL_PARKS.locations) if GRID is None else list(GRID.locations)
+
+# parameters of map_value that convert the average weighted wind speed to the wind power in GW
+ONSHORE_POWER_MAPPING = (3, 10, 7.3, 35)
+OFFSHORE_POWER_MAPPING = (1.92, 5.71, 2.65, 4.05)
+
+# maximum number of weather requests that are running at the same time
+MAX_CONCURRENT_REQUESTS = 8
+
+# last (wind speed, cloudiness) that was requested at a (lat, lon), used for parks that don't answer in a sweep
+_last_values: Dict[Tuple[float, float], Tuple[float, float]] = {}
+
+class SweepResult:
+    """Wind speeds and cloudiness of a sweep over windpark locations, in the order of the locations.
+    Parks that did not answer have their last known values or nan if there are none.
+    answered tells which parks answered in this sweep."""
+    __slots__ = ('locations', 'wind_speeds', 'cloudiness', 'answered', 'weights')
+
+    def __init__(self, locations, wind_speeds: np.ndarray, answered: np.ndarray, weights: np.ndarray, cloudiness: np.ndarray = None):
+        self.locations = locations
+        self.wind_speeds = wind_speeds
+        self.cloudiness = np.full(len(locations), np.nan) if cloudiness is None else cloudiness
+        self.answered = answered
+        self.weights = weights
+
+    @property
+    def coverage(self) -> float:
+        """capacity share of the parks that answered in this sweep, 1 if all answered"""
+        return float(self.weights[self.answered].sum())
+
+    def split(self, index):
+        """returns the wind speeds before and after index"""
+        return self.wind_speeds[:index], self.wind_speeds[index:]
+
+def _parse(weather) -> Tuple[float, float]:
+    clouds = weather.get('clouds')
+    return weather['wind']['speed'], np.nan if clouds is None else clouds['all']
+
+def sweep_wind_speeds(locations, max_workers=None, fetch=None, deadline=None, hedge_after=None, retries=None) -> SweepResult:
+    """requests the windspeeds and the cloudiness at the (lat, lon) locations within deadline seconds, see sweep.fetch_all.
+    If locations is a ParkTable, the coverage is weighted by capacity, otherwise every location counts the same.
+    fetch(lat, lon) is used to get the weather data, it defaults to request_park_weather_data.
+    Use retries=0 if fetch reads a cache, a location that is missing won't be there on the next try either."""
+    weights = locations.weights if isinstance(locations, ParkTable) else None
+    locations = list(locations)
+    max_workers = MAX_CONCURRENT_REQUESTS if max_workers is None else max_workers
+    fetch = request_park_weather_data if fetch is None else fetch
+
+    weathers = sweep.fetch_all(locations, fetch, max_workers, deadline, retries, hedge_after=hedge_after)
+
+    # both fields are parsed into one array, the wind speeds and the cloudiness are views of its columns
+    values = np.empty((len(locations), 2))
+    answered = np.zeros(len(locations), dtype=bool)
+    for i, (location, weather) in enumerate(zip(locations, weathers)):
+        if weather is not None:
+            values[i] = _last_values[location] = _parse(weather)
+            answered[i] = True
+        else:
+            values[i] = _last_values.get(location, (np.nan, np.nan))
+
+    if weights is None:
+        weights = np.full(len(locations), 1 / len(locations)) if locations else np.zeros(0)
+    return SweepResult(locations, values[:, 0], answered, weights, values[:, 1])
+
+def request_wind_speed_array(locations, max_workers=None, fetch=None) -> np.ndarray:
+    """requests the windspeeds at the (lat, lon) locations and returns them as array in the same order.
+    Up to max_workers (default MAX_CONCURRENT_REQUESTS) requests are running concurrently.
+    fetch(lat, lon) is used to get the weather data, it defaults to request_park_weather_data.
+    Parks that don't answer in time have their last known wind speed or nan, see sweep_wind_speeds."""
+    return sweep_wind_speeds(locations, max_workers, fetch).wind_speeds
+
+def request_wind_speeds(location_dict, max_workers=None, fetch=None):
     """requests the windspeeds specified in the location dict.
     The key of the provided dict has to be in the format (lat, lon).
+    See request_wind_speed_array for max_workers and fetch.
     Returns dict with key (lat, lon) and value wind_speed"""
-    wind_speed = {}
-    for lat, lon in location_dict:
-        weather = request_weather_data(lat, lon)
-        wind_speed[(lat, lon)] = weather['wind']['speed']
+    locations = list(location_dict)
+    wind_speeds = request_wind_speed_array(locations, max_workers, fetch)
 
-    return wind_speed
+    # the dict is built in the order of location_dict, so the result does not depend on the request order
+    return dict(zip(locations, wind_speeds.tolist()))
 
-def calculate_average_weighted_wind_speed(location_weight_dict):
-    """Calculates the average wind speed at the (lat, lon) provided by the keys of location_weight_dict.
-    The value at each (lat, lon) key is used to weight the wind speed.
-    The average weighted wind speed con be used to calculate powers on a grid."""
-    weighted_wind_speeds = {}
-    wind_speeds = request_wind_speeds(location_weight_dict)
+def grid_sweep_wind_speeds(parks: ParkTable, grid: GridIndex, max_workers=None, fetch=None, deadline=None, hedge_after=None,
+                           retries=None) -> SweepResult:
+    """requests the sampled cells of grid and interpolates the windspeeds of parks from them, see sweep_wind_speeds.
+    A park counts as answered if all cells it is interpolated from answered"""
+    cells = sweep_wind_speeds(grid.locations, max_workers, fetch, deadline, hedge_after, retries)
+    answered = grid.support(cells.answered) > 1 - 1e-9
+    return SweepResult(parks.locations, grid.interpolate(cells.wind_speeds), answered, parks.weights, grid.interpolate(cells.cloudiness))
 
-    sum = 0
-    for location in location_weight_dict:
-        sum += location_weight_dict[location]
-    average_power = sum / len(location_weight_dict)
+def sweep_parks(parks: ParkTable, onshore_count: int, grid: GridIndex = None, max_workers=None, fetch=None, deadline=None, hedge_after=None,
+                retries=None) -> SweepResult:
+    """requests the windspeeds of parks in one sweep, the first onshore_count parks are onshore and the others offshore
+    like in ALL_PARKS (see combine_parks). With grid the cells of grid are requested instead, see grid_sweep_wind_speeds.
+    Raises sweep.SweepError if there is no wind speed for any onshore or any offshore park"""
+    if grid is None:
+        result = sweep_wind_speeds(parks, max_workers, fetch, deadline, hedge_after, retries)
+    else:
+        result = grid_sweep_wind_speeds(parks, grid, max_workers, fetch, deadline, hedge_after, retries)
+    onshore_wind_speeds, offshore_wind_speeds = result.split(onshore_count)
+    if np.isnan(onshore_wind_speeds).all() or np.isnan(offshore_wind_speeds).all():
+        raise sweep.SweepError("no onshore or no offshore windpark answered")
+    return result
 
-    for location in wind_speeds:
-        weighted_wind_speeds[location] = wind_speeds[location] * location_weight_dict[location] / average_power
+def sweep_all_wind_speeds(max_workers=None, fetch=None, deadline=None, hedge_after=None, retries=None) -> SweepResult:
+    """requests the windspeeds of all onshore and offshore windparks in one sweep over ALL_PARKS, see sweep_parks.
+    Be carefull with this function! Calling it results in 101 API calls, or one per cell if the grid is enabled.
+    Raises sweep.SweepError if there is no wind speed for any onshore or any offshore park"""
+    return sweep_parks(ALL_PARKS, len(ONSHORE_PARKS), GRID, max_workers, fetch, deadline, hedge_after, retries)
 
-    sum = 0
-    for location in weighted_wind_speeds:
-        sum += weighted_wind_speeds[location]
+def request_all_wind_speeds(max_workers=None, fetch=None):
+    """requests the windspeeds of all onshore and offshore windparks in one go, see sweep_all_wind_speeds.
+    Returns a tuple (onshore_wind_speeds, offshore_wind_speeds) of arrays in the order of ONSHORE_PARKS and OFFSHORE_PARKS"""
+    return sweep_all_wind_speeds(max_workers, fetch).split(len(ONSHORE_PARKS))
 
-    average_weighted_wind_speed = sum / len(weighted_wind_speeds)
+def calculate_average_weighted_wind_speed(location_weight_dict, wind_speeds=None):
+    """Calculates the average wind speed at the (lat, lon) provided by the keys of location_weight_dict.
+    The value at each (lat, lon) key is used to weight the wind speed. location_weight_dict can also be a ParkTable.
+    wind_speeds can be a dict with key (lat, lon) or an array in the order of the parks.
+    If wind_speeds is not provided, the wind speeds are requested using request_wind_speed_array.
+    Parks without a wind speed (nan) are left out and the weights of the others are renormalized.
+    The average weighted wind speed con be used to calculate powers on a grid."""
+    parks = get_park_table(location_weight_dict)
+
+    if wind_speeds is None:
+        wind_speeds = request_wind_speed_array(parks)
+    elif isinstance(wind_speeds, dict):
+        wind_speeds = parks.to_array(wind_speeds)
 
-    return average_weighted_wind_speed
+    return parks.weighted_average(wind_speeds)
 
-def estimate_onshore_wind_power_precise():
+def estimate_onshore_wind_power_precise(wind_speeds=None):
     """Estimates the onshore wind power using weather information of 74 locations all over germany and the capacity of windparks located there.
-    This location data is provided in the ONSHORE_WINDPARK_DICT.
-    Be carefull with this function! Calling it results in 74 API calls.
+    This location data is provided in the ONSHORE_WINDPARK_DICT. Already requested wind speeds can be passed with wind_speeds.
+    Be carefull with this function! Calling it without wind_speeds results in 74 API calls.
     See https://docs.google.com/spreadsheets/d/1a9QbTW_9zzluov_hqcWPwHgRYNH03s1lz4pOXHQ5cew/edit?usp=sharing for data."""
-    average_weighted_wind_speed = calculate_average_weighted_wind_speed(ONSHORE_WINDPARK_DICT)
-    return force_non_negative(map_value(average_weighted_wind_speed, 3, 10, 7.3, 35))
+    average_weighted_wind_speed = calculate_average_weighted_wind_speed(ONSHORE_PARKS, wind_speeds)
+    return force_non_negative(map_value(average_weighted_wind_speed, *ONSHORE_POWER_MAPPING))
 
-def estimate_offshore_wind_power_precise():
+def estimate_offshore_wind_power_precise(wind_speeds=None):
     """Estimates the offshore wind power using weather information of 27 locations in the north- and baltic sea and the capacity of windparks located there.
-    This location data is provided in the OFFSHORE_WINDPARK_DICT.
-    Be carefull with this function! Calling it results in 27 API calls.
+    This location data is provided in the OFFSHORE_WINDPARK_DICT. Already requested wind speeds can be passed with wind_speeds.
+    Be carefull with this function! Calling it without wind_speeds results in 27 API calls.
     See https://docs.google.com/spreadsheets/d/1a9QbTW_9zzluov_hqcWPwHgRYNH03s1lz4pOXHQ5cew/edit?usp=sharing for data."""
-    average_weighted_wind_speed = calculate_average_weighted_wind_speed(OFFSHORE_WINDPARK_DICT)
-    return force_non_negative(map_value(average_weighted_wind_speed, 1.92, 5.71, 2.65, 4.05))
+    average_weighted_wind_speed = calculate_average_weighted_wind_speed(OFFSHORE_PARKS, wind_speeds)
+    return force_non_negative(map_value(average_weighted_wind_speed, *OFFSHORE_POWER_MAPPING))
+
+def estimate_wind_power_precise(max_workers=None, fetch=None):
+    """Estimates the onshore and offshore wind power, requesting all 101 windpark locations concurrently.
+    Be carefull with this function! Calling it results in 101 API calls.
+    Returns a tuple (onshore, offshore)"""
+    onshore_wind_speeds, offshore_wind_speeds = request_all_wind_speeds(max_workers, fetch)
+    return estimate_onshore_wind_power_precise(onshore_wind_speeds), estimate_offshore_wind_power_precise(offshore_wind_speeds)
+
+def grid_error(resolution: float = RESOLUTION, max_calls: int = None, max_workers=None, fetch=None):
+    """compares the wind speeds of a grid sweep with a full sweep over ALL_PARKS.
+    Be carefull with this function! It results in a full sweep and a grid sweep of API calls.
+    Returns a dict with the number of calls of both sweeps and the errors of the grid in m/s"""
+    grid = GridIndex(ALL_PARKS.coordinates, ALL_PARKS.capacities, resolution, max_calls)
+    full = sweep_wind_speeds(ALL_PARKS, max_workers, fetch).wind_speeds
+    interpolated = grid_sweep_wind_speeds(ALL_PARKS, grid, max_workers, fetch).wind_speeds
+    errors = np.abs(interpolated - full)
+    split = len(ONSHORE_PARKS)
+    return {
+        'calls': len(grid),
+        'full_calls': len(ALL_PARKS),
+        'mean_abs_error': float(np.nanmean(errors)),
+        'max_abs_error': float(np.nanmax(errors)),
+        'onshore_average_error': abs(ONSHORE_PARKS.weighted_average(interpolated[:split]) - ONSHORE_PARKS.weighted_average(full[:split])),
+        'offshore_average_error': abs(OFFSHORE_PARKS.weighted_average(interpolated[split:]) - OFFSHORE_PARKS.weighted_average(full[split:]))
+    }
 
 if __name__ == "__main__":
     print(estimate_offshore_wind_power_precise())
@@ -0,0 +1,89 @@
+import threading
+import time
+
+# requests of the headline locations (Oldenburg, Holtriem, BorWinAlpha)
+PRIORITY_HIGH = 0
+# requests of the windpark sweep of the precise mode, they can be skipped and done in a later cycle
+PRIORITY_LOW = 1
+
+class RateLimitExceeded(Exception):
+    """raised if the request budget does not allow a request"""
+
+class TokenBucket:
+    """capacity tokens that refill continuously at rate tokens per second"""
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        """adds the tokens since the last refill and returns the available tokens"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self, tokens: float) -> float:
+        """returns the seconds until tokens are available, call refill first"""
+        return max(tokens - self.tokens, 0) / self.rate
+
+class RateLimiter:
+    """Limits the api requests to per_minute per minute and per_day per day.
+
+    Requests with PRIORITY_HIGH wait up to max_wait seconds for the budget. Requests with
+    PRIORITY_LOW don't wait and are refused while less than minute_reserve requests of the
+    minute and day_reserve requests of the day are left, so the headline locations can
+    always be requested. The default day_reserve covers three requests every 10 minutes."""
+
+    def __init__(self, per_minute: float = 60, per_day: float = 30000, minute_reserve: float = 3,
+                 day_reserve: float = 432, max_wait: float = 5, clock=time.monotonic):
+        self.clock = clock
+        now = clock()
+        self.minute = TokenBucket(per_minute, per_minute / 60, now)
+        self.day = TokenBucket(per_day, per_day / 86400, now)
+        self.minute_reserve = minute_reserve
+        self.day_reserve = day_reserve
+        self.max_wait = max_wait
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, priority, now):
+        """returns 0 if a token was taken, otherwise the seconds until one is available"""
+        reserve = (0, 0) if priority == PRIORITY_HIGH else (self.minute_reserve, self.day_reserve)
+        self.minute.refill(now)
+        self.day.refill(now)
+        needed_minute = 1 + reserve[0]
+        needed_day = 1 + reserve[1]
+        if self.minute.tokens >= needed_minute and self.day.tokens >= needed_day:
+            self.minute.tokens -= 1
+            self.day.tokens -= 1
+            return 0
+        return max(self.minute.wait_time(needed_minute), self.day.wait_time(needed_day))
+
+    def try_acquire(self, priority=PRIORITY_HIGH) -> bool:
+        """takes the budget of one request if it is available right now"""
+        with self._lock:
+            return self._try_acquire(priority, self.clock()) == 0
+
+    def acquire(self, priority=PRIORITY_HIGH) -> None:
+        """takes the budget of one request. Raises RateLimitExceeded if it is not available
+        right now (PRIORITY_LOW) or within max_wait seconds (PRIORITY_HIGH)"""
+        deadline = self.clock() + (self.max_wait if priority == PRIORITY_HIGH else 0)
+        while True:
+            with self._lock:
+                now = self.clock()
+                wait = self._try_acquire(priority, now)
+                if wait == 0:
+                    return
+                if now + wait > deadline:
+                    self.refused += 1
+                    raise RateLimitExceeded(f"request budget exhausted, next request possible in {wait:.0f} s")
+            time.sleep(wait)
+
+    def remaining(self) -> dict:
+        """returns the requests that are left in the current minute and day"""
+        with self._lock:
+            now = self.clock()
+            return {'minute': int(self.minute.refill(now)), 'day': int(self.day.refill(now))}
@@ -0,0 +1,302 @@
+"""Several grid zones estimated in one process.
+
+    engine = RegionEngine(load_regions("regions.example.json"))
+    engine.refresh()
+    engine.estimate()                   # {name: Sample}
+
+A Region holds what used to be module constants: the locations of the headline weather, the windparks
+of the precise mode, the demand curve, the share of the german power the estimation functions give and
+the thresholds of the ampel. All regions are requested through one AdaptiveScheduler, so a location
+that several regions use is requested once per observation, and estimated in one estimate_batch pass."""
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict
+
+import data_reader
+import metrics
+import sweep
+from estimator import SOLAR_FACTOR, Sample, estimate_batch
+from util import BOR_WIN_LAT, BOR_WIN_LON, HOLTRIEM_LAT, HOLTRIEM_LON, OLDENBURG_LAT, OLDENBURG_LON, map_value_clamp
+
+# numpy, precise_wind and aggregation are imported when they are needed, so importing this module stays fast
+
+logger = logging.getLogger("co2_ampel")
+
+# directory of the sample logs of the regions, one data file per region
+REGION_DIRECTORY = "data/regions"
+
+class Region:
+    """Configuration of a grid zone.
+
+    args:
+        name                            name of the data file and in the logs
+        solar_location                  (lat, lon) of the cloudiness, like Oldenburg
+        onshore_location                (lat, lon) of the onshore wind speed in normal mode, like Holtriem
+        offshore_location               (lat, lon) of the offshore wind speed in normal mode, like BorWinAlpha
+        onshore_parks, offshore_parks   precise_wind.ParkTable of the precise mode, None uses the parks of precise_wind
+        average, deviation              demand curve in GW, see estimator.estimate_needed_power
+        *_share                         part of the german power of the estimation functions that is produced in the region
+        solar_factors                   factor of every month like estimator.SOLAR_FACTOR, see solar_factors_by_month
+        ampel_range                     emission in g CO2 / kWh that is shown green and red
+    """
+
+    def __init__(self, name, solar_location, onshore_location, offshore_location, onshore_parks=None, offshore_parks=None,
+                 average: float = 60, deviation: float = 20, onshore_share: float = 1, offshore_share: float = 1, solar_share: float = 1,
+                 solar_factors=None, ampel_range=(200, 700)):
+        self.name = name
+        self.solar_location = tuple(solar_location)
+        self.onshore_location = tuple(onshore_location)
+        self.offshore_location = tuple(offshore_location)
+        self.onshore_parks = onshore_parks
+        self.offshore_parks = offshore_parks
+        self.average = average
+        self.deviation = deviation
+        self.onshore_share = onshore_share
+        self.offshore_share = offshore_share
+        self.solar_share = solar_share
+        self.solar_factors = solar_factors_by_month(SOLAR_FACTOR if solar_factors is None else solar_factors)
+        self.ampel_range = tuple(ampel_range)
+        # (key, result) of the last sweep_tables call, rebuilt when the parks or precise_wind.GRID change
+        self._sweep_tables = None
+
+    def __repr__(self):
+        return f"Region({self.name!r})"
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(REGION_DIRECTORY, f"{self.name}.csv")
+
+    def parks(self):
+        """returns the (onshore, offshore) ParkTables of the precise mode"""
+        if self.onshore_parks is not None and self.offshore_parks is not None:
+            return self.onshore_parks, self.offshore_parks
+        import precise_wind
+        return (precise_wind.ONSHORE_PARKS if self.onshore_parks is None else self.onshore_parks,
+                precise_wind.OFFSHORE_PARKS if self.offshore_parks is None else self.offshore_parks)
+
+    def locations(self, use_precise=False):
+        """returns the (lat, lon) of the headline weather, see co2_ampel.required_locations"""
+        if use_precise:
+            return [self.solar_location]
+        return [self.solar_location, self.onshore_location, self.offshore_location]
+
+    def sweep_tables(self):
+        """returns (parks, onshore_count, grid) of the precise mode, see precise_wind.sweep_parks. parks holds the onshore
+        and the offshore parks and grid is a GridIndex over them if precise_wind.GRID is enabled, None otherwise"""
+        import precise_wind
+
+        onshore, offshore = self.parks()
+        key = (onshore, offshore, precise_wind.GRID)
+        if self._sweep_tables is None or self._sweep_tables[0] != key:
+            if onshore is precise_wind.ONSHORE_PARKS and offshore is precise_wind.OFFSHORE_PARKS:
+                parks = precise_wind.ALL_PARKS
+            else:
+                parks = precise_wind.combine_parks(onshore, offshore)
+            self._sweep_tables = (key, (parks, len(onshore), precise_wind.grid_for(parks)))
+        return self._sweep_tables[1]
+
+    def sweep_locations(self, use_precise=False):
+        """returns the (lat, lon) of the windparks of the precise mode, the cells if the grid is enabled"""
+        if not use_precise:
+            return []
+        parks, _, grid = self.sweep_tables()
+        return list(parks.locations if grid is None else grid.locations)
+
+    def ampel_value(self, gpkwh: float) -> float:
+        return map_value_clamp(gpkwh, *self.ampel_range, 0, 1)
+
+def solar_factors_by_month(factors) -> Dict[int, float]:
+    """returns the solar factors with the months 1 to 12 as keys. The months of factors can be ints,
+    numbers as strings like in json or the names of estimator.SOLAR_FACTOR.
+    Raises ValueError if a month is unknown or missing"""
+    names = list(SOLAR_FACTOR)
+    by_month = {}
+    for key, factor in factors.items():
+        if isinstance(key, str) and key.lower() in names:
+            month = names.index(key.lower()) + 1
+        else:
+            try:
+                month = int(key)
+            except ValueError:
+                raise ValueError(f"unknown month {key!r} in solar_factors")
+        if month in by_month or not 1 <= month <= 12:
+            raise ValueError(f"month {key!r} is invalid or given twice in solar_factors")
+        by_month[month] = float(factor)
+    if len(by_month) != 12:
+        raise ValueError(f"solar_factors has no factor for the months {sorted(set(range(1, 13)) - set(by_month))}")
+    return by_month
+
+DEFAULT_REGION = Region("germany", (OLDENBURG_LAT, OLDENBURG_LON), (HOLTRIEM_LAT, HOLTRIEM_LON), (BOR_WIN_LAT, BOR_WIN_LON))
+
+def region_from_dict(config: dict, directory: str = ".") -> Region:
+    """creates a Region from a dict with the keys of Region. 'parks' can be the path of a park registry,
+    relative to directory, see precise_wind.load_park_registry"""
+    config = dict(config)
+    parks = config.pop('parks', None)
+    if parks is not None:
+        import precise_wind
+        tables = precise_wind.load_park_registry(os.path.join(directory, parks))
+        config['onshore_parks'], config['offshore_parks'] = tables['onshore'], tables['offshore']
+    return Region(**config)
+
+def load_regions(path):
+    """reads a json list of regions, see region_from_dict"""
+    with open(path) as f:
+        return [region_from_dict(config, os.path.dirname(path)) for config in json.load(f)]
+
+def _wind_speed(weather) -> float:
+    """returns the wind speed of weather, nan if it is missing or an error response"""
+    return weather['wind']['speed'] if sweep.is_valid(weather) else float('nan')
+
+def _cloudiness(weather) -> float:
+    """returns the cloudiness of weather, nan if it is missing or an error response"""
+    return weather['clouds']['all'] if sweep.is_valid(weather) and 'clouds' in weather else float('nan')
+
+class RegionEngine:
+    """Requests and estimates several regions. The locations of all regions go through one AdaptiveScheduler,
+    so every location is requested once, no matter how many regions use it"""
+
+    def __init__(self, regions, use_precise=False, scheduler=None):
+        from adaptive_scheduler import AdaptiveScheduler
+
+        self.regions = list(regions)
+        self.use_precise = use_precise
+        self.scheduler = AdaptiveScheduler() if scheduler is None else scheduler
+
+    def region(self, name) -> Region:
+        return next(region for region in self.regions if region.name == name)
+
+    def locations(self):
+        """returns the distinct (lat, lon) of all regions, including the windparks"""
+        return list(dict.fromkeys(location for region in self.regions
+                                  for location in region.locations(self.use_precise) + region.sweep_locations(self.use_precise)))
+
+    def sweep_locations(self):
+        return list(dict.fromkeys(location for region in self.regions for location in region.sweep_locations(self.use_precise)))
+
+    def refresh(self, now=None) -> bool:
+        """requests the stale locations of all regions, see AdaptiveScheduler.refresh"""
+        return self.scheduler.refresh(self.locations(), now, sweep=self.sweep_locations())
+
+    def estimate(self, now: datetime.datetime = None) -> Dict[str, Sample]:
+        """estimates all regions from the weather of the scheduler in one estimate_batch.
+        The precise mode sweeps the parks of every region like precise_wind.sweep_all_wind_speeds, parks that are
+        not in the scheduler use their last known wind speed. Like co2_ampel.estimate_sample, the solar power then
+        comes from the cloudiness of the onshore parks, from solar_location only if they have none.
+        Regions without weather are logged and left out.
+        Returns {name: Sample}"""
+        import numpy as np
+        import precise_wind
+
+        now = datetime.datetime.now() if now is None else now
+        get = self.scheduler.get
+        count = len(self.regions)
+        onshore_wind, offshore_wind, cloudiness = np.empty(count), np.empty(count), np.empty(count)
+        cloud_factors = np.full(count, np.nan)
+        coverage = np.ones(count)
+
+        for i, region in enumerate(self.regions):
+            cloudiness[i] = _cloudiness(get(*region.solar_location))
+            if not self.use_precise:
+                onshore_wind[i] = _wind_speed(get(*region.onshore_location))
+                offshore_wind[i] = _wind_speed(get(*region.offshore_location))
+                continue
+
+            parks, onshore_count, grid = region.sweep_tables()
+            try:
+                # the scheduler has the weather or not, retrying the missing parks won't change that
+                result = precise_wind.sweep_parks(parks, onshore_count, grid, fetch=get, retries=0)
+            except sweep.SweepError as error:
+                logger.warning("%s in region %s", error, region.name)
+                onshore_wind[i] = offshore_wind[i] = np.nan
+                continue
+            onshore, offshore = region.parks()
+            onshore_speeds, offshore_speeds = result.split(onshore_count)
+            onshore_wind[i] = onshore.weighted_average(onshore_speeds)
+            offshore_wind[i] = offshore.weighted_average(offshore_speeds)
+            coverage[i] = result.coverage
+            park_cloudiness = result.cloudiness[:onshore_count]
+            cloud_factors[i] = precise_wind.average_solar_cloud_factor(park_cloudiness, onshore)
+            if not np.isnan(cloud_factors[i]):
+                cloudiness[i] = precise_wind.average_solar_cloudiness(park_cloudiness, onshore)
+
+        def column(attribute):
+            return np.array([getattr(region, attribute) for region in self.regions], dtype=np.float64)
+
+        batch = estimate_batch(np.full(count, np.datetime64(now, 'm')), onshore_wind, offshore_wind, cloudiness, self.use_precise,
+                               average=column('average'), deviation=column('deviation'),
+                               solar_factors=np.array([[region.solar_factors[month] for month in range(1, 13)] for region in self.regions]),
+                               onshore_scale=column('onshore_share'), offshore_scale=column('offshore_share'), solar_scale=column('solar_share'),
+                               cloud_factors=cloud_factors)
+
+        samples = {}
+        for i, region in enumerate(self.regions):
+            if np.isnan(batch['gpkwh'][i]):
+                logger.warning("no weather for region %s, skipping it", region.name)
+                continue
+            samples[region.name] = Sample(now, *(float(batch[field][i]) for field in ('onshore', 'offshore', 'solar', 'conv', 'total')),
+                                          holtriem_wind=None if self.use_precise else float(onshore_wind[i]),
+                                          bor_win_wind=None if self.use_precise else float(offshore_wind[i]),
+                                          cloudiness=float(cloudiness[i]), use_precise=self.use_precise, coverage=float(coverage[i]))
+        return samples
+
+    def run_cycle(self, store=None) -> Dict[str, Sample]:
+        """requests the stale locations and, if any observation changed, estimates all regions and stores
+        every Sample with store(region, sample), which defaults to write_region_sample. Returns {name: Sample}"""
+        store = write_region_sample if store is None else store
+        with metrics.timed('cycle'):
+            with metrics.timed('fetch'):
+                changed = self.refresh()
+            if not changed:
+                logger.info("no new observations, skipping cycle")
+                return {}
+            with metrics.timed('estimate'):
+                samples = self.estimate()
+            with metrics.timed('store'):
+                for name, sample in samples.items():
+                    store(self.region(name), sample)
+        for name, sample in samples.items():
+            logger.info("estimated emission in %s: %s g CO2 / kWh", name, sample.gpkwh)
+        return samples
+
+def write_region_sample(region: Region, sample: Sample) -> None:
+    """appends sample to the data file of region, see co2_ampel.write_to_file"""
+    import aggregation
+
+    os.makedirs(os.path.dirname(region.data_path), exist_ok=True)
+    data_reader.append_sample(sample.time, sample.values(), region.data_path)
+    aggregation.add_sample(sample.time, sample.values(), region.data_path)
+
+def sample_information(sample: Sample) -> dict:
+    """returns a dict like co2_ampel.get_all_information of a Sample of a region, without the weather responses"""
+    return {'holtriem_wind': sample.holtriem_wind, 'bor_win_wind': sample.bor_win_wind, 'cloudiness': sample.cloudiness,
+            'power': sample.power, 'power_dist': sample.power_distribution, 'gpkwh': sample.gpkwh, 'coverage': sample.coverage,
+            'clean_window_ahead': False, 'sample': sample}
+
+def run_daemon(engine: RegionEngine, interval=600, led_region=None, stop_event=None, on_sample=None):
+    """runs engine.run_cycle at every multiple of interval seconds until stop_event is set, like co2_ampel.run_daemon.
+    The leds show the region named led_region, the first region by default. on_sample(all_info) is called with
+    every new sample of led_region, see sample_information"""
+    import rgb_controller
+    from co2_ampel import seconds_until_boundary
+
+    led_region = engine.regions[0].name if led_region is None else led_region
+    stop_event = threading.Event() if stop_event is None else stop_event
+    while not stop_event.is_set():
+        try:
+            samples = engine.run_cycle()
+            if led_region in samples:
+                rgb_controller.set_ampel(engine.region(led_region).ampel_value(samples[led_region].gpkwh))
+                if on_sample is not None:
+                    on_sample(sample_information(samples[led_region]))
+        except Exception as error:
+            metrics.inc('cycle_errors_total')
+            logger.exception("cycle failed: %r", error)
+
+        deadline = time.monotonic() + seconds_until_boundary(interval)
+        while not stop_event.is_set() and time.monotonic() < deadline:
+            stop_event.wait(deadline - time.monotonic())
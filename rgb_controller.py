@@ -8,12 +8,17 @@ except ImportError:
 from typing import Collection
 from time import sleep
 
+import metrics
+
 pi = pigpio.pi() if _leds_existing else None
 
 PIN_RED = 17
 PIN_GREEN = 22
 PIN_BLUE = 24
 
+# brightness of the blue led that is added to the ampel color while a clean window is ahead
+CLEAN_WINDOW_BLUE = 96
+
 def _ensure_valid_brightness(brightness: int) -> int:
     """clamps the parameter brightness to the range 0 - 255"""
     if brightness > 255:
@@ -34,23 +39,28 @@ def _lerp_color(color_a: Collection, color_b: Collection, amt: float) -> Collect
 def set_color(color: Collection) -> None:
     """sets leds to the given color"""
     if _leds_existing:
-        pi.set_PWM_dutycycle(PIN_RED, _ensure_valid_brightness(color[0]))
-        pi.set_PWM_dutycycle(PIN_GREEN, _ensure_valid_brightness(color[1]))
-        pi.set_PWM_dutycycle(PIN_BLUE, _ensure_valid_brightness(color[2]))
+        with metrics.timed('led'):
+            pi.set_PWM_dutycycle(PIN_RED, _ensure_valid_brightness(color[0]))
+            pi.set_PWM_dutycycle(PIN_GREEN, _ensure_valid_brightness(color[1]))
+            pi.set_PWM_dutycycle(PIN_BLUE, _ensure_valid_brightness(color[2]))
 
 def clear() -> None:
     """clears leds"""
     set_color((0, 0, 0))
 
-def set_ampel(amount: float) -> None:
+def set_ampel(amount: float, clean_window_ahead: bool = False) -> None:
     """lights up leds on a scale from green to red according to the parameter amount.
-        0 -> green, 1 -> red"""
+        0 -> green, 1 -> red
+    With clean_window_ahead the blue led is added, see forecast.clean_window_ahead"""
     if amount > 1:
         raise ValueError("Ampel amount above 1")
     elif amount < 0:
         raise ValueError("Ampel amount below 0")
 
-    set_color(_lerp_color((0, 255, 0), (255, 0, 0), amount))
+    color = _lerp_color((0, 255, 0), (255, 0, 0), amount)
+    if clean_window_ahead:
+        color[2] = CLEAN_WINDOW_BLUE
+    set_color(color)
 
 def quit() -> None:
     """clears the leds and stops the controll"""
@@ -0,0 +1,359 @@
+"""Serves the samples as JSON over http, so many Ampels can share one fetcher.
+
+    ampel_server = server.serve(8080)       # in the process that fetches, see co2_ampel --serve-port
+    ampel_server.publish(all_info)          # after every new sample
+
+    with server.AmpelClient("http://ampel.local:8080") as client:
+        client.current()
+
+Endpoints, all GET:
+    /current                            latest sample, see to_json_info
+    /latest?n=50                        last n samples like data_reader.read_latest_n_points
+    /range?start=..&end=..[&width=..]   samples from start to end (timestamps) as {'level', 'data'}, see aggregation.read_for_plot
+    /forecast                           latest forecast curve, see data_reader.read_forecast
+
+Responses are cached until the next publish and carry an ETag, requests with a matching If-None-Match
+are answered with 304 and no body. Concurrent requests for the same uncached response share one read
+and the files are read in worker threads, so the event loop keeps serving while a range is read."""
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import data_reader
+
+# requests is imported by AmpelClient and aggregation (numpy) by the first /range with a width
+
+logger = logging.getLogger("co2_ampel")
+
+# most samples /latest returns
+MAX_POINTS = 10000
+# number of cached responses, the cache is cleared when it is full
+MAX_CACHED = 256
+# seconds an idle connection is kept open
+KEEP_ALIVE = 30
+# most header lines read of a request
+MAX_HEADER_LINES = 100
+
+# keys of get_all_information that are served by /current, the sample is served as 'time', 'power' and 'power_dist'
+INFO_KEYS = ('holtriem_weather', 'bor_win_weather', 'oldenburg_weather', 'holtriem_wind', 'bor_win_wind', 'cloudiness',
+             'power', 'power_dist', 'gpkwh', 'coverage', 'clean_window_ahead')
+
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def to_json_info(all_info) -> dict:
+    """returns the dict of co2_ampel.get_all_information without the Sample, so it can be encoded as json"""
+    info = {key: all_info.get(key) for key in INFO_KEYS}
+    info['time'] = all_info['sample'].time.timestamp()
+    return info
+
+def from_json_info(info) -> dict:
+    """returns a dict like co2_ampel.get_all_information from a /current response"""
+    from estimator import Sample
+
+    all_info = dict(info)
+    all_info['coverage'] = 1.0 if info.get('coverage') is None else info['coverage']
+    all_info['sample'] = Sample.from_power(datetime.datetime.fromtimestamp(info['time']), info['power'], coverage=all_info['coverage'])
+    return all_info
+
+def _number(query, name, convert=float, default=None):
+    if name not in query:
+        if default is None:
+            raise HTTPError(400, f"missing parameter {name}")
+        return default
+    try:
+        return convert(query[name][0])
+    except ValueError:
+        raise HTTPError(400, f"invalid parameter {name}")
+
+class AmpelServer:
+    """Serves the samples of the data file at path and the latest published sample, see the module docstring.
+    With forecast_path None, /forecast serves an empty curve.
+    publish can be called from any thread, everything else runs in the event loop of start"""
+
+    def __init__(self, path=data_reader.DATA_FILE, forecast_path=data_reader.FORECAST_FILE):
+        self.path = path
+        self.forecast_path = forecast_path
+        self.current = None
+        # increased by every publish, cached responses of older versions are not used
+        self.version = 0
+        # number of responses that were read, all others came from the cache
+        self.reads = 0
+        self.loop = None
+        self._server = None
+        self._cache = {}
+        self._inflight = {}
+        # writers of the open connections by the task that serves them
+        self._connections = {}
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    def publish(self, all_info) -> None:
+        """serves all_info of co2_ampel.get_all_information as the current sample and invalidates the cached responses"""
+        info = to_json_info(all_info)
+        if self.loop is None:
+            self._publish(info)
+        else:
+            self.loop.call_soon_threadsafe(self._publish, info)
+
+    def _publish(self, info):
+        self.current = info
+        self.version += 1
+        self._cache.clear()
+
+    def _current_from_log(self):
+        """the latest sample of the data file, used until the first publish"""
+        from estimator import Sample
+
+        data = data_reader.read_latest_n_points(1, self.path)
+        if not data['time']:
+            raise HTTPError(404, "no sample yet")
+        power = {field: data[field][0] for field in ('onshore', 'offshore', 'solar', 'conv', 'total')}
+        sample = Sample.from_power(datetime.datetime.fromtimestamp(data['time'][0]), power)
+        info = dict.fromkeys(INFO_KEYS)
+        info.update(power=sample.power, power_dist=sample.power_distribution, gpkwh=data['gpkwh'][0], coverage=1.0, time=data['time'][0])
+        return info
+
+    def _read(self, route, query):
+        """returns the content of a response, runs in a worker thread"""
+        if route == '/current':
+            return self.current if self.current is not None else self._current_from_log()
+        if route == '/latest':
+            return data_reader.read_latest_n_points(min(_number(query, 'n', int, 50), MAX_POINTS), self.path)
+        if route == '/range':
+            start, end = _number(query, 'start'), _number(query, 'end')
+            if 'width' not in query:
+                return {'level': 0, 'data': data_reader.read_range(start, end, self.path)}
+            import aggregation
+            level, data = aggregation.read_for_plot(start, end, _number(query, 'width', int), self.path)
+            return {'level': level, 'data': data}
+        if route == '/forecast':
+            if self.forecast_path is None:
+                return data_reader._parse_lines([])
+            return data_reader.read_forecast(self.forecast_path)
+        raise HTTPError(404, f"unknown path {route}")
+
+    async def _render(self, target, version):
+        url = urlparse(target)
+        self.reads += 1
+        content = await self.loop.run_in_executor(None, self._read, url.path, parse_qs(url.query))
+        body = json.dumps(content).encode()
+        response = ('"' + hashlib.sha1(body).hexdigest()[:16] + '"', body)
+        if version == self.version:
+            if len(self._cache) >= MAX_CACHED:
+                self._cache.clear()
+            self._cache[target] = (version, response)
+        return response
+
+    async def _response(self, target):
+        """returns (etag, body) of target from the cache or the running read of it"""
+        cached = self._cache.get(target)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+
+        key = (target, self.version)
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.ensure_future(self._render(target, self.version))
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # a reader that disconnects does not cancel the read of the others
+        return await asyncio.shield(future)
+
+    async def _respond(self, writer, method, target, headers, keep_alive):
+        status, etag, body = 200, None, b""
+        if method not in ('GET', 'HEAD'):
+            status, body = 405, json.dumps({'error': "only GET and HEAD are allowed"}).encode()
+        else:
+            try:
+                etag, body = await self._response(target)
+            except HTTPError as error:
+                status, body = error.status, json.dumps({'error': str(error)}).encode()
+            except Exception as error:
+                logger.exception("request %s failed", target)
+                status, body = 500, json.dumps({'error': repr(error)}).encode()
+
+        if etag is not None and etag in (tag.strip().removeprefix("W/") for tag in headers.get('if-none-match', '').split(',')):
+            status, body = 304, b""
+
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: application/json", f"Content-Length: {len(body)}",
+                 "Cache-Control: no-cache", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        if etag is not None:
+            lines.append(f"ETag: {etag}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        if method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE)
+                except asyncio.TimeoutError:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    break
+
+                method, target, version = parts
+                headers = {}
+                for _ in range(MAX_HEADER_LINES):
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == "HTTP/1.1" and headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, method, target, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def start(self, host="127.0.0.1", port=8080):
+        """starts serving in the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, host, port, backlog=512)
+        return self._server
+
+    async def close(self):
+        """stops accepting connections and closes the open ones. Closing the transport ends the read of
+        an idle connection, so the connections finish instead of being cancelled"""
+        self._server.close()
+        for writer in list(self._connections.values()):
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def stop(self) -> None:
+        """stops a server started by serve and waits for its thread"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+def serve(port=8080, host="127.0.0.1", path=data_reader.DATA_FILE, forecast_path=data_reader.FORECAST_FILE) -> AmpelServer:
+    """starts an AmpelServer in a background thread with its own event loop and returns it, server.stop() stops it"""
+    server = AmpelServer(path, forecast_path)
+    started = threading.Event()
+    errors = []
+
+    def run():
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(server.start(host, port))
+        except Exception as error:
+            errors.append(error)
+            started.set()
+            loop.close()
+            return
+        started.set()
+        try:
+            loop.run_forever()
+            loop.run_until_complete(server.close())
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            loop.close()
+
+    server._thread = threading.Thread(target=run, name="server", daemon=True)
+    server._thread.start()
+    started.wait()
+    if errors:
+        raise errors[0]
+    return server
+
+class AmpelClient:
+    """Reads the samples from an AmpelServer instead of fetching them.
+    Responses are revalidated with their ETag, so an unchanged response is not sent again"""
+
+    # number of responses kept for revalidation, ranges of a moving time span are rarely requested twice
+    MAX_CACHED = 32
+
+    def __init__(self, url, timeout=5):
+        import requests
+
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._responses = {}
+
+    def close(self) -> None:
+        """closes the pooled connections to the server"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get(self, path, **params):
+        key = (path, tuple(sorted(params.items())))
+        cached = self._responses.get(key)
+        headers = {'If-None-Match': cached[0]} if cached is not None else {}
+        res = self.session.get(self.url + path, params=params, headers=headers, timeout=self.timeout)
+        if res.status_code == 304 and cached is not None:
+            return cached[1]
+        res.raise_for_status()
+        content = res.json()
+        if 'ETag' in res.headers:
+            if len(self._responses) >= self.MAX_CACHED:
+                self._responses.clear()
+            self._responses[key] = (res.headers['ETag'], content)
+        return content
+
+    def current(self) -> dict:
+        """returns the /current response, see to_json_info"""
+        return self._get('/current')
+
+    def all_information(self) -> dict:
+        """returns the current sample like co2_ampel.get_all_information"""
+        return from_json_info(self.current())
+
+    def latest(self, n):
+        return self._get('/latest', n=n)
+
+    def range(self, start, end, width=None):
+        """returns (level, data), see aggregation.read_for_plot. Without width the raw samples are returned"""
+        params = {'start': start, 'end': end}
+        if width is not None:
+            params['width'] = width
+        response = self._get('/range', **params)
+        return response['level'], response['data']
+
+    def forecast(self):
+        return self._get('/forecast')
+
+def run_led_client(url, interval=60, ampel_range=(200, 700), stop_event=None):
+    """shows the current sample of the AmpelServer at url on the leds every interval seconds until stop_event is set"""
+    import rgb_controller
+    from util import map_value_clamp
+
+    stop_event = threading.Event() if stop_event is None else stop_event
+    with AmpelClient(url) as client:
+        while not stop_event.is_set():
+            try:
+                info = client.current()
+                rgb_controller.set_ampel(map_value_clamp(info['gpkwh'], *ampel_range, 0, 1), bool(info.get('clean_window_ahead')))
+            except Exception as error:
+                logger.warning("could not read the sample from %s: %r", url, error)
+            stop_event.wait(interval)
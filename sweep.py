@@ -0,0 +1,103 @@
+"""Requests many locations within a fixed latency budget.
+
+A sweep never fails as a whole: every location gets bounded retries with jittered backoff,
+locations that did not answer by the deadline are returned as None and the sweep returns.
+Optionally, requests that are still running after hedge_after seconds are sent a second time
+and the first answer is used."""
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from rate_limiter import RateLimitExceeded
+
+# seconds a whole sweep may take
+DEADLINE = 20
+# additional attempts per location after a failed request
+RETRIES = 2
+# seconds before the first retry, doubled with every attempt and jittered
+BACKOFF = 0.5
+# seconds after which running requests are sent a second time, None disables hedging
+HEDGE_AFTER = None
+
+class SweepError(Exception):
+    """raised if too few locations of a sweep answered"""
+
+def is_valid(weather) -> bool:
+    """returns True if weather is a successful response of the weather api"""
+    return isinstance(weather, dict) and 'wind' in weather and str(weather.get('cod', 200)) == '200'
+
+def _fetch_with_retries(fetch, location, end, retries, backoff, valid=is_valid):
+    for attempt in range(retries + 1):
+        try:
+            weather = fetch(*location)
+            if valid(weather):
+                return weather
+        except RateLimitExceeded:
+            # the budget does not come back within a sweep
+            return None
+        except Exception:
+            pass
+        delay = random.uniform(0, backoff * 2 ** attempt)
+        if attempt == retries or time.monotonic() + delay >= end:
+            break
+        time.sleep(delay)
+    return None
+
+def fetch_all(locations, fetch, max_workers=8, deadline=None, retries=None, backoff=None, hedge_after=None, valid=is_valid):
+    """requests all (lat, lon) locations with fetch(lat, lon) and returns the responses in the same order.
+    Locations without a response that passes valid(response) within deadline seconds are None.
+    deadline, retries, backoff and hedge_after default to DEADLINE, RETRIES, BACKOFF and HEDGE_AFTER"""
+    locations = list(locations)
+    deadline = DEADLINE if deadline is None else deadline
+    retries = RETRIES if retries is None else retries
+    backoff = BACKOFF if backoff is None else backoff
+    hedge_after = HEDGE_AFTER if hedge_after is None else hedge_after
+
+    results = [None] * len(locations)
+    if not locations:
+        return results
+
+    start = time.monotonic()
+    end = start + deadline
+    workers = max(1, min(max_workers, len(locations)))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    # hedges get their own threads, so they don't queue behind the stragglers they are sent for
+    hedge_executor = None
+    try:
+        futures = {executor.submit(_fetch_with_retries, fetch, location, end, retries, backoff, valid): i
+                   for i, location in enumerate(locations)}
+        answered = [False] * len(locations)
+        pending = set(futures)
+        hedged = hedge_after is None
+
+        while pending:
+            now = time.monotonic()
+            if now >= end:
+                break
+            timeout = end - now if hedged else min(end - now, max(start + hedge_after - now, 0))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                weather = future.result()
+                if weather is not None and not answered[i]:
+                    results[i] = weather
+                    answered[i] = True
+            # the other request of a hedged location is not waited for
+            pending = {future for future in pending if not answered[futures[future]]}
+
+            if not hedged and time.monotonic() >= start + hedge_after:
+                hedged = True
+                stragglers = [future for future in pending if future.running()]
+                if stragglers:
+                    hedge_executor = ThreadPoolExecutor(max_workers=min(workers, len(stragglers)))
+                for future in stragglers:
+                    i = futures[future]
+                    hedge = hedge_executor.submit(_fetch_with_retries, fetch, locations[i], end, 0, backoff, valid)
+                    futures[hedge] = i
+                    pending.add(hedge)
+    finally:
+        # stragglers finish in the background, their responses are dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+        if hedge_executor is not None:
+            hedge_executor.shutdown(wait=False, cancel_futures=True)
+    return results
@@ -1,8 +1,38 @@
 from datetime import datetime, time
+import os
+import tempfile
+import threading
+from time import monotonic, sleep
 import unittest
+from unittest import mock
+
+import numpy as np
 
 import util
+import aggregation
+import benchmarks
+from acquisition import AcquisitionWorker
+import binary_log
+import data_reader
+import precise_wind
+import sweep
+from grid_index import GridIndex
+from adaptive_scheduler import AdaptiveScheduler
+from weather_cache import WeatherCache
+from fake_openweather import FakeOpenWeather, forecast_at, weather_at
+import forecast
+import server
+import region
+import co2_ampel
+import metrics
+from rate_limiter import PRIORITY_HIGH, PRIORITY_LOW, RateLimitExceeded, RateLimiter
 from co2_ampel import estimate_needed_power
+from estimator import estimate_solar_power_from_cloud_factor, solar_cloud_factor
+
+
+def fake_weather_data(lat, lon):
+    """deterministic stand-in for util.request_weather_data"""
+    return {'wind': {'speed': (lat * 7 + lon * 3) % 13}, 'clouds': {'all': int(lat + lon) % 100}}
 
 class Test(unittest.TestCase):
 
@@ -21,4 +51,822 @@ class Test(unittest.TestCase):
         self.assertEqual(estimate_needed_power(time(12), 60, 20), 70)
         self.assertEqual(estimate_needed_power(time(0), 60, 20), 50)
 
+    @mock.patch('precise_wind.request_park_weather_data', fake_weather_data)
+    def test_concurrent_wind_speeds_match_sequential(self):
+        sequential = precise_wind.request_wind_speeds(precise_wind.ONSHORE_WINDPARK_DICT, max_workers=1)
+        concurrent = precise_wind.request_wind_speeds(precise_wind.ONSHORE_WINDPARK_DICT, max_workers=8)
+        self.assertEqual(list(sequential.items()), list(concurrent.items()))
+
+    @mock.patch('precise_wind.request_park_weather_data', fake_weather_data)
+    def test_estimate_wind_power_precise(self):
+        onshore, offshore = precise_wind.estimate_wind_power_precise()
+        self.assertEqual(onshore, precise_wind.estimate_onshore_wind_power_precise())
+        self.assertEqual(offshore, precise_wind.estimate_offshore_wind_power_precise())
+
+    def test_request_weather_data_with_stand_in_server(self):
+        latencies = []
+        with FakeOpenWeather(update_interval=10**10) as server, mock.patch('util.API_URL', server.url), \
+                mock.patch('util.KEY', 'test'), mock.patch('util.latency_listeners', [lambda *a: latencies.append(a)]):
+            util.close_session()
+            try:
+                self.assertEqual(util.request_weather_data(53.5, 8.1, use_cache=False), weather_at(53.5, 8.1, 0))
+                self.assertEqual(util.request_weather_data(54.3, 6.24, use_cache=False), weather_at(54.3, 6.24, 0))
+            finally:
+                util.close_session()
+        self.assertEqual([(lat, lon) for lat, lon, _ in latencies], [(53.5, 8.1), (54.3, 6.24)])
+        self.assertEqual(server.request_count, 2)
+
+    def test_stand_in_server_errors(self):
+        with FakeOpenWeather(error_rate=1) as server, mock.patch('util.API_URL', server.url), mock.patch('util.KEY', 'test'):
+            util.close_session()
+            try:
+                self.assertEqual(util.request_weather_data(53.5, 8.1, use_cache=False)['cod'], 500)
+            finally:
+                util.close_session()
+
+    def test_weather_cache_ttl_and_lru(self):
+        cache = WeatherCache(ttl=600, min_ttl=60, max_entries=2)
+        cache.put(53.5, 8.1, {'dt': 1000}, now=1000)
+        self.assertEqual(cache.get(53.5, 8.1, now=1599), {'dt': 1000})
+        self.assertIsNone(cache.get(53.5, 8.1, now=1600))
+
+        cache.put(54.3, 6.24, {'dt': 1000}, now=1000)
+        cache.get(53.5, 8.1, now=1001)
+        cache.put(55.11, 6.51, {'dt': 1000}, now=1000)
+        self.assertIsNone(cache.get(54.3, 6.24, now=1001))
+        self.assertIsNotNone(cache.get(53.5, 8.1, now=1001))
+
+    def test_weather_cache_persists(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            cache = WeatherCache(path)
+            weather = fake_weather_data(53.5, 8.1)
+            weather['dt'] = datetime.now().timestamp()
+            cache.put(53.5, 8.1, weather)
+            cache.close()
+
+            cache = WeatherCache(path)
+            self.assertEqual(cache.get(53.5, 8.1), weather)
+            cache.close()
+
+    def test_adaptive_scheduler(self):
+        observations = {'dt': 1000}
+        requests = []
+        def fetch(lat, lon):
+            requests.append((lat, lon))
+            return dict(observations)
+
+        scheduler = AdaptiveScheduler(fetch, default_interval=600, min_delay=60, grace=30, max_workers=1)
+        self.assertTrue(scheduler.refresh([(1, 2)], now=1000))
+        # fresh until the predicted next observation
+        self.assertFalse(scheduler.refresh([(1, 2)], now=1300))
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(scheduler.next_delay(now=1300), 330)
+
+        # unchanged observation after the predicted time backs off
+        self.assertFalse(scheduler.refresh([(1, 2)], now=1700))
+        self.assertEqual(scheduler.next_delay(now=1700), 60)
+        self.assertFalse(scheduler.refresh([(1, 2)], now=1760))
+        self.assertEqual(scheduler.next_delay(now=1760), 120)
+
+        observations['dt'] = 1800
+        self.assertTrue(scheduler.refresh([(1, 2)], now=1880))
+        self.assertEqual(scheduler.get(1, 2), {'dt': 1800})
+        self.assertEqual(len(requests), 4)
+
+    def test_vectorized_average_weighted_wind_speed(self):
+        parks = precise_wind.OFFSHORE_WINDPARK_DICT
+        wind_speeds = {location: fake_weather_data(*location)['wind']['speed'] for location in parks}
+
+        average_power = sum(parks.values()) / len(parks)
+        expected = sum(wind_speeds[location] * parks[location] / average_power for location in parks) / len(parks)
+
+        self.assertAlmostEqual(precise_wind.calculate_average_weighted_wind_speed(parks, wind_speeds), expected)
+        self.assertAlmostEqual(precise_wind.calculate_average_weighted_wind_speed(dict(parks), wind_speeds), expected)
+
+    def test_estimate_batch_matches_scalar(self):
+        times = [datetime(2022, month, 1 + month, (month * 5) % 24, month * 4) for month in range(1, 13)]
+        onshore_wind = [0.5 * month for month in range(1, 13)]
+        offshore_wind = [1.3 * month for month in range(1, 13)]
+        cloudiness = [8 * month for month in range(1, 13)]
+
+        batch = co2_ampel.estimate_batch(times, onshore_wind, offshore_wind, cloudiness)
+
+        for i, t in enumerate(times):
+            onshore = co2_ampel.estimate_onshore_wind_power(onshore_wind[i])
+            offshore = co2_ampel.estimate_offshore_wind_power(offshore_wind[i])
+            solar = co2_ampel.estimate_solar_power(t, cloudiness[i])
+            total = estimate_needed_power(t)
+            conv = util.force_non_negative(total - onshore - offshore - solar)
+            for name, value in (('onshore', onshore), ('offshore', offshore), ('solar', solar), ('total', total), ('conv', conv)):
+                self.assertAlmostEqual(batch[name][i], value, msg=name)
+            self.assertAlmostEqual(batch['gpkwh'][i], conv / total * 800)
+
+    def test_read_latest_n_points(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            lines = [f"2022-01-26 07:{i // 60:02d}:{i % 60:02d}.000001,{i},1.5,2,3,4,500" for i in range(600)]
+            with open(path, "w") as f:
+                f.write('\n'.join(lines) + '\n')
+
+            with mock.patch('data_reader.BLOCK_SIZE', 64):
+                data = data_reader.read_latest_n_points(50, path)
+                self.assertEqual(data['onshore'], [float(i) for i in range(550, 600)])
+                self.assertEqual(len(data_reader.read_latest_n_points(1000, path)['time']), 600)
+                self.assertEqual(data_reader.read_latest_n_points(0, path)['time'], [])
+
+    def test_binary_log_roundtrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "data.csv")
+            binary_path = os.path.join(directory, "data.bin")
+            with open(csv_path, "w") as f:
+                for i in range(20):
+                    f.write(f"2022-01-26 07:00:{i:02d}.250000,{i},1.5,2,3,4,500\n")
+
+            self.assertEqual(binary_log.convert_csv_to_binary(csv_path, binary_path, chunk_size=7), 20)
+            binary_log.append(1643200000.5, {'onshore': 20, 'offshore': 1, 'solar': 2, 'conv': 3, 'total': 4}, 600, binary_path)
+
+            data = binary_log.read_latest_n_points(5, binary_path)
+            self.assertEqual(data['onshore'].tolist(), [16, 17, 18, 19, 20])
+            self.assertEqual(data['gpkwh'][-1], 600)
+
+            binary_log.export_to_csv(binary_path, csv_path)
+            self.assertEqual(data_reader.read_latest_n_points(21, csv_path)['onshore'], [float(i) for i in range(21)])
+
+    def test_binary_storage_is_not_served(self):
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            co2_ampel.main(['--storage', 'binary', '--serve-port', '8080'])
+
+    def test_partitions_and_read_range(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            for day in (26, 27, 28):
+                for hour in range(0, 24, 2):
+                    data_reader.append_sample(datetime(2022, 1, day, hour, 30, 0, 1), (day, hour, 2, 3, 4, 500), path)
+
+            self.assertEqual([os.path.basename(p) for p in data_reader.list_partitions(path)],
+                             ["data-2022-01-26.csv", "data-2022-01-27.csv", "data.csv"])
+
+            data = data_reader.read_range(datetime(2022, 1, 26, 21), datetime(2022, 1, 27, 4, 30, 0, 1), path)
+            self.assertEqual(list(zip(data['onshore'], data['offshore'])), [(26, 22), (27, 0), (27, 2), (27, 4)])
+            self.assertEqual(data_reader.read_range(datetime(2022, 1, 28, 23), datetime(2022, 1, 29), path)['time'], [])
+
+            self.assertEqual(data_reader.read_latest_n_points(14, path)['onshore'], [27.0] * 2 + [28.0] * 12)
+
+            archive = data_reader.archive_data(path, os.path.join(directory, "archive"))
+            self.assertEqual(data_reader.list_partitions(path), [])
+            self.assertEqual(len(os.listdir(archive)), 3)
+
+    def test_aggregation_levels(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            def add(minute, value):
+                time = datetime(2022, 1, 26, 7, minute, 0, 1)
+                data_reader.append_sample(time, (value, 1, 2, 3, 4, 100 * value), path)
+                aggregation.add_sample(time, (value, 1, 2, 3, 4, 100 * value), path)
+
+            for minute, value in ((1, 1), (5, 3), (12, 5), (15, 2)):
+                add(minute, value)
+            aggregation.reset(path)
+            add(25, 4)
+
+            data = aggregation.read_aggregated(600, datetime(2022, 1, 26), datetime(2022, 1, 27), path)
+            self.assertEqual(data['count'], [2, 2, 1])
+            self.assertEqual(data['onshore'], [2, 3.5, 4])
+            self.assertEqual(data['gpkwh_min'], [100, 200, 400])
+            self.assertEqual(data['gpkwh_max'], [300, 500, 400])
+            self.assertEqual(aggregation.read_aggregated(3600, datetime(2022, 1, 26), datetime(2022, 1, 27), path)['count'], [5])
+            aggregation.reset(path)
+
+    def test_choose_level(self):
+        self.assertEqual(aggregation.choose_level(60 * 60 * 10, 800), 0)
+        self.assertEqual(aggregation.choose_level(60 * 60 * 24 * 7, 800), 3600)
+        self.assertEqual(aggregation.choose_level(60 * 60 * 24 * 365 * 10, 800), 86400)
+
+    def test_acquisition_worker(self):
+        def fetch(lat, lon):
+            weather = fake_weather_data(lat, lon)
+            weather['dt'] = 1000
+            return weather
+
+        with mock.patch('acquisition.write_to_file') as write_to_file, mock.patch('acquisition.set_ampel') as set_ampel:
+            worker = AcquisitionWorker(AdaptiveScheduler(fetch))
+            try:
+                self.assertTrue(worker.submit(use_precise=False))
+                result = worker.results.get(timeout=5)
+                self.assertEqual(result.kind, 'sample')
+                self.assertEqual(result.generation, worker.generation)
+                write_to_file.assert_called_once_with(result.data['sample'])
+                set_ampel.assert_called_once()
+
+                while worker.busy:
+                    threading.Event().wait(0.01)
+                self.assertTrue(worker.submit(use_precise=False))
+                self.assertEqual(worker.results.get(timeout=5).kind, 'unchanged')
+            finally:
+                worker.stop()
+
+    def test_acquisition_worker_keeps_the_sample_of_a_cancelled_run(self):
+        fetching, release = threading.Event(), threading.Event()
+        def fetch(lat, lon):
+            fetching.set()
+            release.wait(5)
+            weather = fake_weather_data(lat, lon)
+            weather['dt'] = 1000
+            return weather
+
+        with mock.patch('acquisition.write_to_file') as write_to_file, mock.patch('acquisition.set_ampel') as set_ampel:
+            worker = AcquisitionWorker(AdaptiveScheduler(fetch, max_workers=1))
+            try:
+                self.assertTrue(worker.submit(use_precise=False))
+                self.assertTrue(fetching.wait(5))
+                # e.g. a new delta time or stop and start while the fetch is running
+                worker.cancel()
+                self.assertTrue(worker.submit(use_precise=False))
+                self.assertFalse(worker.submit(use_precise=False))
+                release.set()
+
+                result = worker.results.get(timeout=5)
+                self.assertEqual((result.kind, result.generation), ('sample', worker.generation))
+                write_to_file.assert_called_once_with(result.data['sample'])
+                set_ampel.assert_called_once()
+                self.assertTrue(worker.results.empty())
+            finally:
+                worker.stop()
+
+    def test_seconds_until_boundary(self):
+        self.assertEqual(co2_ampel.seconds_until_boundary(600, now=1000), 200)
+        self.assertEqual(co2_ampel.seconds_until_boundary(600, now=1200), 600)
+
+    def test_run_daemon_survives_failed_cycles(self):
+        stop_event = threading.Event()
+        cycles = []
+        def run_cycle(*args):
+            cycles.append(args)
+            if len(cycles) == 1:
+                raise ValueError("failed cycle")
+            stop_event.set()
+
+        with mock.patch('co2_ampel.run_cycle', run_cycle), mock.patch('co2_ampel.seconds_until_boundary', lambda interval: 0):
+            co2_ampel.run_daemon(stop_event=stop_event)
+        self.assertEqual(len(cycles), 2)
+
+    def test_run_daemon_passes_sweep_options_to_scheduler(self):
+        stop_event = threading.Event()
+        schedulers = []
+        def run_cycle(scheduler, *args):
+            schedulers.append(scheduler)
+            stop_event.set()
+
+        with mock.patch('co2_ampel.run_cycle', run_cycle), mock.patch('co2_ampel.seconds_until_boundary', lambda interval: 0):
+            co2_ampel.run_daemon(stop_event=stop_event, sweep_deadline=5, hedge_after=2)
+        self.assertEqual((schedulers[0].sweep_deadline, schedulers[0].hedge_after), (5, 2))
+
+    def test_run_cycle(self):
+        def fetch(lat, lon):
+            weather = fake_weather_data(lat, lon)
+            weather['dt'] = 1000
+            return weather
+
+        stored = []
+        with mock.patch('rgb_controller.set_ampel') as set_ampel:
+            all_info = co2_ampel.run_cycle(AdaptiveScheduler(fetch), use_precise=False, store=stored.append)
+        self.assertEqual(stored, [all_info['sample']])
+        set_ampel.assert_called_once()
+
+    def test_run_cycle_does_not_retry_missing_parks(self):
+        parks = precise_wind.sweep_locations()
+        def sweep_fetch(lat, lon):
+            if parks.index((lat, lon)) % 2:
+                raise RateLimitExceeded()
+            return weather_at(lat, lon, datetime.now().timestamp())
+
+        scheduler = AdaptiveScheduler(lambda lat, lon: weather_at(lat, lon, datetime.now().timestamp()), sweep_fetch=sweep_fetch)
+        start = monotonic()
+        with mock.patch('rgb_controller.set_ampel'):
+            all_info = co2_ampel.run_cycle(scheduler, use_precise=True, store=lambda sample: None)
+        # the parks the scheduler has no weather for are read once, without the backoff of the retries
+        self.assertLess(monotonic() - start, 1)
+        self.assertLess(all_info['coverage'], 1)
+
+    def test_startup_loads_no_heavy_modules(self):
+        for module, forbidden in benchmarks.STARTUP_MODULES.items():
+            _, loaded = benchmarks.measure_import(module)
+            self.assertEqual(set(forbidden) & loaded, set(), module)
+
+    def test_sample(self):
+        power = {'onshore': 10, 'offshore': 5, 'solar': 5, 'conv': 30, 'total': 50}
+        sample = co2_ampel.Sample.from_power(datetime(2022, 1, 26, 12), power)
+        self.assertEqual(sample.power, power)
+        self.assertEqual(sample.power_distribution, co2_ampel.estimate_power_distribution(power))
+        self.assertEqual(sample.gpkwh, co2_ampel.calculate_gCO2_per_kWh(sample.power_distribution, log=False))
+        self.assertEqual(sample.values(), (10, 5, 5, 30, 50, 480))
+
+    def test_get_all_information(self):
+        all_info = co2_ampel.get_all_information(fetch=fake_weather_data)
+        sample = all_info['sample']
+        self.assertEqual(all_info['power'], sample.power)
+        self.assertEqual(all_info['gpkwh'], sample.gpkwh)
+        self.assertEqual(sample.cloudiness, all_info['cloudiness'])
+        self.assertEqual(sample.holtriem_wind, all_info['holtriem_wind'])
+
+    def test_bench_end_to_end(self):
+        results = benchmarks.bench_end_to_end(repeat=1, latency=0, jitter=0)
+        self.assertEqual(results['normal']['requests_per_run'], 3)
+        self.assertEqual(results['precise']['requests_per_run'], 1 + len(precise_wind.ALL_PARKS))
+        self.assertEqual(results['precise']['failures'], 0)
+
+    def test_metrics(self):
+        metrics.reset()
+        with metrics.timed('store'):
+            metrics.inc('api_calls_total')
+        self.assertEqual(metrics.snapshot(), {'counters': {}, 'histograms': {}})
+
+        metrics.enable()
+        try:
+            with metrics.timed('store'):
+                pass
+            metrics.observe('stage_seconds', 0.3, stage='store')
+            metrics.inc('api_errors_total', reason='500')
+            snapshot = metrics.snapshot()
+            text = metrics.render()
+        finally:
+            metrics.disable()
+            metrics.reset()
+        store = snapshot['histograms']['stage_seconds'][(('stage', 'store'),)]
+        self.assertEqual(store['count'], 2)
+        self.assertEqual(store['buckets'][0.5], 1)
+        self.assertIn('co2ampel_stage_seconds_bucket{stage="store",le="+Inf"} 2', text)
+        self.assertIn('co2ampel_api_errors_total{reason="500"} 1', text)
+
+    def test_run_cycle_records_stages(self):
+        metrics.enable()
+        try:
+            with mock.patch('rgb_controller.set_ampel'):
+                co2_ampel.run_cycle(AdaptiveScheduler(lambda lat, lon: weather_at(lat, lon, 1000)), store=lambda sample: None)
+            histograms = metrics.snapshot()['histograms']
+        finally:
+            metrics.disable()
+            metrics.reset()
+        self.assertEqual({labels[0][1] for labels in histograms['stage_seconds']}, {'cycle', 'fetch', 'read', 'estimate', 'store'})
+        # the requests of the scheduler are the only fetch of the cycle
+        self.assertEqual(histograms['stage_seconds'][(('stage', 'fetch'),)]['count'], 1)
+        self.assertEqual(histograms['sample_lag_seconds'][()]['count'], 1)
+
+    def test_rate_limiter(self):
+        now = [0]
+        limiter = RateLimiter(per_minute=5, per_day=100, minute_reserve=2, day_reserve=0, max_wait=0, clock=lambda: now[0])
+        self.assertEqual(sum(limiter.try_acquire(PRIORITY_LOW) for _ in range(5)), 3)
+        self.assertEqual(sum(limiter.try_acquire(PRIORITY_HIGH) for _ in range(5)), 2)
+        self.assertRaises(RateLimitExceeded, limiter.acquire, PRIORITY_HIGH)
+        self.assertEqual(limiter.remaining(), {'minute': 0, 'day': 95})
+        now[0] = 60
+        self.assertEqual(limiter.remaining()['minute'], 5)
+
+    def test_scheduler_spreads_sweep_over_cycles(self):
+        limiter = RateLimiter(per_minute=4, minute_reserve=0, clock=lambda: 0)
+        def sweep_fetch(lat, lon):
+            limiter.acquire(PRIORITY_LOW)
+            return weather_at(lat, lon, 1000)
+
+        parks = [(50, 8 + i) for i in range(6)]
+        scheduler = AdaptiveScheduler(lambda lat, lon: weather_at(lat, lon, 1000), sweep_fetch=sweep_fetch, max_workers=1)
+        self.assertTrue(scheduler.refresh([(53, 8)] + parks, now=0, sweep=parks))
+        self.assertEqual([scheduler.is_stale(*park, now=0) for park in parks], [False] * 4 + [True] * 2)
+        self.assertIsNone(scheduler.get(*parks[-1]))
+
+        limiter.minute.tokens = 2
+        self.assertTrue(scheduler.refresh([(53, 8)] + parks, now=0, sweep=parks))
+        self.assertFalse(any(scheduler.is_stale(*park, now=0) for park in parks))
+
+    def test_weighted_average_skips_missing_parks(self):
+        parks = precise_wind.ParkTable({(50, 8): 1, (51, 8): 3, (52, 8): 4})
+        self.assertAlmostEqual(parks.weighted_average(np.array([2.0, np.nan, 5.0])), (2 + 4 * 5) / 5)
+
+    def test_sweep_retries_and_deadline(self):
+        calls = {}
+        def fetch(lat, lon):
+            calls[lat] = calls.get(lat, 0) + 1
+            if lat == 3:
+                sleep(1)
+            if lat == 1 and calls[lat] == 1:
+                raise ConnectionError()
+            if lat == 2:
+                return {'cod': 500, 'message': 'internal error'}
+            return fake_weather_data(lat, lon)
+
+        start = monotonic()
+        results = sweep.fetch_all([(0, 8), (1, 8), (2, 8), (3, 8)], fetch, deadline=0.3, retries=2, backoff=0.01)
+        self.assertLess(monotonic() - start, 0.6)
+        self.assertEqual(results, [fake_weather_data(0, 8), fake_weather_data(1, 8), None, None])
+        self.assertEqual(calls[1], 2)
+        self.assertEqual(calls[2], 3)
+
+    def test_sweep_hedges_stragglers(self):
+        calls = []
+        def fetch(lat, lon):
+            calls.append(lat)
+            if len(calls) == 1:
+                sleep(1)
+            return fake_weather_data(lat, lon)
+
+        start = monotonic()
+        self.assertEqual(sweep.fetch_all([(0, 8)], fetch, deadline=0.5, hedge_after=0.05), [fake_weather_data(0, 8)])
+        self.assertLess(monotonic() - start, 0.4)
+
+    def test_sweep_falls_back_to_last_known(self):
+        parks = precise_wind.ParkTable({(60.1, 8): 1, (60.2, 8): 3})
+        first = precise_wind.sweep_wind_speeds(parks, fetch=fake_weather_data)
+        self.assertEqual(first.coverage, 1)
+
+        def fetch(lat, lon):
+            return None if lat == 60.2 else {'wind': {'speed': 1.0}}
+
+        with mock.patch('sweep.BACKOFF', 0):
+            second = precise_wind.sweep_wind_speeds(parks, fetch=fetch)
+        self.assertEqual(second.coverage, 0.25)
+        self.assertEqual(second.wind_speeds.tolist(), [1.0, first.wind_speeds[1]])
+
+    def test_grid_index(self):
+        grid = GridIndex([(54.31, 6.21), (54.29, 6.19), (54.0, 7.0), (55.0, 8.0)], weights=[1, 1, 5, 1], resolution=0.1, max_cells=2)
+        self.assertEqual(grid.locations, [(54.0, 7.0), (54.3, 6.2)])
+        values = grid.interpolate(np.array([4.0, 8.0]))
+        self.assertEqual(values[:3].tolist(), [8.0, 8.0, 4.0])
+        self.assertTrue(4.0 < values[3] < 8.0)
+        # parks in a cell without a value have no value, interpolated parks use the remaining cells
+        self.assertEqual(np.isnan(grid.interpolate(np.array([4.0, np.nan]))).tolist(), [True, True, False, False])
+        self.assertEqual(grid.interpolate(np.array([4.0, np.nan]))[3], 4.0)
+
+    def test_precise_mode_on_grid(self):
+        calls = []
+        def fetch(lat, lon):
+            calls.append((lat, lon))
+            return fake_weather_data(lat, lon)
+
+        try:
+            grid = precise_wind.enable_grid(resolution=0.5, max_calls=20)
+            result = precise_wind.sweep_all_wind_speeds(fetch=fetch)
+        finally:
+            precise_wind.disable_grid()
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(sorted(calls), sorted(grid.locations))
+        self.assertEqual(len(result.wind_speeds), len(precise_wind.ALL_PARKS))
+        self.assertFalse(np.isnan(result.wind_speeds).any())
+        self.assertEqual(result.coverage, 1)
+
+    def test_load_park_registry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "parks.csv")
+            with open(path, 'w') as f:
+                f.write("lat,lon,capacity,kind\n53.5,8.1,3,onshore\n53.5,8.1,2,onshore\n54.3,6.2,5,offshore\n")
+            parks = precise_wind.load_park_registry(path)
+        self.assertEqual(parks['onshore'].locations, [(53.5, 8.1)])
+        self.assertEqual(parks['onshore'].capacities.tolist(), [5])
+        self.assertEqual(parks['offshore'].locations, [(54.3, 6.2)])
+
+        # an onshore and an offshore park at the same location stay two parks
+        offshore = precise_wind.ParkTable({(53.5, 8.1): 1, (54.3, 6.2): 1})
+        combined = precise_wind.combine_parks(parks['onshore'], offshore)
+        self.assertEqual(combined.capacities.tolist(), [5, 1, 1])
+        result = precise_wind.sweep_parks(combined, 1, fetch=fake_weather_data)
+        self.assertEqual([len(speeds) for speeds in result.split(1)], [1, 2])
+        self.assertFalse(np.isnan(offshore.weighted_average(result.split(1)[1])))
+
+    def test_precise_solar_from_windpark_responses(self):
+        date = datetime(2022, 6, 1, 12)
+        onshore = len(precise_wind.ONSHORE_PARKS)
+        result = precise_wind.SweepResult(precise_wind.ALL_PARKS.locations, np.zeros(len(precise_wind.ALL_PARKS)),
+                                          np.ones(len(precise_wind.ALL_PARKS), dtype=bool), precise_wind.ALL_PARKS.weights,
+                                          np.array([80.0] * onshore + [0.0] * (len(precise_wind.ALL_PARKS) - onshore)))
+        self.assertAlmostEqual(precise_wind.estimate_solar_power_precise(date, result), co2_ampel.estimate_solar_power(date, 80))
+
+        # all capacity at a site next to a park with clear sky
+        clear_park = precise_wind.ONSHORE_PARKS.locations[0]
+        result.cloudiness[0] = 0
+        try:
+            precise_wind.use_solar_sites(precise_wind.ParkTable({(clear_park[0] + 0.001, clear_park[1]): 100}))
+            solar = precise_wind.estimate_solar_power_precise(date, result)
+        finally:
+            precise_wind.use_solar_sites(None)
+        self.assertAlmostEqual(solar, co2_ampel.estimate_solar_power(date, 0), places=3)
+
+    def test_solar_cloud_factor_of_arrays(self):
+        cloudiness = np.array([0, 50, 90, 100, np.nan])
+        factors = solar_cloud_factor(cloudiness)
+        self.assertEqual(factors[:4].tolist(), [solar_cloud_factor(value) for value in (0, 50, 90, 100)])
+        self.assertTrue(np.isnan(factors[4]))
+
+    def test_precise_solar_needs_no_extra_calls(self):
+        calls = []
+        def fetch(lat, lon):
+            calls.append((lat, lon))
+            return fake_weather_data(lat, lon)
+
+        sample = co2_ampel.get_all_information(use_precise=True, fetch=fetch)['sample']
+        self.assertEqual(len(calls), 1 + len(precise_wind.ALL_PARKS))
+        clouds = np.array([fake_weather_data(*location)['clouds']['all'] for location in precise_wind.ONSHORE_PARKS.locations])
+        cloud_factor = np.clip(1.6 - clouds / 100, 0, 1).mean()
+        self.assertAlmostEqual(sample.solar, estimate_solar_power_from_cloud_factor(sample.time, cloud_factor))
+        # the sample holds the cloudiness of the parks, not of Oldenburg
+        self.assertAlmostEqual(sample.cloudiness, clouds.mean())
+
+    def test_forecast_with_stand_in_server(self):
+        forecast.CACHE.clear()
+        with FakeOpenWeather() as server, mock.patch('util.API_URL', server.url), mock.patch('util.KEY', 'test'):
+            util.close_session()
+            try:
+                now = server.observation_time()
+                curve = forecast.estimate_forecast(48, now=now)
+                # every forecast is requested once and reused until the next update
+                forecast.estimate_forecast(48, now=now)
+            finally:
+                util.close_session()
+                forecast.CACHE.clear()
+        self.assertEqual(server.request_count, 3)
+        self.assertEqual(len(curve['time']), 16)
+
+        steps = {name: forecast_at(*location, now)['list'][:16] for name, location in
+                 (('onshore', (util.HOLTRIEM_LAT, util.HOLTRIEM_LON)), ('offshore', (util.BOR_WIN_LAT, util.BOR_WIN_LON)),
+                  ('solar', (util.OLDENBURG_LAT, util.OLDENBURG_LON)))}
+        expected = co2_ampel.estimate_batch([datetime.fromtimestamp(step['dt']) for step in steps['solar']],
+                                            [step['wind']['speed'] for step in steps['onshore']],
+                                            [step['wind']['speed'] for step in steps['offshore']],
+                                            [step['clouds']['all'] for step in steps['solar']])
+        np.testing.assert_allclose(curve['gpkwh'], expected['gpkwh'])
+
+    def test_forecast_cache_and_precise_forecast(self):
+        clock = [3 * 3600 * 10 + 700]
+        cache = forecast.ForecastCache(clock=lambda: clock[0])
+        cache.put(53.5, 8.1, {'list': []})
+        clock[0] = 3 * 3600 * 11 + 599
+        self.assertEqual(cache.get(53.5, 8.1), {'list': []})
+        clock[0] += 1
+        self.assertIsNone(cache.get(53.5, 8.1))
+
+        calls = []
+        def fetch(lat, lon):
+            calls.append((lat, lon))
+            return forecast_at(lat, lon, 0)
+
+        forecast.CACHE.clear()
+        try:
+            curve = forecast.estimate_forecast(24, use_precise=True, fetch=fetch, now=0)
+        finally:
+            forecast.CACHE.clear()
+        self.assertEqual(len(calls), 1 + len(precise_wind.ALL_PARKS))
+        self.assertEqual(len(curve['gpkwh']), 8)
+        self.assertFalse(np.isnan(curve['gpkwh']).any())
+
+    def test_cleanest_window_and_stored_forecast(self):
+        step = forecast.STEP
+        curve = {field: np.full(6, 500.0) for field in data_reader.FIELDS}
+        curve['time'] = np.arange(6) * step + 1_600_000_000
+        curve['gpkwh'] = np.array([500, 450, 200, 150, 400, 500], dtype=float)
+        self.assertEqual(forecast.cleanest_window(curve, 6), (curve['time'][2], curve['time'][3] + step, 175))
+        self.assertTrue(forecast.clean_window_ahead(curve, 400, within=12, now=curve['time'][0]))
+        self.assertFalse(forecast.clean_window_ahead(curve, 400, within=3, now=curve['time'][0]))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "forecast.csv")
+            self.assertEqual(data_reader.read_forecast(path)['time'], [])
+            data_reader.write_forecast(curve, path)
+            stored = data_reader.read_forecast(path)
+        np.testing.assert_allclose(stored['time'], curve['time'])
+        np.testing.assert_allclose(stored['gpkwh'], curve['gpkwh'])
+
+    def test_server_endpoints_and_etags(self):
+        import requests
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            for minute in range(10):
+                data_reader.append_sample(datetime(2022, 1, 26, 12, minute), (1, 2, 3, 4, 10, 320 + minute), path)
+            ampel_server = server.serve(0, path=path, forecast_path=os.path.join(directory, "forecast.csv"))
+            url = f"http://127.0.0.1:{ampel_server.port}"
+            try:
+                with server.AmpelClient(url) as client:
+                    # the data file is served until the first publish
+                    self.assertEqual(client.current()['gpkwh'], 329)
+                    self.assertEqual(client.latest(3)['gpkwh'], [327, 328, 329])
+                    level, data = client.range(datetime(2022, 1, 26, 12, 2).timestamp(), datetime(2022, 1, 26, 12, 4).timestamp())
+                    self.assertEqual((level, data['gpkwh']), (0, [322, 323, 324]))
+                    self.assertEqual(client.forecast()['time'], [])
+
+                    res = requests.get(url + "/current")
+                    self.assertEqual(requests.get(url + "/current", headers={'If-None-Match': res.headers['ETag']}).status_code, 304)
+                    self.assertEqual(requests.get(url + "/latest?n=x").status_code, 400)
+                    self.assertEqual(requests.get(url + "/unknown").status_code, 404)
+
+                    power = {'onshore': 10, 'offshore': 5, 'solar': 5, 'conv': 30, 'total': 50}
+                    sample = co2_ampel.Sample.from_power(datetime(2022, 1, 26, 12, 10), power)
+                    ampel_server.publish({'sample': sample, 'power': sample.power, 'power_dist': sample.power_distribution,
+                                          'gpkwh': sample.gpkwh, 'coverage': 1.0, 'clean_window_ahead': True})
+                    deadline = monotonic() + 5
+                    while ampel_server.version == 0 and monotonic() < deadline:
+                        sleep(0.01)
+                    all_info = client.all_information()
+                    self.assertEqual(all_info['sample'].gpkwh, sample.gpkwh)
+                    self.assertTrue(all_info['clean_window_ahead'])
+                    self.assertEqual(requests.get(url + "/current", headers={'If-None-Match': res.headers['ETag']}).status_code, 200)
+            finally:
+                ampel_server.stop()
+
+    def test_server_closes_idle_connections(self):
+        import requests
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            data_reader.append_sample(datetime(2022, 1, 26, 12), (1, 2, 3, 4, 10, 320), path)
+            ampel_server = server.serve(0, path=path)
+            with requests.Session() as session:
+                # the session keeps the connection open, the server closes it on stop
+                self.assertEqual(session.get(f"http://127.0.0.1:{ampel_server.port}/current", timeout=5).status_code, 200)
+                with self.assertNoLogs('asyncio', level='ERROR'):
+                    ampel_server.stop()
+        self.assertEqual(ampel_server._connections, {})
+
+    def test_server_shares_reads_between_readers(self):
+        from concurrent.futures import ThreadPoolExecutor
+        import requests
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.csv")
+            for minute in range(60):
+                data_reader.append_sample(datetime(2022, 1, 26, 12, minute), (1, 2, 3, 4, 10, 300), path)
+            ampel_server = server.serve(0, path=path)
+            url = f"http://127.0.0.1:{ampel_server.port}/latest?n=60"
+            try:
+                with ThreadPoolExecutor(max_workers=50) as executor:
+                    responses = list(executor.map(lambda _: requests.get(url, timeout=5), range(200)))
+            finally:
+                ampel_server.stop()
+        self.assertTrue(all(res.status_code == 200 for res in responses))
+        self.assertEqual(len({res.content for res in responses}), 1)
+        self.assertEqual(ampel_server.reads, 1)
+
+    def test_acquisition_worker_reads_from_client(self):
+        power = {'onshore': 10, 'offshore': 5, 'solar': 5, 'conv': 30, 'total': 50}
+        sample = co2_ampel.Sample.from_power(datetime(2022, 1, 26, 12), power)
+        client = mock.Mock()
+        client.all_information.return_value = server.from_json_info(server.to_json_info(
+            {'sample': sample, 'power': sample.power, 'gpkwh': sample.gpkwh}))
+        client.forecast.return_value = {'time': [1643200000], 'gpkwh': [300]}
+
+        with mock.patch('acquisition.set_ampel') as set_ampel:
+            worker = AcquisitionWorker(AdaptiveScheduler(lambda lat, lon: self.fail("fetched")), forecast_hours=48, client=client)
+            try:
+                self.assertTrue(worker.submit())
+                result = worker.results.get(timeout=5)
+                self.assertEqual(result.kind, 'sample')
+                self.assertEqual(result.data['sample'].gpkwh, sample.gpkwh)
+                # every new sample brings the curve of the server along
+                self.assertEqual(result.data['forecast'], client.forecast.return_value)
+                set_ampel.assert_called_once()
+
+                while worker.busy:
+                    threading.Event().wait(0.01)
+                self.assertTrue(worker.submit())
+                self.assertEqual(worker.results.get(timeout=5).kind, 'unchanged')
+            finally:
+                worker.stop()
+
+    def test_region_engine_matches_scalar_estimation(self):
+        def fetch(lat, lon):
+            weather = fake_weather_data(lat, lon)
+            weather['dt'] = 1000
+            return weather
+
+        now = datetime(2022, 6, 1, 13, 30)
+        engine = region.RegionEngine([region.DEFAULT_REGION], scheduler=AdaptiveScheduler(fetch))
+        self.assertTrue(engine.refresh(now=1000))
+        sample = engine.estimate(now)['germany']
+
+        wind = fetch(util.HOLTRIEM_LAT, util.HOLTRIEM_LON)['wind']['speed']
+        self.assertAlmostEqual(sample.onshore, co2_ampel.estimate_onshore_wind_power(wind))
+        self.assertAlmostEqual(sample.solar, co2_ampel.estimate_solar_power(now, fetch(util.OLDENBURG_LAT, util.OLDENBURG_LON)['clouds']['all']))
+        expected = co2_ampel.estimate_batch([now], [wind], [fetch(util.BOR_WIN_LAT, util.BOR_WIN_LON)['wind']['speed']],
+                                            [fetch(util.OLDENBURG_LAT, util.OLDENBURG_LON)['clouds']['all']])
+        self.assertAlmostEqual(sample.gpkwh, expected['gpkwh'][0])
+
+    def test_region_engine_matches_precise_mode(self):
+        dt = datetime.now().timestamp()
+        scheduler = AdaptiveScheduler(lambda lat, lon: weather_at(lat, lon, dt))
+        engine = region.RegionEngine([region.DEFAULT_REGION], use_precise=True, scheduler=scheduler)
+        self.assertTrue(engine.refresh())
+
+        # both read the same weather from the scheduler, so the region equals the single region precise mode
+        all_info = co2_ampel.get_all_information(use_precise=True, fetch=scheduler.get, cached=True)
+        sample = engine.estimate(all_info['sample'].time)['germany']
+        for field in ('onshore', 'offshore', 'solar', 'gpkwh', 'cloudiness'):
+            self.assertAlmostEqual(getattr(sample, field), getattr(all_info['sample'], field), msg=field)
+
+    def test_region_engine_shares_locations(self):
+        calls = []
+        def fetch(lat, lon):
+            calls.append((lat, lon))
+            weather = fake_weather_data(lat, lon)
+            weather['dt'] = int(datetime.now().timestamp())
+            return weather
+
+        regions = region.load_regions(os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.example.json"))
+        self.assertEqual([r.name for r in regions], ['tennet', '50hertz', 'amprion', 'transnetbw'])
+        engine = region.RegionEngine(regions, scheduler=AdaptiveScheduler(fetch, max_workers=1))
+        engine.refresh()
+        # the offshore location of three regions and Holtriem are requested once
+        self.assertEqual(len(calls), len(set(calls)))
+        self.assertEqual(set(calls), set(engine.locations()))
+        self.assertLess(len(calls), sum(len(r.locations()) for r in regions))
+
+        samples = engine.estimate(datetime(2022, 6, 1, 13, 30))
+        self.assertEqual(samples['amprion'].offshore, 0)
+        self.assertAlmostEqual(samples['tennet'].total, co2_ampel.estimate_needed_power(datetime(2022, 6, 1, 13, 30), 18, 6))
+
+        # precise mode averages the parks of each region
+        parks = precise_wind.ParkTable({(53.5, 8.1): 1, (53.6, 8.2): 3})
+        offshore = precise_wind.ParkTable({(54.3, 6.2): 1})
+        engine = region.RegionEngine([region.Region('a', (53.1, 8.2), (0, 0), (0, 0), parks, offshore),
+                                      region.Region('b', (53.1, 8.2), (0, 0), (0, 0), parks, offshore, onshore_share=0.5)],
+                                     use_precise=True, scheduler=AdaptiveScheduler(fetch))
+        calls.clear()
+        engine.refresh()
+        self.assertEqual(len(calls), 4)
+        samples = engine.estimate(datetime(2022, 6, 1, 13, 30))
+        self.assertAlmostEqual(samples['b'].onshore, samples['a'].onshore / 2)
+        self.assertEqual(samples['a'].coverage, 1)
+
+    def test_region_daemon_publishes_the_led_region(self):
+        def fetch(lat, lon):
+            return weather_at(lat, lon, datetime.now().timestamp())
+
+        regions_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.example.json")
+        engine = region.RegionEngine(region.load_regions(regions_path), scheduler=AdaptiveScheduler(fetch))
+        stop_event = threading.Event()
+        published = []
+        def on_sample(all_info):
+            published.append(server.to_json_info(all_info))
+            stop_event.set()
+
+        with mock.patch('region.write_region_sample'), mock.patch('rgb_controller.set_ampel'):
+            region.run_daemon(engine, led_region='amprion', stop_event=stop_event, on_sample=on_sample)
+        self.assertEqual(len(published), 1)
+        self.assertEqual(published[0]['power']['offshore'], 0)
+
+        # the options of the single region daemon are rejected instead of being ignored
+        for option in (['--adaptive'], ['--forecast-hours', '48'], ['--storage', 'binary']):
+            with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+                co2_ampel.main(['--regions', regions_path] + option)
+
+    def test_region_engine_skips_regions_with_invalid_weather(self):
+        def fetch(lat, lon):
+            if (lat, lon) == (52.52, 13.405):
+                return {'cod': 500, 'message': "internal error"}
+            return weather_at(lat, lon, datetime.now().timestamp())
+
+        regions = region.load_regions(os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.example.json"))
+        engine = region.RegionEngine(regions, scheduler=AdaptiveScheduler(fetch))
+        engine.refresh()
+        with self.assertLogs('co2_ampel', level='WARNING'):
+            samples = engine.estimate(datetime(2022, 6, 1, 13, 30))
+        self.assertEqual(sorted(samples), ['amprion', 'tennet', 'transnetbw'])
+
+    def test_region_solar_factors(self):
+        factors = {str(month): month / 10 for month in range(12, 0, -1)}
+        self.assertEqual(region.Region('a', (0, 0), (0, 0), (0, 0), solar_factors=factors).solar_factors,
+                         {month: month / 10 for month in range(1, 13)})
+        self.assertEqual(list(region.DEFAULT_REGION.solar_factors.values()), list(co2_ampel.SOLAR_FACTOR.values()))
+        self.assertEqual(list(region.DEFAULT_REGION.solar_factors), list(range(1, 13)))
+        del factors['7']
+        self.assertRaises(ValueError, region.region_from_dict, {'name': 'a', 'solar_location': (0, 0), 'onshore_location': (0, 0),
+                                                                'offshore_location': (0, 0), 'solar_factors': factors})
+        self.assertRaises(ValueError, region.solar_factors_by_month, {**factors, 'july': 1})
+
+    def test_region_engine_precise_on_grid(self):
+        def fetch(lat, lon):
+            return weather_at(lat, lon, datetime.now().timestamp())
+        def sweep_fetch(lat, lon):
+            if lat == 10:
+                raise RateLimitExceeded()
+            return fetch(lat, lon)
+
+        parks = precise_wind.ParkTable({(53.51, 8.11): 1, (53.52, 8.12): 3, (52.0, 9.0): 4})
+        offshore = precise_wind.ParkTable({(54.3, 6.2): 1})
+        engine = region.RegionEngine([region.Region('a', (53.1, 8.2), (0, 0), (0, 0), parks, offshore)], use_precise=True,
+                                     scheduler=AdaptiveScheduler(fetch, sweep_fetch=sweep_fetch))
+        try:
+            precise_wind.enable_grid(resolution=0.5)
+            # the two parks near 53.5, 8.1 share a cell
+            self.assertEqual(len(engine.sweep_locations()), 3)
+            engine.refresh()
+            sample = engine.estimate(datetime(2022, 6, 1, 13, 30))['a']
+            self.assertEqual(sample.coverage, 1)
+
+            # without any offshore wind speed the region is left out
+            offshore = precise_wind.ParkTable({(10.0, 10.0): 1})
+            engine.regions = [region.Region('b', (53.1, 8.2), (0, 0), (0, 0), parks, offshore)]
+            engine.refresh()
+            with self.assertLogs('co2_ampel', level='WARNING'):
+                self.assertEqual(engine.estimate(datetime(2022, 6, 1, 13, 30)), {})
+        finally:
+            precise_wind.disable_grid()
+
 unittest.main()
\ No newline at end of file
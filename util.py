@@ -1,5 +1,14 @@
 import json
-import requests as req
+import logging
+import threading
+import time
+
+import metrics
+from rate_limiter import PRIORITY_HIGH, PRIORITY_LOW, RateLimitExceeded, RateLimiter
+
+# requests is imported with the first request, so the helper functions can be used without loading it
+
+logger = logging.getLogger("co2_ampel")
 
 def map_value(x, a, b, c, d):
     """maps the value x in relation to a and b to c and d"""
@@ -38,9 +47,147 @@ def load_api_key():
             KEY = f.read().rstrip()
     return KEY
 
-def request_weather_data(lat, lon):
-    """Requests weather data using the openweathermap api."""
+# base url of the openweathermap api. Can be pointed to a local stand-in server for testing
+API_URL = "https://api.openweathermap.org/data/2.5"
+
+# timeouts in seconds for establishing the connection and for waiting for the response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+
+# number of keep-alive connections kept open to the api host
+POOL_SIZE = 8
+
+_session = None
+_session_lock = threading.Lock()
+
+# callables that are called with (lat, lon, seconds) after every request
+latency_listeners = []
+
+# WeatherCache in front of request_weather_data, see enable_cache
+CACHE = None
+CACHE_PATH = "data/weather_cache.sqlite"
+
+# RateLimiter of the api requests, see enable_rate_limit
+RATE_LIMITER = None
+
+def get_session():
+    """returns the shared requests session. The session keeps the connections alive,
+    so consecutive requests don't need a new TCP and TLS handshake"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests as req
+            from requests.adapters import HTTPAdapter
+
+            _session = req.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+def configure_session(connect_timeout=None, read_timeout=None, pool_size=None):
+    """changes the timeouts and the pool size. Changing the pool size closes the current session"""
+    global CONNECT_TIMEOUT, READ_TIMEOUT, POOL_SIZE
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = read_timeout
+    if pool_size is not None and pool_size != POOL_SIZE:
+        POOL_SIZE = pool_size
+        close_session()
+
+def close_session():
+    """closes all pooled connections. The next request opens a new session"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def enable_cache(path=CACHE_PATH, ttl=600, max_entries=512):
+    """puts a WeatherCache in front of request_weather_data. Responses are reused until their
+    observation is older than ttl seconds. With path=None the cache is not stored on disk."""
+    global CACHE
+    from weather_cache import WeatherCache
+    disable_cache()
+    CACHE = WeatherCache(path, ttl=ttl, max_entries=max_entries)
+    return CACHE
+
+def disable_cache():
+    global CACHE
+    if CACHE is not None:
+        CACHE.close()
+        CACHE = None
+
+def enable_rate_limit(per_minute=60, per_day=30000, **kwargs):
+    """limits the requests of request_weather_data, see rate_limiter.RateLimiter for the parameters.
+    The defaults stay within the free plan of openweathermap (60 per minute, 1,000,000 per month)"""
+    global RATE_LIMITER
+    RATE_LIMITER = RateLimiter(per_minute, per_day, **kwargs)
+    return RATE_LIMITER
+
+def disable_rate_limit():
+    global RATE_LIMITER
+    RATE_LIMITER = None
+
+def remaining_budget():
+    """returns the requests left in the current minute and day as dict with the keys 'minute' and 'day',
+    None if the requests are not limited"""
+    limiter = RATE_LIMITER
+    return None if limiter is None else limiter.remaining()
+
+def _request_json(endpoint, lat, lon, priority=PRIORITY_HIGH):
+    """requests API_URL/endpoint for lat, lon within the rate limit and returns the decoded response"""
+    limiter = RATE_LIMITER
+    if limiter is not None:
+        try:
+            limiter.acquire(priority)
+        except RateLimitExceeded:
+            metrics.inc('rate_limited_total', priority='high' if priority == PRIORITY_HIGH else 'low')
+            raise
+
     key = load_api_key()
-    print(f"[INFO] requesting weather at {lat}, {lon}")
-    res = req.get(f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={key}")
-    return json.loads(res.text)
\ No newline at end of file
+    start = time.perf_counter()
+    try:
+        res = get_session().get(f"{API_URL}/{endpoint}", params={'lat': lat, 'lon': lon, 'appid': key},
+                                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except Exception as e:
+        metrics.inc('api_errors_total', reason=type(e).__name__)
+        raise
+    latency = time.perf_counter() - start
+    if res.status_code != 200:
+        metrics.inc('api_errors_total', reason=str(res.status_code))
+    logger.info("requested %s at %s, %s in %.0f ms", endpoint, lat, lon, latency * 1000)
+
+    for listener in latency_listeners:
+        listener(lat, lon, latency)
+
+    return json.loads(res.text)
+
+def request_weather_data(lat, lon, use_cache=True, priority=PRIORITY_HIGH):
+    """Requests weather data using the openweathermap api.
+    If the cache is enabled and holds a fresh response for lat, lon, no request is made.
+    Raises requests.Timeout if the api does not answer within CONNECT_TIMEOUT and READ_TIMEOUT
+    and RateLimitExceeded if the rate limit does not allow the request, see enable_rate_limit."""
+    cache = CACHE if use_cache else None
+    if cache is not None:
+        weather = cache.get(lat, lon)
+        if weather is not None:
+            metrics.inc('cache_hits_total')
+            return weather
+
+    weather = _request_json("weather", lat, lon, priority)
+    # only successful responses carry the observation time
+    if cache is not None and 'dt' in weather:
+        cache.put(lat, lon, weather)
+    return weather
+
+def request_park_weather_data(lat, lon, use_cache=True):
+    """requests weather data like request_weather_data with the low priority of the windpark sweep"""
+    return request_weather_data(lat, lon, use_cache, PRIORITY_LOW)
+
+def request_forecast_data(lat, lon, priority=PRIORITY_HIGH):
+    """Requests the 5 day forecast in 3 hour steps using the openweathermap api.
+    The response holds the steps in 'list', every step has a 'dt', 'wind' and 'clouds' like a weather response.
+    Forecasts are not cached here, see forecast.ForecastCache"""
+    return _request_json("forecast", lat, lon, priority)
@@ -0,0 +1,88 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+class WeatherCache:
+    """Caches weather responses by their coordinates.
+
+    A response is reused until its observation time 'dt' is older than ttl seconds, as
+    openweathermap only refreshes the station data every ~10 minutes. Responses are kept
+    at least min_ttl seconds, so a station that reports an old 'dt' is not requested over and over.
+    If more than max_entries locations are cached, the least recently used one is dropped.
+    If path is provided, the cache is stored in a sqlite database and survives restarts."""
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 600, min_ttl: float = 60, max_entries: int = 512, precision: int = 4):
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_entries = max_entries
+        self.precision = precision
+
+        self._entries: "OrderedDict[Tuple[float, float], Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS weather (lat REAL, lon REAL, expires REAL, data TEXT, PRIMARY KEY (lat, lon))")
+            self._db.execute("DELETE FROM weather WHERE expires <= ?", (time.time(),))
+            self._db.commit()
+            rows = self._db.execute("SELECT lat, lon, expires, data FROM weather ORDER BY expires").fetchall()
+            for lat, lon, expires, data in rows[-max_entries:]:
+                self._entries[(lat, lon)] = (expires, json.loads(data))
+
+    def _key(self, lat: float, lon: float) -> Tuple[float, float]:
+        return round(lat, self.precision), round(lon, self.precision)
+
+    def get(self, lat: float, lon: float, now: Optional[float] = None) -> Optional[dict]:
+        """returns the cached weather at lat, lon or None if there is no fresh response"""
+        now = time.time() if now is None else now
+        key = self._key(lat, lon)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, weather = entry
+            if expires <= now:
+                return None
+            self._entries.move_to_end(key)
+            return weather
+
+    def put(self, lat: float, lon: float, weather: dict, now: Optional[float] = None) -> None:
+        """stores the weather response at lat, lon"""
+        now = time.time() if now is None else now
+        observed = weather.get('dt', now)
+        expires = min(max(observed + self.ttl, now + self.min_ttl), now + self.ttl)
+        key = self._key(lat, lon)
+
+        with self._lock:
+            self._entries[key] = (expires, weather)
+            self._entries.move_to_end(key)
+
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO weather VALUES (?, ?, ?, ?)", (*key, expires, json.dumps(weather)))
+                self._db.executemany("DELETE FROM weather WHERE lat = ? AND lon = ?", evicted)
+                self._db.commit()
+
+    def clear(self) -> None:
+        """removes all cached responses"""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM weather")
+                self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def __len__(self):
+        return len(self._entries)